@@ -47,6 +47,10 @@ CONFIG_SCHEMA = \
                 "description": "write log to stdout",
                 "default": True
             },
+            "optimization": {
+                "$ref": "#/$defs/optimization",
+                "default": {}
+            },
 
             "subaccounts": {
                 "type": "array",
@@ -71,6 +75,28 @@ CONFIG_SCHEMA = \
                     "timeframe": {
                         "type": "integer",
                         "description": "timeframe for ticker data in minutes"
+                    },
+                    "modifiers": {
+                        "type": "array",
+                        "description": "transformations of the candles, applied one after another",
+                        "items": {
+                            "type": "object",
+                            "required": ["type"],
+                            "properties": {
+                                "enabled": {
+                                    "type": "boolean",
+                                    "default": True
+                                },
+                                "type": {
+                                    "type": "string",
+                                    "enum": ["volumebars", "dollarbars", "resample", "heikinashi"]
+                                },
+                                "params": {
+                                    "type": "object",
+                                    "default": {}
+                                }
+                            }
+                        }
                     }
                 }
             },
@@ -86,6 +112,61 @@ CONFIG_SCHEMA = \
                 }
             },
 
+            "optimization": {
+                "type": "object",
+                "properties": {
+                    "enabled": {
+                        "type": "boolean",
+                        "description": "run walk-forward optimization for strategies with a search space",
+                        "default": False
+                    },
+                    "days_train": {
+                        "type": "integer",
+                        "description": "length of the in-sample period in days",
+                        "default": 30
+                    },
+                    "days_test": {
+                        "type": "integer",
+                        "description": "length of the out-of-sample period in days",
+                        "default": 7
+                    },
+                    "log_optimization": {
+                        "type": "boolean",
+                        "description": "log the parameter combinations and results of every optimization",
+                        "default": False
+                    },
+                    "plot_optimization": {
+                        "type": "boolean",
+                        "description": "plot the wallets of all parameter combinations of every optimization",
+                        "default": False
+                    },
+                    "workers": {
+                        "type": "integer",
+                        "description": "number of processes for the parameter combinations, 0 uses all cpu cores",
+                        "minimum": 0,
+                        "default": 1
+                    },
+                    "shared_memory": {
+                        "type": "boolean",
+                        "description": "load the candles once and share them read-only with the optimization workers",
+                        "default": True
+                    },
+                    "batch": {
+                        "type": "boolean",
+                        "description": "run all parameter combinations in one batch backtest if the strategy sets "
+                                       "use_tick_batch, not possible with plot_optimization",
+                        "default": False
+                    },
+                    "screening_top_k": {
+                        "type": "integer",
+                        "description": "run only the best parameter combinations of a vectorized backtest of the "
+                                       "strategy signals, 0 runs all",
+                        "minimum": 0,
+                        "default": 0
+                    }
+                }
+            },
+
             "subaccount": {
                 "type": "object",
                 "required": ["subaccount_id", "strategy", "exchange"],
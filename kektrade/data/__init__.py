@@ -1 +1,2 @@
 from kektrade.data.dataprovider import DataProvider
+from kektrade.data.barview import BarView
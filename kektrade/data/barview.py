@@ -0,0 +1,72 @@
+import logging
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+from pandas import DataFrame
+
+logger = logging.getLogger(__name__)
+
+
+class BarView():
+    """
+    Read-only column store of a dataframe for the tick function of a strategy. Every column is kept as numpy array,
+    so reading a value is an array lookup instead of a dataframe access.
+    Columns are read with view["close"] or view.close, single values with view.close[i] or view.at[i, "close"] like
+    with a dataframe. view[i] returns all values of a candle as dictionary.
+    """
+
+    def __init__(self, dataframe: DataFrame):
+        """
+        Extract the columns of the dataframe. Columns that are added to the dataframe later are not part of the view.
+        :param dataframe: dataframe with indicators
+        """
+        columns = {}
+        for col in dataframe.columns:
+            # The view shares the memory of the dataframe, only the view is read-only
+            values = dataframe[col].to_numpy().view()
+            values.flags.writeable = False
+            columns[col] = values
+
+        # Set without __setattr__, see __getattr__
+        self.__dict__["columns"] = columns
+        self.__dict__["length"] = len(dataframe.index)
+        self.__dict__["at"] = BarViewAt(columns)
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        try:
+            return self.__dict__["columns"][name]
+        except KeyError:
+            raise AttributeError(f"no column {name}")
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("bar view is read-only")
+
+    def __getitem__(self, key: Union[str, int]) -> Union[np.ndarray, Dict[str, Any]]:
+        if isinstance(key, str):
+            return self.columns[key]
+        return {col: values[key] for col, values in self.columns.items()}
+
+    def __contains__(self, col: str) -> bool:
+        return col in self.columns
+
+    def __len__(self) -> int:
+        return self.length
+
+    def keys(self) -> List[str]:
+        """
+        :return: column names
+        """
+        return list(self.columns.keys())
+
+
+class BarViewAt():
+    """
+    Access to single values of a bar view with at[i, col], like DataFrame.at with a range index.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]):
+        self.columns: Dict[str, np.ndarray] = columns
+
+    def __getitem__(self, key: Tuple[int, str]) -> Any:
+        index, col = key
+        return self.columns[col][index]
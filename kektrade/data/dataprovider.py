@@ -1,8 +1,9 @@
 import os
 from multiprocessing import Lock
 from pathlib import Path
-from typing import NamedTuple, Dict, List, Any
+from typing import NamedTuple, Dict, List, Any, Union, Tuple
 from datetime import datetime
+import json
 import logging
 import pandas as pd
 from pandas import DataFrame
@@ -11,7 +12,9 @@ import uuid
 from kektrade import utils
 from kektrade.exchange.resolver import ExchangeEndpoint
 from kektrade.misc import EnumString
-from kektrade.data.volumebars import VolumeBarAggregator
+from kektrade.data.volumebars import VolumeBarBuilder
+from kektrade.data.modifiers import ModifierPipeline
+from kektrade.data.sharedstore import SharedCandleStore, SharedFrame, SharedFrameHandle
 
 logger = logging.getLogger(__name__)
 
@@ -41,13 +44,21 @@ class DataproviderEndpoint(EnumString):
 
 
 class DataProvider():
-    def __init__(self, search_path: str, file_lock: Lock):
+    def __init__(self, search_path: str, file_lock: Lock, live: bool = False):
         self.file_lock: Lock = file_lock
         self.search_path: str = search_path
+        self.live: bool = live
 
         self.main_pair: PairDataInfo = None
         self.aux_pairs: List[PairDataInfo] = []
         self.pair_dataframe_dict: Dict[PairDataInfo, DataFrame] = {}
+        self.pair_history_dict: Dict[str, DataFrame] = {}
+        self.pair_history_period_dict: Dict[str, DatetimePeriod] = {}
+        self.pair_shared_dict: Dict[str, SharedFrame] = {}
+
+        # Live mode: volume bar builders and their bars for every pair and modifier
+        self.volume_bar_builders: Dict[str, VolumeBarBuilder] = {}
+        self.volume_bars: Dict[str, DataFrame] = {}
 
 
     def set_pairs(self, subaccount: Dict[str, Any]) -> None:
@@ -90,29 +101,118 @@ class DataProvider():
         Check if cached candles have all candles required for range. If not download candle data from
         datasource endpoint and save to cache.
         Then load the required part of the cached files as pandas dataframe.
+        If the range is covered by the history in memory, it is cut out of the history instead.
+        In live mode the modifiers only process the new candles.
         :param range: required range of data as unix timestamps
         """
 
         pairs: List[PairDataInfo] = [self.main_pair,] + self.aux_pairs
         for pair in pairs:
-            path = DataProvider._get_data_path(self.search_path, pair)
-
-            DataProvider._verify_cached_data(pair, range, path)
-            df = DataProvider._read_ohlcv_csv(path)
-            df = DataProvider._cut_range(df, range)
-            df = DataProvider._apply_modifiers(df, pair)
+            df = self._get_history_range(pair, range)
+            if df is None:
+                df = self._load_pair_range(pair, range)
+            if self.live:
+                df = self._apply_modifiers_live(df, pair)
+            else:
+                df = self._apply_modifiers(df, pair)
             self.pair_dataframe_dict[pair.id] = df
 
 
+    def load_history_to_memory(self, range: DatetimePeriod) -> None:
+        """
+        Load the unmodified candles of all pairs for a long period and keep them in memory.
+        Used by long-lived processes like the optimizer workers that load many smaller ranges, so the cache files
+        are only read once.
+        :param range: datetime range of the history
+        """
+        pairs: List[PairDataInfo] = [self.main_pair,] + self.aux_pairs
+        for pair in pairs:
+            self.pair_history_dict[pair.id] = self._load_pair_range(pair, range)
+            self.pair_history_period_dict[pair.id] = range
+
+
+    def publish_history(self, store: SharedCandleStore) -> Dict[str, SharedFrameHandle]:
+        """
+        Publish the history of all pairs into shared memory.
+        The handles are keyed by the cache file path, since the pair ids are different in every process.
+        :param store: shared memory store of the calling process
+        :return: dictionary with handles
+        """
+        handles = {}
+        pairs: List[PairDataInfo] = [self.main_pair,] + self.aux_pairs
+        for pair in pairs:
+            key = str(DataProvider._get_data_path(self.search_path, pair))
+            handles[key] = store.publish(self.pair_history_dict[pair.id])
+        return handles
+
+
+    def attach_history(self, handles: Dict[str, SharedFrameHandle], range: DatetimePeriod) -> None:
+        """
+        Use the history another process published into shared memory instead of loading it.
+        :param handles: handles from publish_history
+        :param range: datetime range of the history
+        """
+        pairs: List[PairDataInfo] = [self.main_pair,] + self.aux_pairs
+        for pair in pairs:
+            key = str(DataProvider._get_data_path(self.search_path, pair))
+            self.pair_shared_dict[pair.id] = SharedFrame(handles[key])
+            self.pair_history_period_dict[pair.id] = range
+            self.pair_history_dict.pop(pair.id, None)
+
+
+    def _load_pair_range(self, pair: PairDataInfo, range: DatetimePeriod) -> DataFrame:
+        """
+        Make sure the cache file of the pair has the range and read the range from it.
+        :param pair: pair info
+        :param range: datetime range
+        :return: dataframe without modifiers applied
+        """
+        path = DataProvider._get_data_path(self.search_path, pair)
+
+        DataProvider._verify_cached_data(pair, range, path)
+        df = DataProvider._read_ohlcv_csv(path)
+        return DataProvider._cut_range(df, range)
+
+
+    def _get_history_range(self, pair: PairDataInfo, range: DatetimePeriod) -> Union[None, DataFrame]:
+        """
+        Cut the range out of the history in memory.
+        :param pair: pair info
+        :param range: datetime range
+        :return: dataframe or None if there is no history or it doesn't cover the range
+        """
+        if pair.id not in self.pair_history_period_dict:
+            return None
+
+        history_period = self.pair_history_period_dict[pair.id]
+        if range.start < history_period.start or range.end > history_period.end:
+            return None
+
+        if pair.id in self.pair_shared_dict:
+            return self.pair_shared_dict[pair.id].get_range(range.start, range.end)
+        return DataProvider._cut_range(self.pair_history_dict[pair.id], range)
+
+
     def get_pair_dataframe(self, main_pair: PairDataInfo) -> DataFrame:
         """
         Return reference to dataframe in memory.
+        If the history is attached from shared memory and the pair has no modifiers, the values are a read-only
+        view of the shared memory.
         :param main_pair: pair info
         :return: dataframe
         """
         return self.pair_dataframe_dict[main_pair.id]
 
 
+    def set_pair_dataframe(self, pair: PairDataInfo, df: DataFrame) -> None:
+        """
+        Replace the dataframe of a pair, for example with a dataframe that already has the indicators.
+        :param pair: pair info
+        :param df: dataframe with the same candles as the loaded one
+        """
+        self.pair_dataframe_dict[pair.id] = df
+
+
     @staticmethod
     def _get_data_path(cache_path: str, pair: PairDataInfo) -> Path:
         """
@@ -235,19 +335,112 @@ class DataProvider():
         """
         return df.drop_duplicates(subset=['date'], keep='last')
 
-    @staticmethod
-    def _apply_modifiers(df: DataFrame, pair: PairDataInfo) -> DataFrame:
+    def _apply_modifiers(self, df: DataFrame, pair: PairDataInfo) -> DataFrame:
         """
-        Apply modifiers such as volume bars to the dataframe.
+        Apply modifiers such as volume bars to the dataframe, see kektrade.data.modifiers. The modified candles
+        are cached in the modifiers folder of the search path.
+        :param df: candles
+        :param pair: pair info
+        :return: modified dataframe
         """
-        if pair.modifiers is not None:
-            for modifier in pair.modifiers:
-                if modifier["enabled"] == True:
-                    if modifier["type"] == "volumebars":
-                        logger.info("Apply modifier: VolumeBars")
-                        rolling_median_window = modifier["params"]["rolling_median_window"]
-                        target_timeframe = modifier["params"]["target_timeframe"]
+        cache_path = Path(os.path.join(self.search_path, "modifiers"))
+        return ModifierPipeline(pair.modifiers, cache_path).apply(df)
 
-                        df = VolumeBarAggregator().convert(df, rolling_median_window, target_timeframe, False)
+    def _apply_modifiers_live(self, df: DataFrame, pair: PairDataInfo) -> DataFrame:
+        """
+        Apply the modifiers in live mode. If the first modifier builds volume bars, they are built incrementally from
+        the candles that are new since the last call. The other modifiers are applied to the whole dataframe without
+        cache, since the candles change with every call.
+        :param df: candles of the required range
+        :param pair: pair info
+        :return: modified dataframe
+        """
+        modifiers = [(index, m) for index, m in enumerate(pair.modifiers or []) if m["enabled"] == True]
+        if len(modifiers) > 0 and modifiers[0][1]["type"] == "volumebars":
+            index, modifier = modifiers.pop(0)
+            df = self._update_volume_bars(df, pair, index, modifier["params"])
+        return ModifierPipeline([m for _, m in modifiers]).apply(df)
 
-        return df
+    def _update_volume_bars(self, df: DataFrame, pair: PairDataInfo, index: int, params: Dict[str, Any]) -> DataFrame:
+        """
+        Add the new candles to the volume bars of a modifier. The builder state and the bars are saved next to the
+        cache file of the pair, so after a restart only the candles since the last save are added.
+        :param df: candles of the required range
+        :param pair: pair info
+        :param index: position of the modifier
+        :param params: modifier parameters
+        :return: volume bars of the range
+        """
+        key = f"{pair.id}_{index}"
+        path = DataProvider._get_data_path(self.search_path, pair)
+        path = path.with_name(f"{path.stem}_volumebars{index}")
+
+        builder = self.volume_bar_builders.get(key)
+        if builder is None:
+            builder, bars = DataProvider._load_volume_bars(path, params, df)
+            if builder is None:
+                logger.info("Apply modifier: VolumeBars")
+                builder = VolumeBarBuilder(params["rolling_median_window"], params["target_timeframe"])
+                bars = builder.initialize(df)
+                DataProvider._save_volume_bars(path, builder, bars, append=False)
+            self.volume_bar_builders[key] = builder
+        else:
+            bars = self.volume_bars[key]
+
+        new_bars = builder.update(df)
+        if len(new_bars.index) > 0:
+            bars = pd.concat([bars, new_bars], ignore_index=True)
+        DataProvider._save_volume_bars(path, builder, new_bars, append=True)
+
+        # Bars of candles that left the range are dropped like in a conversion of the range
+        bars = bars[bars["date"] >= df["date"].iloc[0]].reset_index(drop=True)
+        self.volume_bars[key] = bars
+        return bars
+
+    @staticmethod
+    def _load_volume_bars(path: Path, params: Dict[str, Any],
+                          df: DataFrame) -> Tuple[Union[None, VolumeBarBuilder], Union[None, DataFrame]]:
+        """
+        Restore a volume bar builder and its bars saved with _save_volume_bars.
+        :param path: path of the saved files without extension
+        :param params: modifier parameters
+        :param df: candles of the required range
+        :return: builder and bars or None if there is no state that continues with the candles
+        """
+        path_state = path.with_name(path.name + ".json")
+        path_bars = path.with_name(path.name + ".csv")
+        if not os.path.isfile(path_state) or not os.path.isfile(path_bars):
+            return None, None
+
+        with open(path_state, "r") as json_file:
+            state = json.load(json_file)
+        builder = VolumeBarBuilder(params["rolling_median_window"], params["target_timeframe"])
+        if state["rolling_median_window"] != builder.rolling_median_window or \
+                state["target_timeframe"] != builder.target_timeframe:
+            return None, None
+
+        builder.set_state(state)
+        if builder.last_date is None or not (df["date"].iloc[0] <= builder.last_date <= df["date"].iloc[-1]):
+            return None, None
+
+        logger.info("Apply modifier: VolumeBars, continue saved bars")
+        bars = pd.read_csv(path_bars, sep=',', parse_dates=['date'], index_col=0,
+                           float_precision="round_trip")
+        return builder, bars
+
+    @staticmethod
+    def _save_volume_bars(path: Path, builder: VolumeBarBuilder, bars: DataFrame, append: bool) -> None:
+        """
+        Save the state of a volume bar builder and write its bars.
+        :param path: path of the saved files without extension
+        :param builder: volume bar builder
+        :param bars: bars to write
+        :param append: append the bars to the saved bars or replace them
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path.with_name(path.name + ".json"), "w") as json_file:
+            json.dump(builder.get_state(), json_file)
+        if append:
+            bars.to_csv(path.with_name(path.name + ".csv"), mode="a", header=False)
+        else:
+            bars.to_csv(path.with_name(path.name + ".csv"))
@@ -0,0 +1,279 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from kektrade.data.volumebars import VolumeBarAggregator
+
+logger = logging.getLogger(__name__)
+
+
+class IModifier(ABC):
+    """
+    Transformation of the candles of a pair, configured in the modifiers list of a pair:
+    {"enabled": true, "type": "volumebars", "params": {...}}
+    The modifiers of a pair are applied one after another, every modifier gets the output of the previous one.
+    """
+
+    # Value of type in the config
+    name: str = ""
+    # Part of the cache key, increase it when the output of the modifier changes
+    version: int = 1
+
+    def __init__(self, params: Dict[str, Any]):
+        """
+        :param params: parameters from the config
+        """
+        self.params: Dict[str, Any] = params
+
+    @abstractmethod
+    def apply(self, df: DataFrame) -> DataFrame:
+        """
+        Transform the candles. The input must not be changed, it can be a read-only view of shared memory.
+        :param df: candles with date, open, high, low, close, volume and funding_rate
+        :return: new dataframe with the same columns
+        """
+        pass
+
+
+class VolumeBarsModifier(IModifier):
+    """
+    Volume bars, see VolumeBarAggregator.convert.
+    Parameters: rolling_median_window, target_timeframe
+    """
+
+    name = "volumebars"
+
+    def apply(self, df: DataFrame) -> DataFrame:
+        return VolumeBarAggregator.convert(df, self.params["rolling_median_window"], self.params["target_timeframe"],
+                                           False)
+
+
+class DollarBarsModifier(IModifier):
+    """
+    Dollar bars, volume bars of the traded value close * volume instead of the volume. A bar is closed when its
+    traded value is above the rolling median traded value times target_timeframe. The volume of the bars is the
+    traded value.
+    Parameters: rolling_median_window, target_timeframe
+    """
+
+    name = "dollarbars"
+
+    def apply(self, df: DataFrame) -> DataFrame:
+        df = df.copy()
+        df["volume"] = df["close"] * df["volume"]
+        return VolumeBarAggregator.convert(df, self.params["rolling_median_window"], self.params["target_timeframe"],
+                                           False)
+
+
+class ResampleModifier(IModifier):
+    """
+    Resample the candles to a larger timeframe. The candles are grouped by the start of their timeframe period,
+    the date of a bar is the date of its last candle like with volume bars. The last bar can be unfinished.
+    Parameters: timeframe in minutes
+    """
+
+    name = "resample"
+
+    def apply(self, df: DataFrame) -> DataFrame:
+        period = df["date"].dt.floor(f"{int(self.params['timeframe'])}min")
+        bars = df.groupby(period.to_numpy(), sort=True).agg(
+            date=("date", "last"),
+            open=("open", "first"),
+            high=("high", "max"),
+            low=("low", "min"),
+            close=("close", "last"),
+            volume=("volume", "sum"),
+            funding_rate=("funding_rate", "sum"),
+            candle_count=("date", "size")
+        )
+        return bars.reset_index(drop=True)
+
+
+class HeikinAshiModifier(IModifier):
+    """
+    Heikin-Ashi candles. The close is the mean of open, high, low and close, the open is the mean of the open and
+    close of the previous Heikin-Ashi candle.
+    Parameters: none
+    """
+
+    name = "heikinashi"
+
+    def apply(self, df: DataFrame) -> DataFrame:
+        df = df.copy()
+        if len(df.index) == 0:
+            return df
+
+        ha_close = (df["open"] + df["high"] + df["low"] + df["close"]).to_numpy(dtype=np.float64) / 4
+        # open[i] = (open[i - 1] + close[i - 1]) / 2 is an exponential moving average with alpha 0.5
+        seed = (df["open"].iloc[0] + df["close"].iloc[0]) / 2
+        ha_open = pd.Series(np.concatenate([[seed], ha_close[:-1]])).ewm(alpha=0.5, adjust=False).mean().to_numpy()
+
+        df["high"] = np.maximum(df["high"].to_numpy(dtype=np.float64), np.maximum(ha_open, ha_close))
+        df["low"] = np.minimum(df["low"].to_numpy(dtype=np.float64), np.minimum(ha_open, ha_close))
+        df["open"] = ha_open
+        df["close"] = ha_close
+        return df
+
+
+# Size limit of the modifier cache directory in bytes
+MAX_CACHE_SIZE = 2 * 1024 ** 3
+
+MODIFIERS = {cls.name: cls for cls in [VolumeBarsModifier, DollarBarsModifier, ResampleModifier, HeikinAshiModifier]}
+
+
+def create_modifier(modifier: Dict[str, Any]) -> IModifier:
+    """
+    :param modifier: modifier config with type and params
+    :return: modifier
+    """
+    if modifier["type"] not in MODIFIERS:
+        raise Exception(f"unknown modifier {modifier['type']}")
+    return MODIFIERS[modifier["type"]](modifier.get("params", {}))
+
+
+def dataset_fingerprint(df: DataFrame) -> str:
+    """
+    Hash of the columns and values of a dataframe, without the index.
+    :param df: dataframe
+    :return: hex digest
+    """
+    sha1 = hashlib.sha1(json.dumps([str(col) for col in df.columns]).encode())
+    sha1.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class ModifierPipeline():
+    """
+    Apply the enabled modifiers of a pair one after another.
+    With a cache directory the output of every step is saved as pickle file named after the hash of its input
+    fingerprint and the type, version and parameters of its modifier. The key of a step is the input fingerprint of
+    the next one, so only the candles of the first step are hashed. Repeated backtests and the optimizer workers
+    load the transformed candles from there instead of calculating them again, and a changed step only recalculates
+    the steps from there on. The least recently used files are deleted when the directory is larger than
+    max_cache_size.
+    """
+
+    def __init__(self, modifiers: Union[None, List[Dict[str, Any]]], cache_path: Union[None, Path] = None,
+                 max_cache_size: int = MAX_CACHE_SIZE):
+        """
+        :param modifiers: modifier configs of the pair
+        :param cache_path: directory of the cached steps or None to not cache
+        :param max_cache_size: size limit of the cache directory in bytes
+        """
+        self.modifiers: List[Dict[str, Any]] = [m for m in (modifiers or []) if m["enabled"] == True]
+        self.cache_path: Union[None, Path] = cache_path
+        self.max_cache_size: int = max_cache_size
+
+    def apply(self, df: DataFrame) -> DataFrame:
+        """
+        :param df: candles
+        :return: modified candles
+        """
+        if len(self.modifiers) == 0:
+            return df
+
+        if self.cache_path is None:
+            for modifier in self.modifiers:
+                logger.info(f"Apply modifier: {modifier['type']}")
+                df = create_modifier(modifier).apply(df)
+            return df
+
+        paths = []
+        fingerprint = dataset_fingerprint(df)
+        for modifier in self.modifiers:
+            fingerprint = ModifierPipeline._get_step_key(fingerprint, modifier)
+            paths.append(self.cache_path.joinpath(fingerprint + ".pkl"))
+
+        # Continue after the last cached step
+        start = 0
+        for step in reversed(range(len(paths))):
+            cached = ModifierPipeline._load(paths[step])
+            if cached is not None:
+                logger.info(f"Apply modifier: {self.modifiers[step]['type']}, load cached")
+                df = cached
+                start = step + 1
+                break
+
+        for step in range(start, len(self.modifiers)):
+            logger.info(f"Apply modifier: {self.modifiers[step]['type']}")
+            df = create_modifier(self.modifiers[step]).apply(df)
+            ModifierPipeline._save(paths[step], df)
+
+        if start < len(self.modifiers):
+            self._prune_cache()
+        return df
+
+    @staticmethod
+    def _get_step_key(fingerprint: str, modifier: Dict[str, Any]) -> str:
+        """
+        :param fingerprint: fingerprint of the input
+        :param modifier: modifier config
+        :return: hash of the input and the type, version and parameters of the modifier
+        """
+        key = json.dumps({
+            "input": fingerprint,
+            "type": modifier["type"],
+            "version": create_modifier(modifier).version,
+            "params": modifier.get("params", {})
+        }, sort_keys=True, default=str)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @staticmethod
+    def _load(path: Path) -> Union[None, DataFrame]:
+        """
+        Read the output of a step and mark it as recently used for _prune_cache.
+        :param path: pickle file
+        :return: output or None if it is not cached
+        """
+        try:
+            df = pd.read_pickle(path)
+            os.utime(path)
+        except FileNotFoundError:
+            # Not cached or deleted by another process
+            return None
+        return df
+
+    @staticmethod
+    def _save(path: Path, df: DataFrame) -> None:
+        """
+        Write the output of a step. Other processes can write the same file at the same time, so it is written
+        to a temporary file first and then renamed.
+        :param path: pickle file
+        :param df: output
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _prune_cache(self) -> None:
+        """
+        Delete the least recently used files until the cache directory is smaller than max_cache_size.
+        """
+        files = []
+        for path in self.cache_path.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(file[1] for file in files)
+        for _, file_size, path in sorted(files, key=lambda file: file[0]):
+            if size <= self.max_cache_size:
+                break
+            try:
+                # Another process can delete the same file
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
@@ -0,0 +1,130 @@
+import logging
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple, Dict, List
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+logger = logging.getLogger(__name__)
+
+
+class SharedFrameHandle(NamedTuple):
+    """
+    Picklable reference to a dataframe in shared memory. Sent to the worker processes instead of the data.
+    """
+    name: str
+    columns: List[str]
+    length: int
+
+
+class SharedCandleStore():
+    """
+    Owner of dataframes that are published into shared memory.
+    The block of a dataframe contains the date column as int64 nanoseconds, followed by all other columns as
+    float64 arrays, one after another. The store has to be closed by the process that created it.
+    """
+
+    def __init__(self):
+        self.blocks: Dict[str, SharedMemory] = {}
+
+    def publish(self, df: DataFrame) -> SharedFrameHandle:
+        """
+        Copy a dataframe with a date column and numeric columns into a new shared memory block.
+        :param df: dataframe
+        :return: handle to attach the dataframe in other processes
+        """
+        columns = [col for col in df.columns if col != "date"]
+        length = len(df.index)
+
+        shm = SharedMemory(create=True, size=max(1, length * 8 * (len(columns) + 1)))
+        self.blocks[shm.name] = shm
+
+        dates = np.ndarray((length,), dtype=np.int64, buffer=shm.buf)
+        dates[:] = df["date"].values.astype("datetime64[ns]").view(np.int64)
+        values = np.ndarray((len(columns), length), dtype=np.float64, buffer=shm.buf, offset=length * 8)
+        for i, col in enumerate(columns):
+            values[i, :] = df[col].values
+        del dates
+        del values
+
+        return SharedFrameHandle(name=shm.name, columns=columns, length=length)
+
+    @staticmethod
+    def is_publishable(df: DataFrame) -> bool:
+        """
+        Check if all columns besides the date column can be stored as float64.
+        Boolean and integer columns are converted to float64, object columns can't be published.
+        :param df: dataframe
+        :return: true if the dataframe can be published
+        """
+        if "date" not in df.columns:
+            return False
+        for col in df.columns:
+            if col != "date":
+                dtype = df[col].dtype
+                if not isinstance(dtype, np.dtype) or dtype.kind not in "biuf":
+                    return False
+        return True
+
+    def close(self) -> None:
+        """
+        Release all shared memory blocks. Workers that are still attached keep their mapping until they exit.
+        """
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks = {}
+
+
+class SharedFrame():
+    """
+    Read-only view of a dataframe in shared memory.
+    """
+
+    def __init__(self, handle: SharedFrameHandle):
+        """
+        Attach to the shared memory block of the handle.
+        :param handle: handle from SharedCandleStore.publish
+        """
+        self.shm: SharedMemory = SharedMemory(name=handle.name)
+        self.columns: List[str] = handle.columns
+        self.length: int = handle.length
+
+        self.dates: np.ndarray = np.ndarray((handle.length,), dtype=np.int64, buffer=self.shm.buf)
+        self.values: np.ndarray = np.ndarray((len(handle.columns), handle.length), dtype=np.float64,
+                                             buffer=self.shm.buf, offset=handle.length * 8)
+        self.dates.flags.writeable = False
+        self.values.flags.writeable = False
+
+    def get_range(self, start: pd.Timestamp, end: pd.Timestamp) -> DataFrame:
+        """
+        Return the rows with start <= date <= end.
+        :param start: first date
+        :param end: last date
+        :return: dataframe
+        """
+        first = np.searchsorted(self.dates, pd.Timestamp(start).value, side="left")
+        last = np.searchsorted(self.dates, pd.Timestamp(end).value, side="right")
+        return self.get_slice(first, last)
+
+    def get_slice(self, first: int, last: int) -> DataFrame:
+        """
+        Build a dataframe for the rows first to last (exclusive).
+        The numeric columns are zero-copy views of the shared memory, only the date column is converted.
+        New columns can be added to the dataframe, but the existing values can't be changed.
+        :param first: first row
+        :param last: last row, exclusive
+        :return: dataframe with RangeIndex
+        """
+        df = DataFrame(self.values[:, first:last].T, columns=self.columns, copy=False)
+        df.insert(0, "date", pd.to_datetime(self.dates[first:last], utc=True))
+        return df
+
+    def close(self) -> None:
+        """
+        Detach from the shared memory block. Dataframes returned by get_slice must not be used afterwards.
+        """
+        self.dates = None
+        self.values = None
+        self.shm.close()
@@ -1,107 +1,56 @@
+import bisect
 import numpy as np
 import logging
 import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from kektrade.indicators.streaming import RollingMedian
 
 class VolumeBarAggregator():
     @staticmethod
     def convert(df, rolling_median_window, target_timeframe, keep_unfinished_canldes=False):
         """
         Convert OHCL data from time bars to volume bars.
+        A bar is closed before the first candle where the volume of the bar is above the rolling median volume of the
+        previous candles times target_timeframe. Candles without a threshold are skipped. The last bar is unfinished
+        and only kept with keep_unfinished_canldes.
         """
-        first_run = True
-
-        date = None
-        open = 0.0
-        high = 0.0
-        low = 0.0
-        close = 0.0
-        cum_volume = 0.0
-        funding_rate = 0.0
-        candle_count = 0
-
-        arr_date = []
-        arr_open = []
-        arr_high = []
-        arr_low = []
-        arr_close = []
-        arr_volume = []
-        arr_candle_count = []
-        arr_funding_rate = []
-
         df = df.reset_index(drop=True)
         df["rolling_median_volume"] = df.volume.rolling(rolling_median_window).median().shift(1) * target_timeframe
 
-        tmp = df[['date', 'open', 'high', 'low', 'close', 'volume', 'funding_rate', 'rolling_median_volume']].copy()
-        loc_date = tmp.columns.get_loc("date")
-        loc_open = tmp.columns.get_loc("open")
-        loc_high = tmp.columns.get_loc("high")
-        loc_low = tmp.columns.get_loc("low")
-        loc_close = tmp.columns.get_loc("close")
-        loc_volume = tmp.columns.get_loc("volume")
-        loc_funding_rate = tmp.columns.get_loc("funding_rate")
-        loc_rolling_median_volume = tmp.columns.get_loc("rolling_median_volume")
-        numpy_df = tmp.to_numpy()
-
-        l = len(numpy_df)
-        for i in range(l):
-            threshold = numpy_df[i, loc_rolling_median_volume]
-            if np.nan_to_num(threshold) > 0:
-                if first_run:
-                    append = True
-                else:
-                    append = cum_volume > threshold
-
-                if append:
-                    first_run = False
-
-                    # Append if above Threshold
-                    if date is not None:
-                        arr_date.append(date)
-                        arr_open.append(open)
-                        arr_high.append(high)
-                        arr_low.append(low)
-                        arr_close.append(close)
-                        arr_volume.append(cum_volume)
-                        arr_candle_count.append(candle_count)
-                        arr_funding_rate.append(funding_rate)
-
-                    date = numpy_df[i, loc_date]
-                    open = numpy_df[i, loc_open]
-                    high = numpy_df[i, loc_high]
-                    low = numpy_df[i, loc_low]
-                    close = numpy_df[i, loc_close]
-                    cum_volume = numpy_df[i, loc_volume]
-                    funding_rate = numpy_df[i, loc_funding_rate]
-                    candle_count = 1
-                else:
-                    date = numpy_df[i, loc_date]
-                    high = max(high, numpy_df[i, loc_high])
-                    low = min(low, numpy_df[i, loc_low])
-                    close = numpy_df[i, loc_close]
-                    cum_volume += numpy_df[i, loc_volume]
-                    funding_rate += numpy_df[i, loc_funding_rate]
-                    candle_count += 1
-
-        if keep_unfinished_canldes:
-            arr_date.append(date)
-            arr_open.append(open)
-            arr_high.append(high)
-            arr_low.append(low)
-            arr_close.append(close)
-            arr_volume.append(cum_volume)
-            arr_candle_count.append(candle_count)
-            arr_funding_rate.append(funding_rate)
+        threshold = df["rolling_median_volume"].to_numpy(dtype=np.float64)
+        rows = np.flatnonzero(np.nan_to_num(threshold) > 0)
+        volume = df["volume"].to_numpy(dtype=np.float64)[rows]
+
+        starts = _find_bar_starts(volume, threshold[rows])
+        ends = np.append(starts[1:], len(rows)).astype(np.int64)
+        if not keep_unfinished_canldes:
+            starts = starts[:-1]
+            ends = ends[:-1]
+
+        if len(rows) == 0:
+            bars = {col: [] for col in ["date", "open", "high", "low", "close", "volume", "funding_rate", "candle_count"]}
+            if keep_unfinished_canldes:
+                bars = {"date": [None], "open": [0.0], "high": [0.0], "low": [0.0], "close": [0.0], "volume": [0.0],
+                        "funding_rate": [0.0], "candle_count": [0]}
+            return pd.DataFrame(bars)
 
+        first = rows[starts]
+        last = rows[ends - 1]
+        date = df["date"].iloc[last].reset_index(drop=True)
+        if is_numeric_dtype(date.dtype):
+            # Numeric dates share the float type of the other columns like in a numpy array of the whole frame
+            date = date.astype(np.result_type(date.dtype, np.float64))
         vol_bars = pd.DataFrame(
             {
-                "date": arr_date,
-                "open": arr_open,
-                "high": arr_high,
-                "low": arr_low,
-                "close": arr_close,
-                "volume": arr_volume,
-                "funding_rate": arr_funding_rate,
-                "candle_count": arr_candle_count
+                "date": date,
+                "open": df["open"].to_numpy(dtype=np.float64)[first],
+                "high": _reduce_bars(np.maximum, df["high"].to_numpy(dtype=np.float64)[rows], starts, ends),
+                "low": _reduce_bars(np.minimum, df["low"].to_numpy(dtype=np.float64)[rows], starts, ends),
+                "close": df["close"].to_numpy(dtype=np.float64)[last],
+                "volume": _sum_bars(volume, starts, ends),
+                "funding_rate": _sum_bars(df["funding_rate"].to_numpy(dtype=np.float64)[rows], starts, ends),
+                "candle_count": ends - starts
             }
         )
 
@@ -110,43 +59,293 @@ class VolumeBarAggregator():
 
 
     def reapply_to_df(self, volume_df, orig_df, columns, prefix=""):
-        import sqlite3
-        db = sqlite3.connect(":memory:")
+        """
+        Copy columns of volume bars back to the time bars they were built from. Every candle of orig_df gets the
+        values of the bar with lab_start_index <= index <= lab_end_index, candles outside of all bars get nan.
+        The bar of every candle is found with a binary search over the bar starts, the columns are added to orig_df
+        in place.
+        :param volume_df: volume bars with the columns lab_start_index and lab_end_index
+        :param orig_df: time bars
+        :param columns: columns of volume_df to copy
+        :param prefix: optional prefix of the new columns
+        :return: orig_df with the new columns
+        """
+        starts = volume_df["lab_start_index"].to_numpy(dtype=np.int64)
+        ends = volume_df["lab_end_index"].to_numpy(dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = ends[order]
 
-        orig_df["idx"] = orig_df.index
-        volume_df.to_sql("volume_df", db, if_exists="append")
-        orig_df.to_sql("orig_df", db, if_exists="append")
+        if len(starts) == 0:
+            for col in columns:
+                orig_df[col if prefix == "" else f'{prefix}_{col}'] = np.nan
+            return orig_df
 
-        # Add an index on the 'street' column:
-        db.execute("CREATE INDEX orig_df_idx ON orig_df(idx)")
-        db.execute("CREATE INDEX lab_start_index_idx ON volume_df(lab_start_index)")
-        db.execute("CREATE INDEX lab_end_index_idx ON volume_df(lab_end_index)")
+        # Last bar that starts before or on the candle, it contains the candle if it doesn't end before
+        idx = orig_df.index.to_numpy(dtype=np.int64)
+        bar = np.searchsorted(starts, idx, side="right") - 1
+        covered = bar >= 0
+        bar = np.maximum(bar, 0)
+        covered &= idx <= ends[bar]
+        positions = order[bar]
 
-        qry = "select o.date, o.open, o.high, o.low, o.close, o.volume"
         for col in columns:
-            qry = qry + ", v." + col
-            if prefix != "":
-                qry = qry + f' as "{prefix}_{col}"'
+            name = col if prefix == "" else f'{prefix}_{col}'
+            values = volume_df[col].iloc[positions].where(covered)
+            values.index = orig_df.index
+            orig_df[name] = values
 
+        return orig_df
 
-        qry = qry + " from orig_df o"
-        qry = qry + " join volume_df v on o.idx >= v.lab_start_index and o.idx <= v.lab_end_index"
 
-        new_df = pd.read_sql_query(qry, db)
-        db.close()
+class VolumeBarBuilder():
+    """
+    Build volume bars incrementally for live mode. The builder keeps the open bar and the volumes of the rolling
+    median window, so new candles are added without converting the whole history again. The bars are the same as
+    the ones of VolumeBarAggregator.convert over all candles the builder has seen.
+    The state can be saved with get_state and restored with set_state to continue after a restart.
+    """
 
-        # Leere Zeilen am Anfang einfügen damit man Spalten in Originales DF übernhemn kann
-        l = len(orig_df.index) - len(new_df.index)
-        df1 = pd.DataFrame([[np.nan] * len(new_df.columns)] * l, columns=new_df.columns)
-        new_df = df1.append(new_df, ignore_index=True)
+    COLUMNS = ["date", "open", "high", "low", "close", "volume", "funding_rate", "candle_count"]
 
-        for col in columns:
-            if prefix != "":
-                col = f'{prefix}_{col}'
-            orig_df[col] = new_df[col]
+    def __init__(self, rolling_median_window, target_timeframe):
+        self.rolling_median_window = rolling_median_window
+        self.target_timeframe = target_timeframe
 
-        del df1
-        del new_df
+        self.median = RollingMedian(timeperiod=rolling_median_window)
+        self.bar = None
+        self.last_date = None
 
-        return orig_df
+    def initialize(self, df):
+        """
+        Convert the history at once and keep the unfinished bar and the rolling median window.
+        :param df: time candles
+        :return: finished volume bars
+        """
+        df = df.reset_index(drop=True)
+        bars = VolumeBarAggregator.convert(df, self.rolling_median_window, self.target_timeframe,
+                                           keep_unfinished_canldes=True)
+
+        self.median.initialize(df["volume"].to_numpy(dtype=np.float64))
+        # Without a candle with a threshold the unfinished bar is empty and has no date
+        self.bar = None if bars["date"].iloc[-1] is None else bars.iloc[-1].to_dict()
+        self.last_date = df["date"].iloc[-1] if len(df.index) > 0 else None
+        return bars.iloc[:-1].reset_index(drop=True)
+
+    def update(self, df):
+        """
+        Add the candles that are newer than the last candle of the builder.
+        :param df: time candles, may contain candles the builder has already seen
+        :return: volume bars finished by the new candles
+        """
+        if self.last_date is not None:
+            df = df[df["date"] > self.last_date]
+
+        bars = []
+        for row in df[["date", "open", "high", "low", "close", "volume", "funding_rate"]].itertuples(index=False):
+            bar = self._add_candle(row)
+            if bar is not None:
+                bars.append(bar)
+            self.last_date = row.date
+
+        return pd.DataFrame(bars, columns=self.COLUMNS)
+
+    def _add_candle(self, row):
+        """
+        Add a single candle like the loop of the original conversion.
+        :param row: candle
+        :return: finished bar or None
+        """
+        threshold = self.median.value * self.target_timeframe
+        self.median.update(row.volume)
+
+        if not np.nan_to_num(threshold) > 0:
+            return None
+
+        bar = self.bar
+        if bar is None or bar["volume"] > threshold:
+            self.bar = {"date": row.date, "open": row.open, "high": row.high, "low": row.low, "close": row.close,
+                        "volume": row.volume, "funding_rate": row.funding_rate, "candle_count": 1}
+            return bar
+
+        bar["date"] = row.date
+        bar["high"] = max(bar["high"], row.high)
+        bar["low"] = min(bar["low"], row.low)
+        bar["close"] = row.close
+        bar["volume"] += row.volume
+        bar["funding_rate"] += row.funding_rate
+        bar["candle_count"] += 1
+        return None
+
+    def get_state(self):
+        """
+        :return: state of the builder with plain python types, it can be written as json
+        """
+        bar = None
+        if self.bar is not None:
+            bar = {key: _to_plain(value) for key, value in self.bar.items()}
+        return {
+            "rolling_median_window": self.rolling_median_window,
+            "target_timeframe": self.target_timeframe,
+            "median": self.median.get_state(),
+            "bar": bar,
+            "last_date": _to_plain(self.last_date)
+        }
+
+    def set_state(self, state):
+        """
+        Restore a state from get_state of a builder with the same parameters.
+        :param state: state
+        """
+        self.median.set_state(state["median"])
+        self.bar = state["bar"]
+        if self.bar is not None:
+            self.bar["date"] = _from_plain(self.bar["date"])
+        self.last_date = _from_plain(state["last_date"])
+
+
+def _to_plain(value):
+    """
+    Convert dates and numpy scalars for json.
+    """
+    if isinstance(value, pd.Timestamp):
+        return {"timestamp": value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _from_plain(value):
+    """
+    Convert the dates of _to_plain back.
+    """
+    if isinstance(value, dict):
+        return pd.Timestamp(value["timestamp"])
+    return value
+
+
+def _find_bar_starts(volume, threshold):
+    """
+    Find the first candle of every volume bar. A bar that starts on candle s ends before the first candle i > s where
+    the volume of the candles s..i-1 is above the threshold of i.
+    With the cumulative volume, the condition is cumulative_volume[i] - threshold[i] > cumulative_volume[s]. The
+    running maximum of the left side stays below cumulative_volume[s] up to s, so a binary search on it estimates the
+    end of every bar. The estimated bars are then checked at once with the volume summed up from the start of every
+    bar like the original loop, only bars where rounding of the cumulative volume moved the boundary are searched again.
+    :param volume: volume of the candles with a threshold
+    :param threshold: threshold of the candles
+    :return: positions of the first candles of the bars
+    """
+    length = len(volume)
+    if length == 0:
+        return np.empty(0, dtype=np.int64)
+
+    cumulative_volume = np.concatenate([[0], np.cumsum(volume)])
+    reach = np.maximum.accumulate(cumulative_volume[:-1] - threshold).tolist()
+    cumulative_volume = cumulative_volume.tolist()
+
+    def estimate(start):
+        starts = []
+        while start < length:
+            starts.append(start)
+            start = max(bisect.bisect_right(reach, cumulative_volume[start]), start + 1)
+        return starts
+
+    starts = estimate(0)
+    first = 0
+    while first < len(starts):
+        # Bars before first are already checked
+        begin = starts[first]
+        bar_starts = np.array(starts[first:], dtype=np.int64) - begin
+        bar_ends = np.append(bar_starts[1:], length - begin)
+        bar_volume = _running_sums(volume[begin:], bar_starts, bar_ends)
+
+        # A candle starts a bar exactly when the volume of the bar before it is above its threshold
+        closed = bar_volume[:-1] > threshold[begin + 1:]
+        is_start = np.zeros(length - begin, dtype=bool)
+        is_start[bar_starts] = True
+        wrong = np.flatnonzero(closed != is_start[1:])
+        if len(wrong) == 0:
+            break
+
+        bar = first + int(np.searchsorted(bar_starts, wrong[0], side="right")) - 1
+        starts = starts[:bar + 1] + estimate(_find_bar_end(volume, threshold, starts[bar]))
+        first = bar + 1
+
+    return np.array(starts, dtype=np.int64)
+
+
+def _find_bar_end(volume, threshold, start):
+    """
+    Search the end of a single bar with the volume summed up from its start.
+    :param volume: volume of the candles with a threshold
+    :param threshold: threshold of the candles
+    :param start: first candle of the bar
+    :return: first candle of the next bar, the number of candles if the bar is unfinished
+    """
+    length = len(volume)
+    window = 16
+    while True:
+        end = min(start + window + 1, length)
+        bar_volume = np.cumsum(volume[start:end])
+        closed = bar_volume[:-1] > threshold[start + 1:end]
+        if closed.any():
+            return start + 1 + int(np.argmax(closed))
+        if end == length:
+            return length
+        window *= 2
+
+
+def _reduce_bars(ufunc, values, starts, ends):
+    """
+    Reduce the values of every bar, e.g. with np.maximum for the high.
+    :param ufunc: numpy ufunc
+    :param values: values of the candles
+    :param starts: first candle of every bar
+    :param ends: position after the last candle of every bar
+    :return: value of every bar
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.float64)
+    # reduceat reduces up to the next index, the unfinished candles after the last bar are left out
+    return ufunc.reduceat(values[:ends[-1]], starts)
+
+
+def _sum_bars(values, starts, ends):
+    """
+    Sum the values of every bar in the order of the candles, so the sums are the same as adding them one after
+    another. np.add.reduceat may add in a different order.
+    :param values: values of the candles
+    :param starts: first candle of every bar
+    :param ends: position after the last candle of every bar
+    :return: sum of every bar
+    """
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.float64)
+    return _running_sums(values, starts, ends)[ends - 1]
+
+
+def _running_sums(values, starts, ends):
+    """
+    Sum of the values from the start of the bar up to every candle, added one after another. All bars are summed
+    together, one candle position at a time, the longest bars first.
+    :param values: values of the candles
+    :param starts: first candle of every bar
+    :param ends: position after the last candle of every bar
+    :return: running sum on every candle of the bars
+    """
+    result = np.full(len(values), np.nan)
+    if len(starts) == 0:
+        return result
+
+    lengths = ends - starts
+    order = np.argsort(-lengths, kind="stable")
+    sorted_starts = starts[order]
+    descending_lengths = -lengths[order]
 
+    result[sorted_starts] = values[sorted_starts]
+    for offset in range(1, int(lengths.max())):
+        count = int(np.searchsorted(descending_lengths, -offset, side="left"))
+        positions = sorted_starts[:count] + offset
+        result[positions] = result[positions - 1] + values[positions]
+    return result
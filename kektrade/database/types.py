@@ -88,11 +88,12 @@ def get_engine(path: Path):
     """
     Create a sqlalchemy engine with the sql database of the path.
     Create the database if it does not exist.
+    Optimization workers write to the same database in parallel, so wait for the lock instead of failing.
     :param path: path to db
     :return: sql alchemy engine object
     """
     MY_SQL_URL = 'sqlite:///' + str(path)
-    engine = create_engine(MY_SQL_URL)
+    engine = create_engine(MY_SQL_URL, connect_args={"timeout": 60})
     logging.getLogger('sqlalchemy').setLevel(logging.CRITICAL)
     return engine
 
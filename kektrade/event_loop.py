@@ -1,18 +1,22 @@
 import datetime
 import time
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Union, Tuple
 import logging
 import os
 from pathlib import Path
 import copy
 import pytz
 
+import numpy as np
+import pandas as pd
 from pandas import DataFrame
 import tqdm
 from sqlalchemy.exc import OperationalError
 
 from kektrade.data.dataprovider import DatetimePeriod
+from kektrade.data.barview import BarView
 from kektrade.exchange import Backtest
+from kektrade.exchange.history_sink import HistorySinkType
 from kektrade.database.types import Subaccount, Pair, get_engine
 from kektrade.database.types import get_session
 from kektrade.plotting import PlotterSubaccount
@@ -53,6 +57,16 @@ class EventLoop():
         self.optimized_parameter: Dict[str, Any] = {}
         self.recalculate_inidcators: bool = True
 
+        # Columns of the dataframe for strategies with use_bar_view, created again after the indicators are calculated
+        self.bar_view: Union[None, BarView] = None
+
+        # Dataframe with indicators of the last tick in live mode, for strategies with update_indicators
+        self.indicator_df: Union[None, DataFrame] = None
+
+        # Candles on which the strategy could act, None if the strategy doesn't provide them
+        self.candidate_positions: Union[None, np.ndarray] = None
+        self.candidate_parameter: Union[None, Dict[str, Any]] = None
+
     def start(self) -> int:
         """
         This is the main loop. At first the necassary candles are loaded.
@@ -93,7 +107,7 @@ class EventLoop():
             self.subaccount.exchange.df_position = index
 
             self._optimize_start()
-            parameter = self.subaccount.subaccount_config["parameters"]
+            parameter = dict(self.subaccount.subaccount_config["parameters"])
             parameter.update(self._optimize_get_parameter())
             parameters_indicators = self._optimize_get_parameters_indicators()
             subaccount.exchange.before_tick(index)
@@ -101,9 +115,10 @@ class EventLoop():
             if parameter or not self._optimization_enabled():
                 df = self._get_main_df()
                 df = self._populate_indicators(subaccount, df, metadata, parameters_indicators)
+                self._populate_candidate_bars(subaccount, df, metadata, parameter)
 
-                subaccount.strategy.tick(dataframe=df, index=index, metadata=metadata, parameter=parameter,
-                                         variables=variables, exchange=subaccount.exchange)
+                subaccount.strategy.tick(dataframe=self._get_tick_data(df), index=index, metadata=metadata,
+                                         parameter=parameter, variables=variables, exchange=subaccount.exchange)
             else:
                 subaccount.exchange.close_position()
 
@@ -111,6 +126,10 @@ class EventLoop():
             self.df_position += 1
             self._progress_step()
 
+            skipped = self._skip_candles()
+            if skipped > 0 and self.subaccount.is_backtest() and not self.subaccount.is_optimization():
+                pbar.update(skipped)
+
             if not self.subaccount.is_backtest():
                 if self.subaccount.config["plotting"]["enabled"]:
                     self._plot_subaccount()
@@ -122,6 +141,7 @@ class EventLoop():
         if self.subaccount.config["plotting"]["enabled"]:
             self._plot_subaccount()
         self._free_progress()
+        self._free_optimize()
 
         if not self.subaccount.is_optimization():
             logger.info(f"=== Finished event loop for subaccount {self.subaccount.subaccount_config['subaccount_id']} ===")
@@ -168,6 +188,9 @@ class EventLoop():
             logger.info("Aquire file lock")
             range = self.subaccount.get_required_datetimerange()
             self.subaccount.dataprovider.load_datasets_to_memory(range)
+            if self.subaccount.indicator_dataframe is not None:
+                self.subaccount.dataprovider.set_pair_dataframe(self.subaccount.dataprovider.main_pair,
+                                                                self.subaccount.indicator_dataframe)
             self._set_current_candle_timestamp()
             logger.info("Release file lock")
 
@@ -242,6 +265,9 @@ class EventLoop():
         """
         if self.subaccount.is_backtest() and self._get_index() == 0:
             self.subaccount.exchange.set_dataframe(self._get_main_df())
+        if self.subaccount.is_backtest():
+            if not self._history_enabled():
+                self.subaccount.exchange.history_sink_type = HistorySinkType.Null.value
         self.subaccount.exchange.subaccount_id = self.subaccount_id
         self.subaccount.exchange.initial_deposit = self.subaccount.subaccount_config["exchange_parameters"]["initial_deposit"]
         self.subaccount.exchange.init_exchange()
@@ -277,7 +303,9 @@ class EventLoop():
         """
         Populate the indicators.
         In backtest mode calculate the indicators only once since the dataframe is complete from the start.
-        In live mode calculate the indicators every time since there is a new candle at the end.
+        In live mode calculate the indicators every time since there is a new candle at the end. Strategies with
+        update_indicators only calculate the indicators of the new candles.
+        Optimization runs get the indicators precomputed by the optimizer and skip the calculation.
         :param subaccount: subaccount
         :param df: dataframe
         :param metadata: metadata
@@ -285,23 +313,173 @@ class EventLoop():
         :return: dataframe with indicators
         """
         if not self.subaccount.is_backtest():
+            updated = self._update_indicators(subaccount, df, metadata, parameters)
+            if updated is not None:
+                return updated
             self.recalculate_inidcators = True
 
         if self.recalculate_inidcators:
-            df = subaccount.strategy.populate_indicators(dataframe=df, metadata=metadata, parameters=parameters)
-            utils.create_missing_columns(self.subaccount.run_settings.db_path, "ticker", df)
-            df["pair_id"] = self.pair_id
+            self.bar_view = None
+            if self.subaccount.indicator_dataframe is None:
+                df = subaccount.strategy.populate_indicators(dataframe=df, metadata=metadata, parameters=parameters)
+            self._save_ticker(df)
+            self.recalculate_inidcators = False
+
+        return df
+
+    def _update_indicators(self, subaccount: SubaccountItem,
+                           df: DataFrame,
+                           metadata: Dict[str, Any],
+                           parameters: Dict[str, List[Any]]) -> Union[None, DataFrame]:
+        """
+        Live mode: append the new candles to the dataframe of the last tick and let the strategy calculate the
+        indicators only for them. Only the new candles are appended to the ticker table.
+        :param subaccount: subaccount
+        :param df: dataframe
+        :param metadata: metadata
+        :param parameters: parameters
+        :return: dataframe with indicators or None if the strategy doesn't implement update_indicators
+        """
+        start = 0
+        if not self.recalculate_inidcators and self.indicator_df is not None:
+            df, start = self._append_new_candles(self.indicator_df, df)
+
+        df = subaccount.strategy.update_indicators(dataframe=df, start=start, metadata=metadata, parameters=parameters)
+        if df is None:
+            return None
+
+        self.indicator_df = df
+        self.bar_view = None
+        self._save_ticker(df, start)
+        self.recalculate_inidcators = False
+        return df
+
+    def _append_new_candles(self, indicator_df: DataFrame, df: DataFrame) -> Tuple[DataFrame, int]:
+        """
+        Append the candles of the reloaded dataframe that are newer than the last candle with indicators. Candles
+        that are no longer part of the loaded range are removed from the start.
+        :param indicator_df: dataframe with indicators of the last tick
+        :param df: reloaded dataframe
+        :return: dataframe and position of the first new candle, 0 if the dataframes don't fit together
+        """
+        kept = indicator_df[indicator_df["date"] >= df["date"].iloc[0]]
+        new = df[df["date"] > indicator_df["date"].iloc[-1]]
+        if len(kept.index) + len(new.index) != len(df.index):
+            logger.warning("Reloaded candles don't continue the dataframe, calculate the indicators again")
+            return df, 0
 
-            con = get_engine(self.subaccount.run_settings.db_path)
+        return pd.concat([kept, new], ignore_index=True), len(kept.index)
+
+    def _save_ticker(self, df: DataFrame, start: int = 0) -> None:
+        """
+        Write the candles with indicators to the ticker table. With start 0 the candles of the pair are replaced,
+        otherwise the candles from start on are appended.
+        :param df: dataframe with indicators
+        :param start: position of the first candle to write
+        """
+        if not self._history_enabled():
+            return
+
+        utils.create_missing_columns(self.subaccount.run_settings.db_path, "ticker", df)
+        df["pair_id"] = self.pair_id
+
+        con = get_engine(self.subaccount.run_settings.db_path)
+        if start == 0:
             try:
                 con.execute(f"delete from ticker where pair_id = {self.pair_id}")
             except OperationalError:
                 pass
 
-            df.to_sql(name="ticker", con=con, if_exists='append')
-            self.recalculate_inidcators = False
+        df.iloc[start:].to_sql(name="ticker", con=con, if_exists='append')
 
-        return df
+    def _get_tick_data(self, df: DataFrame) -> Union[DataFrame, BarView]:
+        """
+        Get the data the tick function of the strategy is called with. Strategies with use_bar_view get a bar view of
+        the dataframe, which is created once after the indicators are calculated.
+        :param df: dataframe with indicators
+        :return: dataframe or bar view
+        """
+        if not self.subaccount.strategy.use_bar_view:
+            return df
+        if self.bar_view is None:
+            self.bar_view = BarView(df)
+        return self.bar_view
+
+    def _populate_candidate_bars(self, subaccount: SubaccountItem,
+                                 df: DataFrame,
+                                 metadata: Dict[str, Any],
+                                 parameter: Dict[str, Any]) -> None:
+        """
+        Get the candles on which the strategy could act. Only in backtest mode and again when the parameters change.
+        :param subaccount: subaccount
+        :param df: dataframe with indicators
+        :param metadata: metadata
+        :param parameter: parameters of the tick call
+        """
+        if not self.subaccount.is_backtest():
+            return
+        if self.candidate_parameter is not None and parameter == self.candidate_parameter:
+            return
+
+        mask = subaccount.strategy.populate_candidate_bars(dataframe=df, metadata=metadata, parameter=parameter)
+        self.candidate_parameter = dict(parameter)
+        if mask is None:
+            self.candidate_positions = None
+        else:
+            self.candidate_positions = np.flatnonzero(np.asarray(mask, dtype=bool))
+
+    def _skip_candles(self) -> int:
+        """
+        Jump to the next candle on which the strategy could act, the exchange could execute orders, liquidate or pay
+        funding, or an optimization could start. The exchange calculates the snapshots of the skipped candles.
+        :return: number of skipped candles
+        """
+        if not self.subaccount.is_backtest() or self.candidate_positions is None:
+            return 0
+
+        start = self.df_position
+        length = self._get_df_length()
+        if start >= length:
+            return 0
+
+        target = length
+        candidate = int(np.searchsorted(self.candidate_positions, start))
+        if candidate < len(self.candidate_positions):
+            target = int(self.candidate_positions[candidate])
+
+        # after_tick of the candle before an event processes the event
+        target = min(target, self.subaccount.exchange.get_next_event(start + 1) - 1)
+
+        if self._optimization_enabled() and not self.subaccount.is_optimization():
+            target = min(target, self._get_next_optimization())
+
+        if target <= start:
+            return 0
+
+        self.subaccount.exchange.skip_to(target)
+        self.df_position = target
+        return target - start
+
+    def _get_next_optimization(self) -> int:
+        """
+        Get the candle where _optimization_necassary starts the next optimization, the first candle at or after the
+        end of the current test period. The optimization starts before the tick of that candle, so it must not be
+        skipped.
+        :return: position of the candle or the length of the dataframe
+        """
+        dates = self._get_main_df()["date"]
+        position = int(dates.searchsorted(pd.Timestamp(self.optimizer.test_period.end), side="left"))
+        # The first optimization can't start before the third candle
+        return max(position, 2)
+
+    def _history_enabled(self) -> bool:
+        """
+        Check if the ticker and exchange history are written to the database.
+        Optimization runs only need them if the optimization is plotted, otherwise their results are returned
+        in memory.
+        :return: true if the history is written
+        """
+        return not self.subaccount.is_optimization() or self.subaccount.config["optimization"]["plot_optimization"]
 
     def _plot_subaccount(self):
         """
@@ -341,6 +519,13 @@ class EventLoop():
         if not self.subaccount.is_optimization():
             self.optimizer = Optimizer(self.subaccount)
 
+    def _free_optimize(self):
+        """
+        Stop the worker pool of the optimizer.
+        """
+        if not self.subaccount.is_optimization():
+            self.optimizer.close()
+
     def _optimize_start(self):
         """
         Start the optimization process.
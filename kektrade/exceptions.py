@@ -36,4 +36,9 @@ class UnknownExchangeParameter(Exception):
 class ExchangeException(Exception):
     """
     Exception occuring inside exchange class.
-    """
\ No newline at end of file
+    """
+
+class UnsupportedHistorySink(Exception):
+    """
+    Unknown history sink type for backtest exchange.
+    """
@@ -8,4 +8,6 @@ from kektrade.exchange.binance_spot import BinanceSpot
 from kektrade.exchange.backtest import Backtest
 from kektrade.exchange.interface import IExchange
 from kektrade.exchange.resolver import ExchangeResolver
-from kektrade.exchange.backtest_futures import BacktestFutures
\ No newline at end of file
+from kektrade.exchange.backtest_futures import BacktestFutures
+from kektrade.exchange.vectorized import StrategySignals, VectorizedBacktest, load_vectorized_backtest
+from kektrade.exchange.batch import BatchBacktest
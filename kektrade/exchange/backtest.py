@@ -3,6 +3,7 @@ import logging
 from datetime import datetime
 
 from kektrade.exchange.interface import IExchange
+from kektrade.exceptions import ExchangeException
 
 logger = logging.getLogger(__name__)
 
@@ -28,5 +29,36 @@ class Backtest(IExchange):
 
         self.contract_multiplier: int = 100
 
+        # Position of the current candle in the dataframe
+        self.df_position: int = 0
+
+        # Compare the running margin totals of the backtest exchange with a full recalculation on every use
+        self.debug_aggregates: bool = False
+
+        # Destination of orders, executions and the wallet and position of every candle, see HistorySinkType
+        self.history_sink_type: str = "sqlite"
+        # Record the position and open orders every candle or only when they change, see HistoryMode
+        self.history_mode: str = "snapshot"
+
     def is_backtest(self):
         return True
+
+    def get_next_event(self, start: int) -> int:
+        """
+        Get the first candle from start on in which the exchange could change the position, the orders or the
+        balance, given the current state. The candles before it can be skipped with skip_to.
+        Exchanges that can't tell return start, so nothing is skipped.
+        :param start: first candle to check
+        :return: position of the candle
+        """
+        return start
+
+    def skip_to(self, position: int) -> None:
+        """
+        Advance to a candle without processing the candles in between. Only valid up to the candle returned by
+        get_next_event.
+        Exchanges that don't implement get_next_event can't skip candles and only accept the current position.
+        :param position: new position in the dataframe
+        """
+        if position != self.df_position:
+            raise ExchangeException(f"{self.__class__.__name__} can't skip to candle {position}")
@@ -1,7 +1,6 @@
 import copy
 import logging
-from functools import cmp_to_key
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Tuple
 import datetime
 import os
 import numpy as np
@@ -19,6 +18,10 @@ from kektrade.exchange.backtest import Backtest
 from kektrade.exceptions import *
 from kektrade import utils
 from kektrade.exchange.history_meta import Versioned, versioned_session
+from kektrade.exchange.history_sink import IHistorySink, HistorySinkResolver
+from kektrade.exchange.backtest_types import *
+from kektrade.exchange.orderbook import OrderBook
+from kektrade.exchange.event_index import CandleEventIndex
 
 logger = logging.getLogger(__name__)
 
@@ -28,26 +31,93 @@ class BacktestFutures(Backtest):
         super().__init__()
 
         self.df: DataFrame = pd.DataFrame()
-        self.df_position: int = 0
+        self.df_length: int = 0
+
+        # Columns of the dataframe as numpy arrays, the simulation doesn't index the dataframe itself
+        self.open_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.high_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.low_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.close_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.funding_rate_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.date_values: np.ndarray = np.empty(0, dtype=np.int64)
+        self.timestamp_values: np.ndarray = np.empty(0, dtype=np.int64)
+        self.date_epoch: datetime.datetime = datetime.datetime(1970, 1, 1)
+        self.date_cache_position: int = -1
+        self.date_cache: Union[None, datetime.datetime] = None
+
+        # Created on the first search for the next event, see get_next_event
+        self.event_index: Union[None, CandleEventIndex] = None
+        self.funding_positions: Union[None, np.ndarray] = None
 
         self.finished: bool = False
 
-        self.orders_open: List[Order] = []
-        self.orders_canceled: List[Order] = []
-        self.orders_closed: List[Order] = []
-        self.orders_expired: List[Order] = []
+        self.order_book: OrderBook = OrderBook()
+        self.orders_canceled: List[SimOrder] = []
+        self.orders_closed: List[SimOrder] = []
+        self.orders_expired: List[SimOrder] = []
 
-        self.executions: List[Execution] = []
+        self.executions: List[SimExecution] = []
         #self.positions: List[Position] = []
-        self.position: Position = Position()
-        self.wallet: Wallet = Wallet()
+        self.position: SimPosition = SimPosition()
+        self.wallet: SimWallet = SimWallet()
 
         self.order_cnt: int = 0
-        self.session: SessionClass = None
+        self.history_sink: IHistorySink = None
+
+        # Take profit and stop loss of open orders by order id, and the other orders of each one-cancels-other group
+        self.order_brackets: Dict[int, OrderBracket] = {}
+        self.oco_siblings: Dict[int, List[int]] = {}
+
+        # Running total of the initial margin of the open orders with a price. The margin of orders without a price
+        # depends on the close price and is calculated when needed.
+        self.order_margins: Dict[int, float] = {}
+        self.order_margin_total: float = 0
+        self.orders_without_price: Dict[int, SimOrder] = {}
+
+        # Position margin and upnl only change with the candle or the position
+        self.position_version: int = 0
+        self.position_cache_key: Tuple[int, int] = (-1, -1)
+        self.position_margin_cache: float = 0
+        self.upnl_cache: float = np.nan
+
+        # Position contracts for which the reduce only orders in the book were last checked, nan forces a check
+        self.reduce_only_checked_contracts: float = np.nan
+        self.reduce_only_checked_order_id: int = 0
+
+        self.equity_peak: float = 0
+        self.max_drawdown: float = 0
+        self.trade_count: int = 0
 
 
     def set_dataframe(self, dataframe: DataFrame) -> None:
+        """
+        Set the dataframe and extract the candle columns as numpy arrays.
+        The event loop sets the dataframe every tick, so nothing is done if it is the same object with the same length.
+        :param dataframe: dataframe
+        """
+        if dataframe is self.df and len(dataframe.index) == self.df_length:
+            return
+
         self.df = dataframe
+        self.df_length = len(dataframe.index)
+
+        self.open_values = dataframe["open"].to_numpy(dtype=np.float64)
+        self.high_values = dataframe["high"].to_numpy(dtype=np.float64)
+        self.low_values = dataframe["low"].to_numpy(dtype=np.float64)
+        self.close_values = dataframe["close"].to_numpy(dtype=np.float64)
+        if "funding_rate" in dataframe.columns:
+            self.funding_rate_values = dataframe["funding_rate"].to_numpy(dtype=np.float64)
+        else:
+            self.funding_rate_values = np.full(self.df_length, np.nan)
+
+        dates = dataframe["date"]
+        self.date_values = dates.values.astype("datetime64[ns]").view(np.int64)
+        self.timestamp_values = self.date_values // 1000000000
+        self.date_epoch = datetime.datetime(1970, 1, 1, tzinfo=dates.dt.tz)
+        self.date_cache_position = -1
+
+        self.event_index = None
+        self.funding_positions = None
 
     def set_df_position(self, position: int) -> None:
         self.df_position = position
@@ -63,10 +133,12 @@ class BacktestFutures(Backtest):
         self.position.subaccount_id = self.subaccount_id
         self.position.price = 0
         self.position.contracts = 0
+        self._invalidate_position_cache()
 
         self.set_leverage(1)
 
-        self.session = get_session(self.run_settings.db_path)
+        self.history_sink = HistorySinkResolver.load_history_sink(self.history_sink_type, self.history_mode,
+                                                                  self.run_settings, self.subaccount_id)
 
     def before_tick(self, i: int) -> None:
         pass
@@ -77,7 +149,7 @@ class BacktestFutures(Backtest):
 
         self.df_position += 1
 
-        if self.df_position >= len(self.df.index) - 1:
+        if self.df_position >= self.df_length - 1:
             self.finished = True
         else:
             self._check_funding()
@@ -86,54 +158,131 @@ class BacktestFutures(Backtest):
 
             self._update_position()
             self._update_wallet()
+            self._update_drawdown()
 
             self._copy_objects_for_history()
 
+    def get_next_event(self, start: int) -> int:
+        """
+        Get the first candle from start on in which an order could be executed or canceled, the position could be
+        liquidated or funding is paid. Nothing is skipped while market orders or cancellations are pending, reduce only
+        orders have to be checked against a changed position, or the balance check could cancel an order.
+        :param start: first candle to check
+        :return: position of the candle, the length of the dataframe if there is none
+        """
+        if self.finished or start >= self.df_length:
+            return start
+
+        book = self.order_book
+        if len(book.market_orders) > 0 or len(book.canceled_orders) > 0:
+            return start
+
+        for order in book.reduce_only_orders.values():
+            if order.order_id > self.reduce_only_checked_order_id or \
+                    self.position.contracts != self.reduce_only_checked_contracts:
+                return start
+
+        if not self.unlimited_funds:
+            # The available balance only changes without a position
+            for order in book.orders.values():
+                if not self._is_order_reducing(order):
+                    if self._position_open() or self._get_available_balance() < 0:
+                        return start
+                    break
+
+        if self.event_index is None:
+            self.event_index = CandleEventIndex(self.low_values, self.high_values)
+            self.funding_positions = np.flatnonzero(np.nan_to_num(self.funding_rate_values, nan=0) != 0)
+        index = self.event_index
+
+        event = self.df_length
+        if self._position_open():
+            funding = int(np.searchsorted(self.funding_positions, start))
+            if funding < len(self.funding_positions):
+                event = min(event, int(self.funding_positions[funding]))
+
+            if self.position.contracts > 0:
+                event = min(event, index.first_low_below(start, self._get_liquidation_price()))
+            else:
+                event = min(event, index.first_high_above(start, self._get_liquidation_price()))
+
+        limit_prices = [ladder[i][0] for ladder in (book.bids, book.asks) if len(ladder) > 0 for i in (0, -1)]
+        if len(limit_prices) > 0:
+            # A limit order needs the low below and the high above its price in the same candle
+            event = min(event, max(index.first_low_below(start, max(limit_prices)),
+                                   index.first_high_above(start, min(limit_prices))))
+        if len(book.buy_stops) > 0:
+            event = min(event, index.first_high_above(start, book.buy_stops[0][0], inclusive=True))
+        if len(book.sell_stops) > 0:
+            event = min(event, index.first_low_below(start, book.sell_stops[-1][0], inclusive=True))
+        return event
+
+    def skip_to(self, position: int) -> None:
+        """
+        Advance to a candle without processing the candles in between. Their snapshots are calculated for all candles
+        at once, since only the price changes.
+        :param position: new position in the dataframe
+        """
+        last = min(position, self.df_length - 2)
+        positions = np.arange(self.df_position + 1, last + 1)
+        if len(positions) > 0:
+            self._add_skipped_snapshots(positions)
+            self.reduce_only_checked_contracts = self.position.contracts
+            self.reduce_only_checked_order_id = self.order_cnt
+
+        self.df_position = position
+        if self.df_position >= self.df_length - 1:
+            self.finished = True
+
     def finalize_exchange(self) -> None:
-        self.session.commit()
+        self.history_sink.finalize()
 
     def set_leverage(self, leverage: int) -> None:
         if self._position_open():
             logger.warning("can't change leverage while a position is open")
         else:
             self.position.leverage = leverage
+            self._invalidate_position_cache()
 
     def get_open(self) -> float:
-        return self.df.open.iloc[self.df_position]
+        return self.open_values[self.df_position]
 
     def get_close(self) -> float:
-        return self.df.close.iloc[self.df_position]
+        return self.close_values[self.df_position]
 
     def get_high(self) -> float:
-        return self.df.high.iloc[self.df_position]
+        return self.high_values[self.df_position]
 
     def get_low(self) -> float:
-        return self.df.low.iloc[self.df_position]
+        return self.low_values[self.df_position]
 
     def open_order(self, symbol: str, order_type: OrderType, contracts: float, price: float = 0, reduce_only: bool = False,
                    post_only: bool = False, take_profit: Union[None, float] = None,
                    stop_loss: Union[None, float] = None) -> Union[None, Order]:
+        order_type = to_code(order_type)
         if contracts == 0:
             raise ExchangeException("contracts must not be 0")
         elif self.hedge_mode == 1 and not ((contracts > 0 and not reduce_only) or (contracts < 0 and reduce_only)):
             raise ExchangeException("can't open short in long hedge mode")
         elif self.hedge_mode == -1 and not ((contracts < 0 and not reduce_only) or (contracts > 0 and reduce_only)):
             raise ExchangeException("can't open long in short hedge mode")
-        elif order_type in [OrderType.LIMIT, OrderType.STOP_MARKET] and price == 0:
+        elif order_type in [ORDER_TYPE_LIMIT, ORDER_TYPE_STOP_MARKET] and price == 0:
             raise ExchangeException("no price set")
+        elif (take_profit is not None and take_profit <= 0) or (stop_loss is not None and stop_loss <= 0):
+            raise ExchangeException("take profit and stop loss must be positive")
 
-        order = Order()
+        order = SimOrder()
         order.order_id = self._get_order_id()
         order.subaccount_id = self.subaccount_id
         order.client_order_id = ""
         order.datetime = self._get_date()
         order.timestamp = self._get_timestamp()
         order.last_trade_timestamp = None
-        order.status = OrderStatus.OPEN
+        order.status = ORDER_STATUS_OPEN
         order.symbol = symbol
         order.order_type = order_type
-        order.time_in_force = TimeInForce.GTC
-        order.side = Side.BUY if contracts > 0 else Side.SELL
+        order.time_in_force = TIME_IN_FORCE_GTC
+        order.side = SIDE_BUY if contracts > 0 else SIDE_SELL
         order.price = price
         order.contracts = contracts
         order.cost = self._get_order_initial_margin(order)
@@ -144,16 +293,16 @@ class BacktestFutures(Backtest):
         order.hedge_mode = self.hedge_mode
         order.insert_state = True
 
-        if (order.order_type in [OrderType.MARKET, OrderType.STOP_MARKET]) or \
-            (order.order_type == OrderType.LIMIT and ((order.contracts > 0 and order.price > self.get_close()) or
+        if (order.order_type in [ORDER_TYPE_MARKET, ORDER_TYPE_STOP_MARKET]) or \
+            (order.order_type == ORDER_TYPE_LIMIT and ((order.contracts > 0 and order.price > self.get_close()) or
                                                       (order.contracts < 0 and order.price < self.get_close()))):
-            order.taker_or_maker = TakerMakerType.TAKER
+            order.taker_or_maker = TAKER
             order.fee_rate = self.taker_fee
         else:
-            order.taker_or_maker = TakerMakerType.MAKER
+            order.taker_or_maker = MAKER
             order.fee_rate = self.maker_fee
 
-        self.session.add(order)
+        self.history_sink.add_order(order)
 
         if not self._check_order_post_only(order):
             logger.warning(f"order {order.order_id} is post-only and instantly canceled")
@@ -165,24 +314,27 @@ class BacktestFutures(Backtest):
             self.orders_canceled.append(order)
             return None
 
-        self.orders_open.append(order)
+        self._add_order_to_book(order)
+        if take_profit is not None or stop_loss is not None:
+            self.order_brackets[order.order_id] = OrderBracket(take_profit=take_profit, stop_loss=stop_loss)
         return order
 
     def cancel_order(self, id: str) -> Union[None, Order]:
-        for order in self.orders_open:
-            if order.order_id == id:
-                order.status = OrderStatus.CANCELED
-                return order
+        order = self.order_book.get(id)
+        if order is not None:
+            self.order_book.cancel(order)
+            return order
 
     def cancel_all_orders(self) -> None:
-        for order in self.orders_open:
-            order.status = OrderStatus.CANCELED
+        self.order_book.cancel_all()
 
     def set_order_price(self, id: str, price: float) -> Union[None, Order]:
-        for order in self.orders_open:
-            if order.order_id == id:
-                order.price = price
-                return order
+        order = self.order_book.get(id)
+        if order is not None:
+            self._remove_order_margin(order)
+            self.order_book.set_price(order, price)
+            self._add_order_margin(order)
+            return order
 
     def get_position(self) -> Union[None, Position]:
         return self.position
@@ -192,7 +344,7 @@ class BacktestFutures(Backtest):
 
     def get_contracts_percentage(self, percentage: float) -> float:
         price = self.get_close()
-        tmp = Order()
+        tmp = SimOrder()
         tmp.price = price
         tmp.contracts = 1
         price_one_contract = self._get_order_initial_margin(tmp)
@@ -202,7 +354,7 @@ class BacktestFutures(Backtest):
 
     def close_position(self):
         if self.get_position().contracts != 0:
-            self.open_order("", order_type=OrderType.MARKET, contracts=-self.get_position().contracts)
+            self.open_order("", order_type=ORDER_TYPE_MARKET, contracts=-self.get_position().contracts)
 
     """
          ██████╗ ██████╗ ██████╗ ███████╗██████╗
@@ -214,17 +366,66 @@ class BacktestFutures(Backtest):
     """
 
 
-    def _get_order_margin(self) -> float:
+    def _get_order_margin(self, exclude_order: Union[None, SimOrder] = None) -> float:
         """
-        Sums the initial margin of all opened orders.
+        Sums the initial margin of all opened orders from the running total and the orders without a price.
+        :param exclude_order: order in the book that is not included
+        :return: total order margin
+        """
+        margin = self.order_margin_total
+        for order in self.orders_without_price.values():
+            if order is not exclude_order:
+                margin += self._get_order_initial_margin(order)
+        if exclude_order is not None and exclude_order.order_id in self.order_margins:
+            margin -= self.order_margins[exclude_order.order_id]
+        return margin
+
+    def _get_order_margin_full(self, exclude_order: Union[None, SimOrder] = None) -> float:
+        """
+        Sums the initial margin of all opened orders by going over the order book.
+        :param exclude_order: order in the book that is not included
         :return: total order margin
         """
         margin = 0
-        for order in self.orders_open:
-            margin += self._get_order_initial_margin(order)
+        for order in self.order_book.orders.values():
+            if order is not exclude_order:
+                margin += self._get_order_initial_margin(order)
         return margin
 
-    def _is_order_reducing(self, order: Order) -> bool:
+    def _add_order_to_book(self, order: SimOrder) -> None:
+        """
+        Add an order to the order book and its margin to the running total.
+        :param order: order
+        """
+        self.order_book.add(order)
+        self._add_order_margin(order)
+
+    def _remove_order_from_book(self, order: SimOrder) -> None:
+        """
+        Remove an order from the order book and its margin from the running total.
+        :param order: order
+        """
+        self._remove_order_margin(order)
+        self.order_book.remove(order)
+
+    def _add_order_margin(self, order: SimOrder) -> None:
+        if order.price > 0:
+            margin = self._get_order_initial_margin(order)
+            self.order_margins[order.order_id] = margin
+            self.order_margin_total += margin
+        else:
+            self.orders_without_price[order.order_id] = order
+
+    def _remove_order_margin(self, order: SimOrder) -> None:
+        if order.order_id in self.order_margins:
+            self.order_margin_total -= self.order_margins.pop(order.order_id)
+            if len(self.order_margins) == 0:
+                # Start again from zero, so rounding errors don't add up
+                self.order_margin_total = 0
+        else:
+            self.orders_without_price.pop(order.order_id, None)
+
+    def _is_order_reducing(self, order: SimOrder) -> bool:
         """
         Check if the order would reduce the current position (-100 -> -10 is reducing)
         :param order: order
@@ -237,19 +438,20 @@ class BacktestFutures(Backtest):
             reduce = True
         return reduce
 
-    def _check_order_enough_balance(self, order: Order) -> bool:
+    def _check_order_enough_balance(self, order: SimOrder) -> bool:
         """
         Check if the order can be executed with the current availible balance.
+        The margin of the order itself isn't part of the available balance, if it is already in the order book.
         :param order:
         :return:
         """
         if not self._is_order_reducing(order):
             order_cost = self._get_order_initial_margin(order)
-            if order_cost > self._get_available_balance() and not self.unlimited_funds:
+            if order_cost > self._get_available_balance(exclude_order=order) and not self.unlimited_funds:
                 return False
         return True
 
-    def _check_order_reduce_only(self, order: Order) -> bool:
+    def _check_order_reduce_only(self, order: SimOrder) -> bool:
         """
         Check if the order can be executed considering the reduce only parameter.
         :param order: order
@@ -262,7 +464,7 @@ class BacktestFutures(Backtest):
                 return False
         return True
 
-    def _check_order_lifetime(self, order: Order) -> bool:
+    def _check_order_lifetime(self, order: SimOrder) -> bool:
         """
         Check if the order should be canceled.
         :param order: order
@@ -270,7 +472,7 @@ class BacktestFutures(Backtest):
         """
         return True
 
-    def _check_order_post_only(self, order: Order) -> bool:
+    def _check_order_post_only(self, order: SimOrder) -> bool:
         """
         Check if the order can be opened considerung the post only parameter.
         :param order: order
@@ -278,9 +480,9 @@ class BacktestFutures(Backtest):
         """
         current_price = self.get_open()
         if order.post_only:
-            if (order.order_type == OrderType.LIMIT and ((order.contracts > 0 and order.price > current_price) or
+            if (order.order_type == ORDER_TYPE_LIMIT and ((order.contracts > 0 and order.price > current_price) or
                                                          (order.contracts < 0 and order.price < current_price))) or \
-                    (order.order_type == OrderType.STOP_MARKET and (
+                    (order.order_type == ORDER_TYPE_STOP_MARKET and (
                             (order.contracts > 0 and order.price < current_price) or
                             (order.contracts < 0 and order.price > current_price))):
                 return False
@@ -314,17 +516,21 @@ class BacktestFutures(Backtest):
 
     def _get_date(self) -> datetime.datetime:
         """
-        Get the current datetime in dataframe as python datetime
+        Get the current datetime in dataframe as python datetime. The datetime is created once per candle.
         :return: python dt
         """
-        return utils.pdts_to_pydt(self.df.at[self.df_position, "date"])
+        if self.date_cache_position != self.df_position:
+            microseconds = int(self.date_values[self.df_position]) // 1000
+            self.date_cache = self.date_epoch + datetime.timedelta(microseconds=microseconds)
+            self.date_cache_position = self.df_position
+        return self.date_cache
 
     def _get_timestamp(self) -> int:
         """
         Get the current datetime in dataframe as unix timestamp.
         :return: unix timestamp in seconds
         """
-        return int(self._get_date().timestamp())
+        return int(self.timestamp_values[self.df_position])
 
 
     """
@@ -354,20 +560,73 @@ class BacktestFutures(Backtest):
         if self.unlimited_funds:
             return self.wallet.deposit
 
-        return self._get_account_balance() + np.nan_to_num(self._get_upnl(), nan=0)
+        upnl = self._get_upnl_cached()
+        if np.isnan(upnl):
+            upnl = 0
+        return self._get_account_balance() + upnl
 
-    def _get_available_balance(self) -> float:
+    def _get_available_balance(self, exclude_order: Union[None, SimOrder] = None) -> float:
         """
         Availible Balance = account balance - upnl - position margin - order margin
+        :param exclude_order: order in the book whose margin is not subtracted
         :return: available balance
         """
         if self.unlimited_funds:
             return self.wallet.deposit
 
-        position_margin = self._get_position_margin()
-        order_margin = self._get_order_margin()
+        if self.debug_aggregates:
+            self._check_aggregates(exclude_order)
+
+        position_margin = self._get_position_margin_cached()
+        order_margin = self._get_order_margin(exclude_order)
         return self._get_margin_balance() - position_margin - order_margin
 
+    def _get_position_margin_cached(self) -> float:
+        """
+        Get the position margin, calculated once per candle and position change.
+        :return: position margin
+        """
+        self._update_position_cache()
+        return self.position_margin_cache
+
+    def _get_upnl_cached(self) -> float:
+        """
+        Get the upnl, calculated once per candle and position change.
+        :return: upnl
+        """
+        self._update_position_cache()
+        return self.upnl_cache
+
+    def _update_position_cache(self) -> None:
+        key = (self.df_position, self.position_version)
+        if key != self.position_cache_key:
+            self.position_margin_cache = self._get_position_margin()
+            self.upnl_cache = self._get_upnl()
+            self.position_cache_key = key
+
+    def _invalidate_position_cache(self) -> None:
+        """
+        Has to be called after every change of the position.
+        """
+        self.position_version += 1
+
+    def _check_aggregates(self, exclude_order: Union[None, SimOrder] = None) -> None:
+        """
+        Compare the running totals and cached values with a full recalculation.
+        :param exclude_order: order in the book that is not included in the order margin
+        """
+        # The running total has rounding errors relative to the margin of all orders, even if one is excluded
+        order_margin_scale = self._get_order_margin_full()
+        checks = [
+            ("order margin", self._get_order_margin(exclude_order), self._get_order_margin_full(exclude_order),
+             order_margin_scale),
+            ("position margin", self._get_position_margin_cached(), self._get_position_margin(), 0),
+            ("upnl", self._get_upnl_cached(), self._get_upnl(), 0),
+        ]
+        for name, value, expected, scale in checks:
+            if not np.isclose(value, expected, rtol=1e-9, atol=max(1e-12, scale * 1e-9), equal_nan=True):
+                raise ExchangeException(f"{name} is {value} but should be {expected}")
+
 
     def _update_wallet(self) -> None:
         """
@@ -377,7 +636,17 @@ class BacktestFutures(Backtest):
         self.wallet.available_balance = self._get_available_balance()
         self.wallet.margin_balance = self._get_margin_balance()
         self.wallet.order_margin = self._get_order_margin()
-        self.wallet.position_margin = self._get_position_margin()
+        self.wallet.position_margin = self._get_position_margin_cached()
+
+    def _update_drawdown(self) -> None:
+        """
+        Track the highest margin balance and the largest drawdown from it as ratio of the peak.
+        """
+        equity = self.wallet.margin_balance
+        if equity > self.equity_peak:
+            self.equity_peak = equity
+        if self.equity_peak > 0:
+            self.max_drawdown = max(self.max_drawdown, (self.equity_peak - equity) / self.equity_peak)
 
 
     """
@@ -396,6 +665,7 @@ class BacktestFutures(Backtest):
         """
         self.position.price = 0
         self.position.contracts = 0
+        self._invalidate_position_cache()
 
     def _check_liquidation(self) -> None:
         """
@@ -410,16 +680,16 @@ class BacktestFutures(Backtest):
             else:
                 liquidated = False
                 if self.position.contracts > 0:
-                    if self.df.at[self.df_position, "low"] < self._get_liquidation_price():
+                    if self.low_values[self.df_position] < self._get_liquidation_price():
                         liquidated = True
                 elif self.position.contracts < 0:
-                    if self.df.at[self.df_position, "high"] > self._get_liquidation_price():
+                    if self.high_values[self.df_position] > self._get_liquidation_price():
                         liquidated = True
 
                 if liquidated:
-                    execution = Execution()
+                    execution = SimExecution()
                     execution.subaccount_id = self.subaccount_id
-                    execution.execution_type = ExecutionType.LIQUIDATION
+                    execution.execution_type = EXECUTION_TYPE_LIQUIDATION
                     execution.execution_id = self._get_order_id()
                     execution.order_id = 0
                     execution.datetime = self._get_date()
@@ -428,10 +698,10 @@ class BacktestFutures(Backtest):
                     execution.price = self._get_liquidation_price()
                     execution.contracts = self.position.contracts
                     execution.cost = -self._get_position_margin()
-                    execution.reduce_or_expand = ReduceExpandType.REDUCE
+                    execution.reduce_or_expand = REDUCE
                     execution.fee_rate = 0
                     execution.fee_cost = 0
-                    self.session.add(execution)
+                    self.history_sink.add_execution(execution)
 
                     self.wallet.total_rpnl += execution.cost
                     self._reset_position()
@@ -439,44 +709,43 @@ class BacktestFutures(Backtest):
     def _process_orders(self) -> None:
         """
         Go over open order and check if they need to be executed or canceled.
-
-        :return:
+        Only the orders whose checks can change are visited, sorted by their distance to open, in case multiple are
+        executed in the same candle:
+        - market orders, canceled orders and limit and stop orders with a price in the range of the candle
+        - reduce only orders, if the position changed since they were last checked
+        - all orders, if the available balance is negative. Otherwise every order passes the balance check, since
+          the available balance without the margin of the order is at least its margin.
+        Executing an order changes the position and balance, so the remaining orders are collected again.
         """
-        open = self.df.open.iloc[self.df_position]
-        high = self.df.high.iloc[self.df_position]
-        low = self.df.low.iloc[self.df_position]
-
-        # Order mit Abstand zu Open sortieren, falls mehre in der selben Candle ausgeführt werden
-        def compare(item1, item2):
-            # Markets immer ganz unten
-            if item1.price is None:
-                return -1
-            if item2.price is None:
-                return 1
-
-            dist1 = abs(item1.price - open)
-            dist2 = abs(item2.price - open)
-
-            if dist1 < dist2:
-                return -1
-            elif dist1 > dist2:
-                return 1
-            else:
-                return 0
-
-        tmp = self.orders_open.copy()
-        tmp.sort(key=cmp_to_key(compare))
-        for order in tmp:
-            if order.status == OrderStatus.CANCELED:
+        open = self.open_values[self.df_position]
+        high = self.high_values[self.df_position]
+        low = self.low_values[self.df_position]
+
+        full_scan = self._is_balance_check_required()
+        orders = self._get_order_candidates(open, low, high, full_scan)
+        last_order_id = self.order_cnt
+        visited = set()
+        executed = False
+        position_contracts = self.position.contracts
+
+        index = 0
+        while index < len(orders):
+            order = orders[index]
+            index += 1
+            visited.add(order.order_id)
+
+            if order not in self.order_book:
+                # Canceled by its one-cancels-other group
+                continue
+
+            if order.status == ORDER_STATUS_CANCELED:
                 self._cancel_order(order)
-            elif order.status == OrderStatus.OPEN:
+            elif order.status == ORDER_STATUS_OPEN:
                 cancel: bool = False
 
-                self.orders_open.remove(order)
-                if not self._check_order_enough_balance(order):
+                if full_scan and not self._check_order_enough_balance(order):
                     #logger.info(f"not enough balance for order {order.order_id}")
                     cancel = True
-                self.orders_open.append(order)
 
                 if not self._check_order_reduce_only(order):
                     logger.info(f"reduce only order not possible for order {order.order_id}")
@@ -490,44 +759,169 @@ class BacktestFutures(Backtest):
                     self._cancel_order(order)
                 else:
                     limit_filled: bool = False
-                    if order.order_type == OrderType.LIMIT or order.order_type == OrderType.STOP_MARKET:
+                    if order.order_type == ORDER_TYPE_LIMIT:
                         if order.contracts > 0:
                             if low < order.price < high:
                                 limit_filled = True
                         if order.contracts < 0:
                             if low < order.price < high:
                                 limit_filled = True
+                    elif order.order_type == ORDER_TYPE_STOP_MARKET:
+                        limit_filled = self._is_stop_triggered(order, low, high)
+
+                    if (limit_filled or order.order_type == ORDER_TYPE_MARKET):
+                        distance = abs(order.price - open)
 
-                    if (limit_filled or order.order_type == OrderType.MARKET):
-                        order.status = OrderStatus.CLOSED
+                        order.status = ORDER_STATUS_CLOSED
                         order.last_trade_datetime = self._get_date()
                         order.last_trade_timestamp = self._get_timestamp()
 
-                        if (order.order_type == OrderType.MARKET):
+                        if (order.order_type == ORDER_TYPE_MARKET):
                             order.price = self.get_open()
-                        elif (order.order_type == OrderType.STOP_MARKET):
-                            slippage = abs(order.price * self.stop_market_slippage)
-                            if order.contracts > 0:
-                                order.price += slippage
-                            else:
-                                order.price -= slippage
+                        elif (order.order_type == ORDER_TYPE_STOP_MARKET):
+                            order.price = self._get_stop_fill_price(order, open)
 
                         self._execute_order(order)
+                        executed = True
+
+                        # Orders closer to open were already checked before the execution. Orders opened by the
+                        # execution, like take profit and stop loss, are processed from the next candle on.
+                        full_scan = full_scan or self._is_balance_check_required()
+                        candidates = self._get_order_candidates(open, low, high, full_scan, check_reduce_only=True)
+                        orders = [o for o in candidates
+                                  if o.order_id not in visited and o.order_id <= last_order_id and
+                                  abs(o.price - open) >= distance]
+                        index = 0
+
+        if executed or self.position.contracts != position_contracts:
+            self.reduce_only_checked_contracts = np.nan
+        else:
+            self.reduce_only_checked_contracts = position_contracts
+        self.reduce_only_checked_order_id = self.order_cnt
+
+    def _is_stop_triggered(self, order: SimOrder, low: float, high: float) -> bool:
+        """
+        Check if a stop order is triggered in the current candle. Buy stops trigger when the high reaches the stop
+        price, sell stops when the low reaches it.
+        :param order: stop order
+        :param low: low price
+        :param high: high price
+        :return: bool
+        """
+        if order.contracts > 0:
+            return high >= order.price
+        else:
+            return low <= order.price
+
+    def _get_stop_fill_price(self, order: SimOrder, open: float) -> float:
+        """
+        Get the execution price of a triggered stop order. If the candle opened beyond the stop price, the order is
+        filled at open instead. The slippage always makes the price worse.
+        :param order: stop order
+        :param open: open price
+        :return: fill price
+        """
+        if order.contracts > 0:
+            price = max(order.price, open)
+            return price + abs(price * self.stop_market_slippage)
+        else:
+            price = min(order.price, open)
+            return price - abs(price * self.stop_market_slippage)
 
-    def _cancel_order(self, order: Order) -> None:
+    def _open_bracket_orders(self, order: SimOrder, contracts: float) -> None:
+        """
+        Open the take profit and stop loss of an executed order as reduce only orders in the opposite direction.
+        The take profit is a limit order, the stop loss a stop market order. If both are set, executing one cancels
+        the other.
+        :param order: executed order
+        :param contracts: executed contracts
+        """
+        bracket = self.order_brackets.pop(order.order_id, None)
+        if bracket is None:
+            return
+
+        children = []
+        if bracket.take_profit is not None:
+            children.append(self.open_order(order.symbol, ORDER_TYPE_LIMIT, contracts=-contracts,
+                                            price=bracket.take_profit, reduce_only=True))
+        if bracket.stop_loss is not None:
+            children.append(self.open_order(order.symbol, ORDER_TYPE_STOP_MARKET, contracts=-contracts,
+                                            price=bracket.stop_loss, reduce_only=True))
+
+        children = [child for child in children if child is not None]
+        for child in children:
+            self.oco_siblings[child.order_id] = [other.order_id for other in children if other is not child]
+
+    def _cancel_oco_siblings(self, order: SimOrder) -> None:
+        """
+        Cancel the other orders of the one-cancels-other group of an executed order.
+        :param order: executed order
+        """
+        for order_id in self.oco_siblings.pop(order.order_id, []):
+            sibling = self.order_book.get(order_id)
+            if sibling is not None:
+                self._cancel_order(sibling)
+
+    def _is_balance_check_required(self) -> bool:
+        """
+        Check if the orders in the book have to pass the balance check. With a positive available balance every order
+        passes it.
+        :return: bool
+        """
+        return not self.unlimited_funds and self._get_available_balance() < 0
+
+    def _get_order_candidates(self, open: float, low: float, high: float, full_scan: bool,
+                              check_reduce_only: bool = False) -> List[SimOrder]:
+        """
+        Get the orders from the book that have to be processed in this candle, sorted by their distance to open.
+        Equal distances are sorted by the order id.
+        :param open: open price
+        :param low: low price
+        :param high: high price
+        :param full_scan: return all orders
+        :param check_reduce_only: return all reduce only orders, since the position changed
+        :return: list of orders
+        """
+        if full_scan:
+            orders = self.order_book.get_orders()
+        else:
+            candidates = {}
+            for order in self.order_book.get_market_orders():
+                candidates[order.order_id] = order
+            for order in self.order_book.get_canceled_orders():
+                candidates[order.order_id] = order
+            for order in self.order_book.get_in_range(low, high):
+                candidates[order.order_id] = order
+            for order in self.order_book.get_triggered_stops(low, high):
+                candidates[order.order_id] = order
+
+            position_changed = self.position.contracts != self.reduce_only_checked_contracts
+            for order in self.order_book.get_reduce_only_orders():
+                if check_reduce_only or position_changed or order.order_id > self.reduce_only_checked_order_id:
+                    candidates[order.order_id] = order
+            orders = list(candidates.values())
+
+        orders.sort(key=lambda item: (abs(item.price - open), item.order_id))
+        return orders
+
+    def _cancel_order(self, order: SimOrder) -> None:
         """
         Set status to cancel and move to seperate list.
         :param order: order
         """
-        order.status = OrderStatus.CANCELED
+        order.status = ORDER_STATUS_CANCELED
         self.orders_canceled.append(order)
-        self.orders_open.remove(order)
+        self._remove_order_from_book(order)
+        self.order_brackets.pop(order.order_id, None)
+        self.oco_siblings.pop(order.order_id, None)
 
 
 
-    def _execute_order(self, order: Order) -> None:
+    def _execute_order(self, order: SimOrder) -> None:
         self.orders_closed.append(order)
-        self.orders_open.remove(order)
+        self._remove_order_from_book(order)
+        self.trade_count += 1
+        self._cancel_oco_siblings(order)
 
         # Reduce only können keinen Seitenwechsel machen!
         if order.reduce_only:
@@ -535,10 +929,10 @@ class BacktestFutures(Backtest):
                 if (order.contracts > 0 and self.position.contracts < 0) or (order.contracts < 0 and self.position.contracts > 0):
                     order.contracts = -self.position.contracts
 
-        def expand(order_tmp: Order):
-            execution = Execution()
+        def expand(order_tmp: SimOrder):
+            execution = SimExecution()
             execution.subaccount_id = self.subaccount_id
-            execution.execution_type = ExecutionType.TRADE
+            execution.execution_type = EXECUTION_TYPE_TRADE
             execution.execution_id = self._get_order_id()
             execution.order_id = order_tmp.order_id
             execution.datetime = self._get_date()
@@ -547,11 +941,11 @@ class BacktestFutures(Backtest):
             execution.price = order_tmp.price
             execution.contracts = order_tmp.contracts
             execution.cost = self._get_order_initial_margin(order_tmp)
-            execution.reduce_or_expand = ReduceExpandType.EXPAND
+            execution.reduce_or_expand = EXPAND
             execution.fee_rate = order_tmp.fee_rate
             execution.fee_cost = self._get_order_fee_cost(order_tmp)
             execution.taker_or_maker = order.taker_or_maker
-            self.session.add(execution)
+            self.history_sink.add_execution(execution)
 
             if self.position.contracts == 0:
                 self.position.price = order_tmp.price
@@ -559,13 +953,14 @@ class BacktestFutures(Backtest):
             else:
                 self.position.price = self._get_order_position_aep(order)
                 self.position.contracts += order_tmp.contracts
+            self._invalidate_position_cache()
 
             self.wallet.total_rpnl += execution.fee_cost
 
-        def reduce(order_tmp: Order):
-            execution = Execution()
+        def reduce(order_tmp: SimOrder):
+            execution = SimExecution()
             execution.subaccount_id = self.subaccount_id
-            execution.execution_type = ExecutionType.TRADE
+            execution.execution_type = EXECUTION_TYPE_TRADE
             execution.execution_id = self._get_order_id()
             execution.order_id = order_tmp.order_id
             execution.datetime = self._get_date()
@@ -574,27 +969,30 @@ class BacktestFutures(Backtest):
             execution.price = order_tmp.price
             execution.contracts = order_tmp.contracts
             execution.cost = 0
-            execution.reduce_or_expand = ReduceExpandType.REDUCE
+            execution.reduce_or_expand = REDUCE
             execution.fee_rate = order_tmp.fee_rate
             execution.fee_cost = self._get_order_fee_cost(order_tmp)
             execution.taker_or_maker = order.taker_or_maker
 
-            price = order_tmp.price if order.order_type == OrderType.LIMIT else self.get_open()
+            price = order_tmp.price if order.order_type == ORDER_TYPE_LIMIT else self.get_open()
             if self.position.contracts > 0:
                 rpnl = self._get_order_rpnl_long(order_tmp, price)
             else:
                 rpnl = self._get_order_rpnl_short(order_tmp, price)
 
             execution.cost = rpnl
-            self.session.add(execution)
+            self.history_sink.add_execution(execution)
 
             self.wallet.total_rpnl += execution.fee_cost
             self.position.contracts += order_tmp.contracts
+            self._invalidate_position_cache()
             self.wallet.total_rpnl += rpnl
 
             if self.position.contracts == 0:
                 self._reset_position()
 
+        contracts = order.contracts
+
         # Seitenwechel
         if (self.position.contracts > 0 and (self.position.contracts + order.contracts) < 0) or \
             (self.position.contracts < 0 and (self.position.contracts + order.contracts) > 0):
@@ -603,7 +1001,7 @@ class BacktestFutures(Backtest):
             reduction = copy.copy(order)
             reduction.order_id = self._get_order_id()
             reduction.contracts = -self.position.contracts
-            self.session.add(reduction)
+            self.history_sink.add_order(reduction)
             order.contracts += self.position.contracts
             reduce(reduction)
 
@@ -612,23 +1010,55 @@ class BacktestFutures(Backtest):
         elif abs(self.position.contracts + order.contracts) < abs(self.position.contracts):
             reduce(order)
 
+        self._open_bracket_orders(order, contracts)
+
+    def _add_skipped_snapshots(self, positions: np.ndarray) -> None:
+        """
+        Calculate the wallet and position of skipped candles, update the drawdown and record the snapshots.
+        Without a position nothing changes, otherwise the values that depend on the open price are calculated with
+        the vectorized versions of the position functions. The wallet and position keep the values of the last
+        candle.
+        :param positions: positions of the skipped candles in the dataframe
+        """
+        wallet_values = {}
+        position_values = {}
+        margin_balance = np.full(len(positions), self.wallet.margin_balance)
+
+        if self._position_open():
+            open_values = self.open_values[positions]
+            upnl = self._get_upnl_values(open_values)
+            position_margin = self._get_position_margin_values(open_values)
+
+            if not self.unlimited_funds:
+                margin_balance = self._get_account_balance() + np.nan_to_num(upnl, nan=0)
+                wallet_values["margin_balance"] = margin_balance
+                wallet_values["available_balance"] = margin_balance - position_margin - self._get_order_margin()
+            wallet_values["position_margin"] = position_margin
+
+            position_values["collateral"] = position_margin
+            position_values["unrealizedPnl"] = upnl
+            position_values["unrealizedPnlPercentage"] = upnl / position_margin
+            position_values["bankruptcyPrice"] = self._get_bankruptcy_price_values(self.position.contracts,
+                                                                                   open_values)
+
+        for name, values in wallet_values.items():
+            setattr(self.wallet, name, values[-1])
+        for name, values in position_values.items():
+            setattr(self.position, name, values[-1])
+
+        peaks = np.maximum.accumulate(np.append(self.equity_peak, margin_balance))[1:]
+        if peaks[-1] > 0:
+            drawdowns = np.where(peaks > 0, (peaks - margin_balance) / np.where(peaks > 0, peaks, 1), 0)
+            self.max_drawdown = max(self.max_drawdown, drawdowns.max())
+        self.equity_peak = peaks[-1]
+
+        self.history_sink.add_snapshots(self.wallet, self.position, self.order_book.get_orders(),
+                                        self.date_values[positions], self.timestamp_values[positions],
+                                        wallet_values, position_values)
+
     def _copy_objects_for_history(self):
-        self.wallet.datetime = self._get_date()
-        self.wallet.timestamp = self._get_timestamp()
-        tmp = copy_sqla_object(self.wallet)
-        self.session.add(tmp)
-
-        self.position.datetime = self._get_date()
-        self.position.timestamp = self._get_timestamp()
-        tmp = copy_sqla_object(self.position)
-        self.session.add(tmp)
-
-        for order in itertools.chain(self.orders_open): #, self.orders_canceled, self.orders_closed, self.orders_expired):
-            tmp = copy_sqla_object(order)
-            tmp.insert_state = False
-            tmp.datetime = self._get_date()
-            tmp.timestamp = self._get_timestamp()
-            self.session.add(tmp)
+        self.history_sink.add_snapshot(self.wallet, self.position, self.order_book.get_orders(), self._get_date(),
+                                       self._get_timestamp())
 
         self.orders_closed = []
         self.orders_canceled = []
@@ -639,10 +1069,10 @@ class BacktestFutures(Backtest):
         """
         Update position object with current values.
         """
-        self.position.collateral = self._get_position_margin()
+        self.position.collateral = self._get_position_margin_cached()
         self.position.initialMargin = self._get_position_initial_marign()
         self.position.maintenanceMargin = self._get_position_maintenance_margin()
-        self.position.unrealizedPnl = self._get_upnl()
+        self.position.unrealizedPnl = self._get_upnl_cached()
         self.position.unrealizedPnlPercentage = self._get_upnlp()
         self.position.liquidationPrice = self._get_liquidation_price()
         self.position.bankruptcyPrice = self._get_bankruptcy_price(self.position.contracts)
@@ -16,6 +16,7 @@ from sqlalchemy.orm.session import Session as SessionClass
 
 from kektrade.exchange.interface import *
 from kektrade.exchange.backtest_futures import BacktestFutures
+from kektrade.exchange.backtest_types import *
 from kektrade.exceptions import *
 from kektrade import utils
 from kektrade.exchange.history_meta import Versioned, versioned_session
@@ -34,7 +35,7 @@ class BacktestInverse(BacktestFutures):
         ╚═════╝ ╚═╝  ╚═╝╚═════╝ ╚══════╝╚═╝  ╚═╝
        """
 
-    def _get_order_initial_margin(self, order: Order) -> float:
+    def _get_order_initial_margin(self, order: SimOrder) -> float:
         """
         https://blog.bybit.com/en-us/bybit-101/how-to-calculate-order-cost/
         Initial margin is calculated by the order quantity and estimated execution price. For market orders, the
@@ -189,6 +190,45 @@ class BacktestInverse(BacktestFutures):
         elif self.position.contracts < 0:
             return self.position.contracts * ((1 / self.position.price) - (1 / self.get_open()))
 
+    def _get_upnl_values(self, open_values: np.ndarray) -> np.ndarray:
+        """
+        Vectorized _get_upnl for several open prices.
+        :param open_values: open prices
+        :return: upnl for every price
+        """
+        if not self._position_open():
+            return np.full(len(open_values), np.nan)
+
+        return self.position.contracts * ((1 / self.position.price) - (1 / open_values))
+
+    def _get_bankruptcy_price_values(self, contracts: float, open_values: np.ndarray) -> np.ndarray:
+        """
+        Vectorized _get_bankruptcy_price for several open prices.
+        :param contracts: amount of contracts
+        :param open_values: open prices
+        :return: bankruptcy price for every price
+        """
+        if not self._position_open() or self.cross_margin or self.position.leverage == 1:
+            return np.full(len(open_values), self._get_bankruptcy_price(contracts))
+
+        if contracts > 0:
+            return open_values * (self.position.leverage / (self.position.leverage + 1))
+        else:
+            return open_values * (self.position.leverage / (self.position.leverage - 1))
+
+    def _get_position_margin_values(self, open_values: np.ndarray) -> np.ndarray:
+        """
+        Vectorized _get_position_margin for several open prices.
+        :param open_values: open prices
+        :return: position margin for every price
+        """
+        if not self._position_open():
+            return np.zeros(len(open_values))
+
+        bankruptcy_price = self._get_bankruptcy_price_values(self.position.contracts, open_values)
+        fee_close = np.abs(self.position.contracts / bankruptcy_price) * self.taker_fee
+        return self._get_position_initial_marign() + fee_close
+
     def _get_upnlp(self) -> float:
         """
         https://blog.bybit.com/en-us/bybit-101/how-to-understand-profit-and-loss/
@@ -217,7 +257,7 @@ class BacktestInverse(BacktestFutures):
         If a position is open, calculate the funding cost and create a new execution event.
         """
         if self._position_open():
-            rate = self.df.at[self.df_position, "funding_rate"]
+            rate = self.funding_rate_values[self.df_position]
             if (not np.isnan(rate) and rate != 0):
                 position_value = abs(self.position.contracts) / self.get_close()
                 funding_fee = abs(position_value * rate)
@@ -229,9 +269,9 @@ class BacktestInverse(BacktestFutures):
                     if rate < 0:
                         funding_fee = funding_fee * -1
 
-                execution = Execution()
+                execution = SimExecution()
                 execution.subaccount_id = self.subaccount_id
-                execution.execution_type = ExecutionType.FUNDING
+                execution.execution_type = EXECUTION_TYPE_FUNDING
                 execution.execution_id = self._get_order_id()
                 execution.order_id = 0
                 execution.datetime = self._get_date()
@@ -240,22 +280,22 @@ class BacktestInverse(BacktestFutures):
                 execution.price = self.get_close()
                 execution.contracts = 0
                 execution.cost = funding_fee
-                execution.reduce_or_expand = ReduceExpandType.REDUCE
+                execution.reduce_or_expand = REDUCE
                 execution.fee_rate = 0
                 execution.fee_cost = 0
-                self.session.add(execution)
+                self.history_sink.add_execution(execution)
 
                 self.wallet.total_rpnl += execution.cost
 
-    def _get_order_fee_cost(self, order: Order) -> float:
+    def _get_order_fee_cost(self, order: SimOrder) -> float:
         return abs(order.contracts / order.price) * order.fee_rate
 
-    def _get_order_rpnl_long(self, order: Order, price: float) -> float:
+    def _get_order_rpnl_long(self, order: SimOrder, price: float) -> float:
         return self.position.contracts * ((1 / self.position.price) - (1 / self.get_open()))
 
-    def _get_order_rpnl_short(self, order: Order, price: float) -> float:
+    def _get_order_rpnl_short(self, order: SimOrder, price: float) -> float:
         return self.position.contracts * ((1 / self.position.price) - (1 / self.get_open()))
 
-    def _get_order_position_aep(self, order: Order) -> float:
+    def _get_order_position_aep(self, order: SimOrder) -> float:
         return (self.position.contracts + order.contracts) / ((self.position.contracts / self.position.price) +
                                                               (order.contracts / order.price))
\ No newline at end of file
@@ -0,0 +1,91 @@
+import logging
+from typing import Any, NamedTuple, Union
+
+from kektrade.database.types import *
+
+logger = logging.getLogger(__name__)
+
+# Integer codes of the database enums. The simulation entities store these codes instead of the enum members, so
+# the backtest exchange compares plain integers. The history sinks convert them back to the enums.
+ORDER_STATUS_OPEN = OrderStatus.OPEN.value
+ORDER_STATUS_CLOSED = OrderStatus.CLOSED.value
+ORDER_STATUS_CANCELED = OrderStatus.CANCELED.value
+ORDER_STATUS_EXPIRED = OrderStatus.EXPIRED.value
+
+ORDER_TYPE_MARKET = OrderType.MARKET.value
+ORDER_TYPE_LIMIT = OrderType.LIMIT.value
+ORDER_TYPE_STOP_MARKET = OrderType.STOP_MARKET.value
+
+SIDE_BUY = Side.BUY.value
+SIDE_SELL = Side.SELL.value
+
+TIME_IN_FORCE_GTC = TimeInForce.GTC.value
+
+EXECUTION_TYPE_TRADE = ExecutionType.TRADE.value
+EXECUTION_TYPE_LIQUIDATION = ExecutionType.LIQUIDATION.value
+EXECUTION_TYPE_FUNDING = ExecutionType.FUNDING.value
+
+TAKER = TakerMakerType.TAKER.value
+MAKER = TakerMakerType.MAKER.value
+
+REDUCE = ReduceExpandType.REDUCE.value
+EXPAND = ReduceExpandType.EXPAND.value
+
+
+def to_code(value: Any) -> Any:
+    """
+    Convert an enum member to its integer code. Codes are returned unchanged.
+    :param value: enum member or code
+    :return: code
+    """
+    return getattr(value, "value", value)
+
+
+class SimEntity():
+    """
+    Base class for the objects of the backtest exchange. They have the same attributes as the database classes, but
+    no sqlalchemy instrumentation. All attributes start as None.
+    Enum attributes hold integer codes, which still compare equal to the enum members.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({values})"
+
+
+class SimOrder(SimEntity):
+    __slots__ = ("subaccount_id", "order_id", "client_order_id", "insert_state", "datetime", "timestamp",
+                 "last_trade_datetime", "last_trade_timestamp", "status", "symbol", "order_type", "time_in_force",
+                 "side", "hedged", "hedge_mode", "price", "contracts", "cost", "fee_currency", "fee_rate",
+                 "reduce_only", "post_only", "taker_or_maker")
+
+
+class SimExecution(SimEntity):
+    __slots__ = ("subaccount_id", "execution_id", "datetime", "timestamp", "symbol", "execution_type", "order_id",
+                 "taker_or_maker", "price", "contracts", "cost", "fee_cost", "fee_rate", "reduce_or_expand")
+
+
+class SimPosition(SimEntity):
+    __slots__ = ("subaccount_id", "position_id", "datetime", "timestamp", "symbol", "isolated", "hedged",
+                 "contracts", "price", "leverage", "collateral", "initialMargin", "initialMarginPercentage",
+                 "maintenanceMargin", "maintenanceMarginPercentage", "unrealizedPnl", "unrealizedPnlPercentage",
+                 "liquidationPrice", "bankruptcyPrice", "status")
+
+
+class SimWallet(SimEntity):
+    __slots__ = ("subaccount_id", "datetime", "timestamp", "deposit", "account_balance", "margin_balance",
+                 "available_balance", "total_rpnl", "order_margin", "position_margin")
+
+
+class OrderBracket(NamedTuple):
+    """
+    Take profit and stop loss prices of an order. They are opened as reduce only orders when the order is executed
+    and cancel each other.
+    """
+    take_profit: Union[None, float]
+    stop_loss: Union[None, float]
@@ -0,0 +1,278 @@
+import logging
+from typing import Union
+
+import numpy as np
+from pandas import DataFrame
+
+from kektrade.exceptions import ExchangeException
+from kektrade.exchange.backtest import Backtest
+from kektrade.exchange.vectorized import VectorizedBacktest, load_vectorized_backtest
+
+logger = logging.getLogger(__name__)
+
+
+class BatchBacktest():
+    """
+    Backtest exchange for many parameter combinations at once. The wallet and position of every combination are kept
+    in arrays and all combinations are advanced over the same candle together, so a grid of combinations needs a
+    single pass over the candles instead of one event loop each.
+    Only market orders are supported, at most one per combination and candle. For every combination the results are
+    the same as with the backtest exchange the formulas are taken from.
+    """
+
+    def __init__(self, exchange: Backtest, initial_deposit: float, count: int):
+        """
+        :param exchange: backtest exchange with the parameters from the config
+        :param initial_deposit: deposit of every combination
+        :param count: number of parameter combinations
+        """
+        self.formulas: VectorizedBacktest = load_vectorized_backtest(exchange, initial_deposit)
+        self.count: int = count
+        self.initial_deposit: float = initial_deposit
+        self.unlimited_funds: bool = exchange.unlimited_funds
+
+        self.df_position: int = 0
+        self.df_length: int = 0
+        self.finished: bool = False
+        self.open_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.high_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.low_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.close_values: np.ndarray = np.empty(0, dtype=np.float64)
+        self.funding_rate_values: np.ndarray = np.empty(0, dtype=np.float64)
+
+        self.contracts: np.ndarray = np.zeros(count)
+        self.price: np.ndarray = np.zeros(count)
+        self.total_rpnl: np.ndarray = np.zeros(count)
+        self.trade_count: np.ndarray = np.zeros(count, dtype=np.int64)
+        self.equity_peak: np.ndarray = np.zeros(count)
+        self.max_drawdown: np.ndarray = np.zeros(count)
+
+        # Market orders of the current candle, executed in the next one. 0 contracts is no order.
+        self.order_contracts: np.ndarray = np.zeros(count)
+        self.order_reduce_only: np.ndarray = np.zeros(count, dtype=bool)
+
+    def set_dataframe(self, dataframe: DataFrame) -> None:
+        """
+        Set the candles all combinations are simulated on.
+        :param dataframe: dataframe
+        """
+        self.df_length = len(dataframe.index)
+        self.open_values = dataframe["open"].to_numpy(dtype=np.float64)
+        self.high_values = dataframe["high"].to_numpy(dtype=np.float64)
+        self.low_values = dataframe["low"].to_numpy(dtype=np.float64)
+        self.close_values = dataframe["close"].to_numpy(dtype=np.float64)
+        if "funding_rate" in dataframe.columns:
+            self.funding_rate_values = np.nan_to_num(dataframe["funding_rate"].to_numpy(dtype=np.float64), nan=0)
+        else:
+            self.funding_rate_values = np.zeros(self.df_length)
+
+    def get_position_contracts(self) -> np.ndarray:
+        """
+        :return: contracts of the position of every combination
+        """
+        return self.contracts.copy()
+
+    def get_account_balance(self) -> np.ndarray:
+        """
+        :return: account balance of every combination
+        """
+        if self.unlimited_funds:
+            return np.full(self.count, self.initial_deposit)
+        return self.initial_deposit + self.total_rpnl
+
+    def get_contracts_percentage(self, percentage: float) -> np.ndarray:
+        """
+        Contracts that use a percentage of the account balance as initial margin, like get_contracts_percentage of the
+        backtest exchange.
+        :param percentage: percentage of the account balance
+        :return: contracts for every combination
+        """
+        price_one_contract = self.formulas._get_order_initial_margin(1, self.close_values[self.df_position])
+        return self.get_account_balance() * (percentage / 100) / price_one_contract
+
+    def open_orders(self, contracts: np.ndarray, reduce_only: Union[bool, np.ndarray] = False) -> np.ndarray:
+        """
+        Open a market order for every combination with contracts other than 0. Orders that don't pass the balance
+        check of the backtest exchange are canceled.
+        :param contracts: contracts of the order of every combination
+        :param reduce_only: reduce only flag of every combination
+        :return: mask of the combinations whose order was opened
+        """
+        contracts = np.asarray(contracts, dtype=np.float64)
+        reduce_only = np.broadcast_to(np.asarray(reduce_only, dtype=bool), (self.count,))
+        if contracts.shape != (self.count,):
+            raise ExchangeException("one order per parameter combination expected")
+
+        opened = contracts != 0
+        if (opened & (self.order_contracts != 0)).any():
+            raise ExchangeException("only one order per parameter combination and candle")
+
+        opened &= self._check_enough_balance(contracts, reduce_only, self._get_available_balance())
+        self.order_contracts = np.where(opened, contracts, self.order_contracts)
+        self.order_reduce_only = np.where(opened, reduce_only, self.order_reduce_only)
+        return opened
+
+    def close_positions(self) -> None:
+        """
+        Close the positions of all combinations with a market order.
+        """
+        self.open_orders(-self.contracts)
+
+    def after_tick(self, i: int) -> None:
+        """
+        Process the next candle for all combinations, in the order of the backtest exchange.
+        :param i: current position in the dataframe
+        """
+        if i != self.df_position:
+            raise ExchangeException("df position mismatch")
+
+        self.df_position += 1
+
+        if self.df_position >= self.df_length - 1:
+            self.finished = True
+        else:
+            self._check_funding()
+            self._check_liquidation()
+            self._process_orders()
+            self._update_drawdown()
+
+    def _get_available_balance(self, order_contracts: Union[None, np.ndarray] = None) -> np.ndarray:
+        """
+        Available balance of every combination on the current candle.
+        :param order_contracts: contracts of open market orders
+        :return: available balance
+        """
+        balance = self.initial_deposit + self.total_rpnl
+        position_open = self.contracts != 0
+        if position_open.any():
+            open = self.open_values[self.df_position]
+            contracts = self.contracts[position_open]
+            price = self.price[position_open]
+            balance[position_open] += self.formulas._get_upnl_values(contracts, price, open) - \
+                self.formulas._get_position_margin_values(contracts, price, open)
+        if order_contracts is not None:
+            balance -= self.formulas._get_order_initial_margin(order_contracts, self.close_values[self.df_position])
+        return balance
+
+    def _check_enough_balance(self, contracts: np.ndarray, reduce_only: np.ndarray,
+                              available_balance: np.ndarray) -> np.ndarray:
+        """
+        Check for every combination if its order can be paid. Orders that reduce the position always pass.
+        :param contracts: contracts of the orders
+        :param reduce_only: reduce only flags of the orders
+        :param available_balance: available balance without the orders
+        :return: mask of the orders that pass
+        """
+        if self.unlimited_funds:
+            return np.ones(self.count, dtype=bool)
+
+        reducing = reduce_only | (np.abs(self.contracts + contracts) < np.abs(self.contracts))
+        order_cost = self.formulas._get_order_initial_margin(contracts, self.close_values[self.df_position])
+        return reducing | (order_cost <= available_balance)
+
+    def _check_funding(self) -> None:
+        rate = self.funding_rate_values[self.df_position]
+        if rate != 0:
+            self.total_rpnl += self.formulas._get_funding_values(self.contracts, self.close_values[self.df_position],
+                                                                 rate)
+
+    def _check_liquidation(self) -> None:
+        position_open = self.contracts != 0
+        if not position_open.any():
+            return
+
+        contracts = self.contracts[position_open]
+        price = self.price[position_open]
+        liquidation_price = self.formulas._get_liquidation_price(contracts, price)
+        liquidated = np.where(contracts > 0, self.low_values[self.df_position] < liquidation_price,
+                              self.high_values[self.df_position] > liquidation_price)
+        if not liquidated.any():
+            return
+
+        cost = self.formulas._get_position_margin_values(contracts[liquidated], price[liquidated],
+                                                         self.open_values[self.df_position])
+        indices = np.flatnonzero(position_open)[liquidated]
+        self.total_rpnl[indices] -= cost
+        self.contracts[indices] = 0
+        self.price[indices] = 0
+
+    def _process_orders(self) -> None:
+        """
+        Execute the market orders of the last candle on the open of the current one.
+        """
+        contracts = self.order_contracts
+        reduce_only = self.order_reduce_only
+        self.order_contracts = np.zeros(self.count)
+        self.order_reduce_only = np.zeros(self.count, dtype=bool)
+
+        execute = contracts != 0
+        if not execute.any():
+            return
+
+        if not self.unlimited_funds:
+            # Like the backtest exchange, the balance is only checked again if it became negative
+            check = self._get_available_balance(contracts) < 0
+            if check.any():
+                execute &= ~check | self._check_enough_balance(contracts, reduce_only, self._get_available_balance())
+        position = self.contracts.copy()
+        execute &= ~(reduce_only & (((contracts > 0) & (position > 0)) | (position == 0)))
+        if not execute.any():
+            return
+
+        self.trade_count += execute
+        contracts = np.where(execute, contracts, 0)
+        contracts = np.where(reduce_only & (np.abs(contracts) > np.abs(position)) & (contracts * position < 0),
+                             -position, contracts)
+        price = self.open_values[self.df_position]
+
+        # Reversal, reduce to zero first
+        reverse = ((position > 0) & (position + contracts < 0)) | ((position < 0) & (position + contracts > 0))
+        if reverse.any():
+            self._reduce(reverse, -position)
+            contracts = np.where(reverse, contracts + position, contracts)
+
+        position = self.contracts.copy()
+        expand = np.abs(position + contracts) > np.abs(position)
+        reduce = np.abs(position + contracts) < np.abs(position)
+        if expand.any():
+            self.total_rpnl[expand] += self.formulas._get_fee(contracts[expand], price)
+            new_contracts = position[expand] + contracts[expand]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                aep = new_contracts / ((position[expand] / self.price[expand]) + (contracts[expand] / price))
+            self.price[expand] = np.where(position[expand] == 0, price, aep)
+            self.contracts[expand] = new_contracts
+        if reduce.any():
+            self._reduce(reduce, contracts)
+
+    def _reduce(self, mask: np.ndarray, contracts: np.ndarray) -> None:
+        """
+        Reduce the positions, the realized pnl is calculated for the whole position like in the backtest exchange.
+        :param mask: combinations to reduce
+        :param contracts: contracts of the orders of all combinations
+        """
+        open = self.open_values[self.df_position]
+        position = self.contracts[mask]
+        rpnl = position * ((1 / self.price[mask]) - (1 / open))
+        self.total_rpnl[mask] += self.formulas._get_fee(contracts[mask], open) + rpnl
+        position = position + contracts[mask]
+        self.contracts[mask] = position
+        self.price[mask] = np.where(position != 0, self.price[mask], 0)
+
+    def _update_drawdown(self) -> None:
+        """
+        Track the highest margin balance and the largest drawdown from it for every combination.
+        """
+        if self.unlimited_funds:
+            equity = np.full(self.count, self.initial_deposit)
+        else:
+            equity = self.initial_deposit + self.total_rpnl
+            position_open = self.contracts != 0
+            equity[position_open] += self.formulas._get_upnl_values(self.contracts[position_open],
+                                                                    self.price[position_open],
+                                                                    self.open_values[self.df_position])
+
+        self.equity_peak = np.maximum(self.equity_peak, equity)
+        peak_positive = self.equity_peak > 0
+        drawdown = (self.equity_peak[peak_positive] - equity[peak_positive]) / self.equity_peak[peak_positive]
+        self.max_drawdown[peak_positive] = np.maximum(self.max_drawdown[peak_positive], drawdown)
+
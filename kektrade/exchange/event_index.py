@@ -0,0 +1,69 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class CandleEventIndex():
+    """
+    Find the next candle whose low or high crosses a price. The minimum of the lows and the maximum of the highs are
+    precomputed for blocks of candles, so a search only scans single candles in the first and the matching block.
+    """
+
+    def __init__(self, low: np.ndarray, high: np.ndarray, block_size: int = 128):
+        self.low: np.ndarray = low
+        self.high: np.ndarray = high
+        self.length: int = len(low)
+        self.block_size: int = block_size
+
+        blocks = -(-self.length // block_size)
+        padding = blocks * block_size - self.length
+        # fmin and fmax ignore missing values
+        self.block_low: np.ndarray = np.fmin.reduce(
+            np.append(low, np.full(padding, np.inf)).reshape(blocks, block_size), axis=1)
+        self.block_high: np.ndarray = np.fmax.reduce(
+            np.append(high, np.full(padding, -np.inf)).reshape(blocks, block_size), axis=1)
+
+    def first_low_below(self, start: int, price: float, inclusive: bool = False) -> int:
+        """
+        Get the first candle from start on with a low below the price.
+        :param start: first candle to check
+        :param price: price
+        :param inclusive: also match a low equal to the price
+        :return: position of the candle or the length of the data if there is none
+        """
+        if inclusive:
+            return self._find_first(start, self.low, self.block_low, lambda values: values <= price)
+        return self._find_first(start, self.low, self.block_low, lambda values: values < price)
+
+    def first_high_above(self, start: int, price: float, inclusive: bool = False) -> int:
+        """
+        Get the first candle from start on with a high above the price.
+        :param start: first candle to check
+        :param price: price
+        :param inclusive: also match a high equal to the price
+        :return: position of the candle or the length of the data if there is none
+        """
+        if inclusive:
+            return self._find_first(start, self.high, self.block_high, lambda values: values >= price)
+        return self._find_first(start, self.high, self.block_high, lambda values: values > price)
+
+    def _find_first(self, start: int, values: np.ndarray, block_values: np.ndarray, condition) -> int:
+        if start >= self.length:
+            return self.length
+
+        block = start // self.block_size
+        end = min((block + 1) * self.block_size, self.length)
+        matches = np.flatnonzero(condition(values[start:end]))
+        if len(matches) > 0:
+            return start + int(matches[0])
+
+        blocks = np.flatnonzero(condition(block_values[block + 1:]))
+        if len(blocks) == 0:
+            return self.length
+
+        block = block + 1 + int(blocks[0])
+        start = block * self.block_size
+        matches = np.flatnonzero(condition(values[start:start + self.block_size]))
+        return start + int(matches[0])
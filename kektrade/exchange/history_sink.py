@@ -0,0 +1,573 @@
+import logging
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import NamedTuple, Dict, List, Any, Union, Tuple
+import datetime
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import sqlalchemy as sa
+from sqlalchemy.orm import class_mapper
+
+from kektrade.config import RunSettings
+from kektrade.database.types import *
+from kektrade.exchange.backtest_types import SimOrder, SimExecution, SimPosition, SimWallet
+from kektrade.exceptions import UnsupportedHistorySink
+from kektrade.misc import EnumString
+
+logger = logging.getLogger(__name__)
+
+
+class HistorySinkType(EnumString):
+    Null = "null"
+    Memory = "memory"
+    Sqlite = "sqlite"
+    File = "file"
+
+
+class HistoryMode(EnumString):
+    Snapshot = "snapshot"
+    Delta = "delta"
+
+
+class ColumnKind(EnumString):
+    Integer = "integer"
+    Float = "float"
+    Boolean = "boolean"
+    Enum = "enum"
+    Datetime = "datetime"
+    String = "string"
+
+
+class ColumnInfo(NamedTuple):
+    """
+    Column of a history table and how it is stored in a ColumnBuffer.
+    """
+    name: str
+    kind: ColumnKind
+    enum: Any
+
+
+def get_table_columns(cls) -> List[ColumnInfo]:
+    """
+    Get the columns of a database class without the primary key.
+    Integer, float and boolean columns are stored as float64 with nan for None, enums as float64 of their code,
+    datetimes as int64 nanoseconds and strings as objects.
+    :param cls: sqlalchemy class
+    :return: list of columns
+    """
+    columns = []
+    for column in class_mapper(cls).columns:
+        if column.primary_key:
+            continue
+        if isinstance(column.type, sa.Enum):
+            columns.append(ColumnInfo(name=column.key, kind=ColumnKind.Enum, enum=column.type.enum_class))
+        elif isinstance(column.type, sa.DateTime):
+            columns.append(ColumnInfo(name=column.key, kind=ColumnKind.Datetime, enum=None))
+        elif isinstance(column.type, sa.Integer):
+            columns.append(ColumnInfo(name=column.key, kind=ColumnKind.Integer, enum=None))
+        elif isinstance(column.type, sa.Float):
+            columns.append(ColumnInfo(name=column.key, kind=ColumnKind.Float, enum=None))
+        elif isinstance(column.type, sa.Boolean):
+            columns.append(ColumnInfo(name=column.key, kind=ColumnKind.Boolean, enum=None))
+        else:
+            columns.append(ColumnInfo(name=column.key, kind=ColumnKind.String, enum=None))
+    return columns
+
+
+class ColumnBuffer():
+    """
+    Rows of a history table stored as one growable numpy array per column.
+    """
+
+    def __init__(self, columns: List[ColumnInfo], capacity: int = 1024):
+        self.columns: List[ColumnInfo] = columns
+        self.capacity: int = capacity
+        self.length: int = 0
+        self.arrays: Dict[str, np.ndarray] = {}
+        for column in columns:
+            self.arrays[column.name] = ColumnBuffer._allocate(column, capacity)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, obj: Any, **values) -> None:
+        """
+        Append the attributes of an object as new row.
+        :param obj: object with an attribute for every column
+        :param values: values that override the attributes of the object
+        """
+        if self.length == self.capacity:
+            self._grow()
+
+        i = self.length
+        for column in self.columns:
+            if column.name in values:
+                value = values[column.name]
+            else:
+                value = getattr(obj, column.name, None)
+            self.arrays[column.name][i] = ColumnBuffer._to_column_value(column, value)
+        self.length += 1
+
+    def extend(self, obj: Any, count: int, **values) -> None:
+        """
+        Append the attributes of an object as count new rows.
+        :param obj: object with an attribute for every column
+        :param count: number of rows
+        :param values: values that override the attributes of the object, either a single value or an array with a
+                       value for every row. Arrays of datetime columns hold nanoseconds.
+        """
+        while self.length + count > self.capacity:
+            self._grow()
+
+        start = self.length
+        end = start + count
+        for column in self.columns:
+            if column.name in values:
+                value = values[column.name]
+            else:
+                value = getattr(obj, column.name, None)
+            if not isinstance(value, np.ndarray):
+                value = ColumnBuffer._to_column_value(column, value)
+            self.arrays[column.name][start:end] = value
+        self.length = end
+
+    def get_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Return views of the filled part of the arrays.
+        :return: dictionary with column name and array
+        """
+        return {name: array[:self.length] for name, array in self.arrays.items()}
+
+    def get_dataframe(self) -> DataFrame:
+        """
+        Return a dataframe of the rows. Enums stay numeric codes, datetimes are converted to datetime64.
+        :return: dataframe
+        """
+        data = {}
+        for column in self.columns:
+            array = self.arrays[column.name][:self.length]
+            if column.kind == ColumnKind.Datetime:
+                array = array.view("datetime64[ns]")
+            data[column.name] = array
+        return DataFrame(data)
+
+    def get_rows(self) -> List[Dict[str, Any]]:
+        """
+        Convert the rows back to python values for a database insert. nan and empty datetimes become None,
+        enum codes become the enum members.
+        :return: list of dictionaries with column name and value
+        """
+        names = []
+        values = []
+        for column in self.columns:
+            names.append(column.name)
+            values.append(ColumnBuffer._to_python_values(column, self.arrays[column.name][:self.length]))
+        return [dict(zip(names, row)) for row in zip(*values)]
+
+    def clear(self) -> None:
+        """
+        Remove all rows but keep the allocated arrays.
+        """
+        self.length = 0
+
+    def _grow(self) -> None:
+        """
+        Double the capacity of all arrays.
+        """
+        self.capacity *= 2
+        for column in self.columns:
+            array = ColumnBuffer._allocate(column, self.capacity)
+            array[:self.length] = self.arrays[column.name][:self.length]
+            self.arrays[column.name] = array
+
+    @staticmethod
+    def _allocate(column: ColumnInfo, capacity: int) -> np.ndarray:
+        """
+        Create an empty array for a column.
+        :param column: column info
+        :param capacity: number of rows
+        :return: array
+        """
+        if column.kind == ColumnKind.Datetime:
+            return np.full(capacity, np.iinfo(np.int64).min, dtype=np.int64)
+        elif column.kind == ColumnKind.String:
+            return np.empty(capacity, dtype=object)
+        else:
+            return np.full(capacity, np.nan, dtype=np.float64)
+
+    @staticmethod
+    def _to_python_values(column: ColumnInfo, array: np.ndarray) -> List[Any]:
+        """
+        Convert the stored values of a column to python values.
+        :param column: column info
+        :param array: stored values
+        :return: list of values
+        """
+        if column.kind == ColumnKind.String:
+            return array.tolist()
+        elif column.kind == ColumnKind.Datetime:
+            empty = array == np.iinfo(np.int64).min
+            dates = pd.to_datetime(np.where(empty, 0, array), utc=True).to_pydatetime()
+            return [None if is_empty else date for is_empty, date in zip(empty, dates)]
+
+        empty = np.isnan(array)
+        if column.kind == ColumnKind.Float:
+            return [None if is_empty else value for is_empty, value in zip(empty, array.tolist())]
+        elif column.kind == ColumnKind.Integer:
+            return [None if is_empty else int(value) for is_empty, value in zip(empty, array.tolist())]
+        elif column.kind == ColumnKind.Boolean:
+            return [None if is_empty else bool(value) for is_empty, value in zip(empty, array.tolist())]
+        else:
+            return [None if is_empty else column.enum(int(value)) for is_empty, value in zip(empty, array.tolist())]
+
+    @staticmethod
+    def _to_column_value(column: ColumnInfo, value: Any) -> Any:
+        """
+        Convert a python value to the storage type of the column.
+        :param column: column info
+        :param value: value
+        :return: converted value
+        """
+        if value is None:
+            if column.kind == ColumnKind.Datetime:
+                return np.iinfo(np.int64).min
+            elif column.kind == ColumnKind.String:
+                return None
+            return np.nan
+        if column.kind == ColumnKind.Enum:
+            return getattr(value, "value", value)
+        elif column.kind == ColumnKind.Datetime:
+            return pd.Timestamp(value).value
+        return value
+
+
+class IHistorySink(ABC):
+    """
+    Destination for the orders, executions and the snapshots of every candle of a backtest exchange.
+    """
+
+    @abstractmethod
+    def add_order(self, order: SimOrder) -> None:
+        """
+        Add a new order. The order object stays in use by the exchange, its final state is recorded.
+        :param order: order
+        """
+        pass
+
+    @abstractmethod
+    def add_execution(self, execution: SimExecution) -> None:
+        """
+        Add an execution.
+        :param execution: execution
+        """
+        pass
+
+    @abstractmethod
+    def add_snapshot(self, wallet: SimWallet, position: SimPosition, orders: List[SimOrder],
+                     date: datetime.datetime, timestamp: int) -> None:
+        """
+        Record the state of the wallet, position and open orders after a candle.
+        The objects are copied, since the exchange keeps changing them.
+        :param wallet: wallet
+        :param position: position
+        :param orders: open orders
+        :param date: datetime of the candle
+        :param timestamp: unix timestamp of the candle
+        """
+        pass
+
+    @abstractmethod
+    def add_snapshots(self, wallet: SimWallet, position: SimPosition, orders: List[SimOrder],
+                      dates: np.ndarray, timestamps: np.ndarray, wallet_values: Dict[str, np.ndarray],
+                      position_values: Dict[str, np.ndarray]) -> None:
+        """
+        Record the state of the wallet, position and open orders after several candles in which nothing but the
+        prices changed. The objects hold the state after the last candle.
+        :param wallet: wallet
+        :param position: position
+        :param orders: open orders
+        :param dates: datetimes of the candles in nanoseconds
+        :param timestamps: unix timestamps of the candles
+        :param wallet_values: wallet values that change with every candle, one array per column
+        :param position_values: position values that change with every candle, one array per column
+        """
+        pass
+
+    @abstractmethod
+    def finalize(self) -> None:
+        """
+        Called once after the last candle.
+        """
+        pass
+
+
+class NullHistorySink(IHistorySink):
+    """
+    Discard the history. Used for runs that only need the final state of the exchange.
+    """
+
+    def add_order(self, order: SimOrder) -> None:
+        pass
+
+    def add_execution(self, execution: SimExecution) -> None:
+        pass
+
+    def add_snapshot(self, wallet: SimWallet, position: SimPosition, orders: List[SimOrder],
+                     date: datetime.datetime, timestamp: int) -> None:
+        pass
+
+    def add_snapshots(self, wallet: SimWallet, position: SimPosition, orders: List[SimOrder],
+                      dates: np.ndarray, timestamps: np.ndarray, wallet_values: Dict[str, np.ndarray],
+                      position_values: Dict[str, np.ndarray]) -> None:
+        pass
+
+    def finalize(self) -> None:
+        pass
+
+
+class MemoryHistorySink(IHistorySink):
+    """
+    Keep the history in columnar numpy buffers, one for every table.
+    In delta mode the position and the open orders are only recorded when one of their values changed. When an order
+    leaves the book, a last row with its final status is recorded. The wallet is recorded for every candle and is
+    the timeline to expand the changes on.
+    """
+
+    # Columns that change with every snapshot and are ignored for the change detection
+    delta_ignored_columns = ["datetime", "timestamp", "insert_state"]
+
+    def __init__(self, capacity: int = 1024, mode: HistoryMode = HistoryMode.Snapshot):
+        self.tables: Dict[str, ColumnBuffer] = {}
+        for cls in [Order, Execution, Wallet, Position]:
+            self.tables[cls.__tablename__] = ColumnBuffer(get_table_columns(cls), capacity)
+        self.orders: List[SimOrder] = []
+
+        self.mode: HistoryMode = mode
+        self.last_position: Union[None, Tuple] = None
+        self.last_orders: Dict[str, Tuple] = {}
+        self.book_orders: Dict[str, SimOrder] = {}
+
+    def add_order(self, order: SimOrder) -> None:
+        self.orders.append(order)
+
+    def add_execution(self, execution: SimExecution) -> None:
+        self._append(Execution.__tablename__, execution)
+
+    def add_snapshot(self, wallet: SimWallet, position: SimPosition, orders: List[SimOrder],
+                     date: datetime.datetime, timestamp: int) -> None:
+        self._append(Wallet.__tablename__, wallet, datetime=date, timestamp=timestamp)
+        if self.mode == HistoryMode.Delta:
+            self._add_position_delta(position, date, timestamp)
+            self._add_orders_delta(orders, date, timestamp)
+        else:
+            self._append(Position.__tablename__, position, datetime=date, timestamp=timestamp)
+            for order in orders:
+                self._append(Order.__tablename__, order, insert_state=False, datetime=date, timestamp=timestamp)
+
+    def add_snapshots(self, wallet: SimWallet, position: SimPosition, orders: List[SimOrder],
+                      dates: np.ndarray, timestamps: np.ndarray, wallet_values: Dict[str, np.ndarray],
+                      position_values: Dict[str, np.ndarray]) -> None:
+        count = len(dates)
+        if count == 0:
+            return
+
+        self._extend(Wallet.__tablename__, wallet, count, datetime=dates, timestamp=timestamps, **wallet_values)
+        if self.mode == HistoryMode.Delta:
+            if len(position_values) > 0:
+                self._extend(Position.__tablename__, position, count, datetime=dates, timestamp=timestamps,
+                             **position_values)
+                self.last_position = self._get_delta_values(Position.__tablename__, position)
+            else:
+                self._add_position_delta(position, pd.Timestamp(int(dates[0]), tz="UTC").to_pydatetime(),
+                                         int(timestamps[0]))
+        else:
+            self._extend(Position.__tablename__, position, count, datetime=dates, timestamp=timestamps,
+                         **position_values)
+            if len(orders) > 0:
+                # Same row order as single snapshots, all open orders of a candle after each other
+                book = ColumnBuffer(self.tables[Order.__tablename__].columns, len(orders))
+                for order in orders:
+                    book.append(order, insert_state=False)
+                values = {name: np.tile(array, count) for name, array in book.get_arrays().items()}
+                values["datetime"] = np.repeat(dates, len(orders))
+                values["timestamp"] = np.repeat(timestamps, len(orders))
+                self._extend(Order.__tablename__, None, count * len(orders), **values)
+
+    def _add_position_delta(self, position: SimPosition, date: datetime.datetime, timestamp: int) -> None:
+        """
+        Record the position if it changed since the last recorded row.
+        :param position: position
+        :param date: datetime of the candle
+        :param timestamp: unix timestamp of the candle
+        """
+        values = self._get_delta_values(Position.__tablename__, position)
+        if values != self.last_position:
+            self._append(Position.__tablename__, position, datetime=date, timestamp=timestamp)
+            self.last_position = values
+
+    def _add_orders_delta(self, orders: List[SimOrder], date: datetime.datetime, timestamp: int) -> None:
+        """
+        Record the open orders that are new or changed and a final row for the orders that left the book.
+        :param orders: open orders
+        :param date: datetime of the candle
+        :param timestamp: unix timestamp of the candle
+        """
+        book_orders = {}
+        for order in orders:
+            book_orders[order.order_id] = order
+            values = self._get_delta_values(Order.__tablename__, order)
+            if values != self.last_orders.get(order.order_id):
+                self._append(Order.__tablename__, order, insert_state=False, datetime=date, timestamp=timestamp)
+                self.last_orders[order.order_id] = values
+
+        for order_id, order in self.book_orders.items():
+            if order_id not in book_orders:
+                self._append(Order.__tablename__, order, insert_state=False, datetime=date, timestamp=timestamp)
+                del self.last_orders[order_id]
+        self.book_orders = book_orders
+
+    def _get_delta_values(self, table: str, obj: Any) -> Tuple:
+        """
+        Get the values of an object that are compared in delta mode. nan is replaced with None, so unchanged nan
+        values compare equal.
+        :param table: table name
+        :param obj: object
+        :return: tuple of values
+        """
+        values = []
+        for column in self.tables[table].columns:
+            if column.name not in self.delta_ignored_columns:
+                value = getattr(obj, column.name, None)
+                if isinstance(value, float) and np.isnan(value):
+                    value = None
+                values.append(value)
+        return tuple(values)
+
+    def finalize(self) -> None:
+        """
+        Record the final state of the new orders.
+        """
+        for order in self.orders:
+            self._append(Order.__tablename__, order)
+        self.orders = []
+
+    def _append(self, table: str, obj: Any, **values) -> None:
+        """
+        Append a row to the buffer of a table.
+        :param table: table name
+        :param obj: object with an attribute for every column
+        :param values: values that override the attributes of the object
+        """
+        self.tables[table].append(obj, **values)
+
+    def _extend(self, table: str, obj: Any, count: int, **values) -> None:
+        """
+        Append several rows to the buffer of a table.
+        :param table: table name
+        :param obj: object with an attribute for every column
+        :param count: number of rows
+        :param values: values or arrays of values that override the attributes of the object
+        """
+        self.tables[table].extend(obj, count, **values)
+
+    def get_dataframe(self, table: str) -> DataFrame:
+        """
+        Return the rows of a table.
+        :param table: table name like in the database
+        :return: dataframe
+        """
+        return self.tables[table].get_dataframe()
+
+
+class SqliteHistorySink(MemoryHistorySink):
+    """
+    Write the history to the database of the run.
+    Snapshots and executions are collected in column buffers of a fixed size and written with bulk inserts whenever
+    a buffer is full, so the memory stays bounded. Orders are inserted with their final state at the end.
+    """
+
+    def __init__(self, db_path: Path, chunk_size: int = 10000, mode: HistoryMode = HistoryMode.Snapshot):
+        super().__init__(capacity=chunk_size, mode=mode)
+        self.chunk_size: int = chunk_size
+        self.engine = get_engine(db_path)
+        Base.metadata.create_all(self.engine, checkfirst=True)
+
+    def finalize(self) -> None:
+        super().finalize()
+        for table in self.tables.keys():
+            self._flush(table)
+
+    def _append(self, table: str, obj: Any, **values) -> None:
+        super()._append(table, obj, **values)
+        if len(self.tables[table]) >= self.chunk_size:
+            self._flush(table)
+
+    def _extend(self, table: str, obj: Any, count: int, **values) -> None:
+        super()._extend(table, obj, count, **values)
+        if len(self.tables[table]) >= self.chunk_size:
+            self._flush(table)
+
+    def _flush(self, table: str) -> None:
+        """
+        Insert the rows of a buffer with a single executemany statement and clear it.
+        :param table: table name
+        """
+        buffer = self.tables[table]
+        if len(buffer) > 0:
+            with self.engine.begin() as con:
+                con.execute(Base.metadata.tables[table].insert(), buffer.get_rows())
+            buffer.clear()
+
+
+class FileHistorySink(MemoryHistorySink):
+    """
+    Keep the history in memory and save all columns to a compressed numpy file when the run is finished.
+    The arrays are named "table.column", strings are saved as unicode arrays.
+    """
+
+    def __init__(self, path: Path, mode: HistoryMode = HistoryMode.Snapshot):
+        super().__init__(mode=mode)
+        self.path: Path = path
+
+    def finalize(self) -> None:
+        super().finalize()
+
+        arrays = {}
+        for table, buffer in self.tables.items():
+            for column in buffer.columns:
+                array = buffer.arrays[column.name][:buffer.length]
+                if column.kind == ColumnKind.String:
+                    array = np.array(["" if value is None else str(value) for value in array], dtype=str)
+                arrays[f"{table}.{column.name}"] = array
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(self.path, **arrays)
+
+
+class HistorySinkResolver():
+    @classmethod
+    def load_history_sink(cls, sink_type: str, history_mode: str, run_settings: RunSettings,
+                          subaccount_id: int) -> IHistorySink:
+        """
+        Create the history sink for a backtest exchange.
+        :param sink_type: value of HistorySinkType
+        :param history_mode: value of HistoryMode
+        :param run_settings: run settings with database path and run dir
+        :param subaccount_id: database id of subaccount, used for the file name of file sinks
+        :return: history sink
+        """
+        sink = HistorySinkType.from_str(sink_type)
+        mode = HistoryMode.from_str(history_mode)
+        if sink == HistorySinkType.Null:
+            return NullHistorySink()
+        elif sink == HistorySinkType.Memory:
+            return MemoryHistorySink(mode=mode)
+        elif sink == HistorySinkType.Sqlite:
+            return SqliteHistorySink(run_settings.db_path, mode=mode)
+        elif sink == HistorySinkType.File:
+            return FileHistorySink(Path(os.path.join(run_settings.run_dir, f"history_{subaccount_id}.npz")), mode=mode)
+        else:
+            raise UnsupportedHistorySink()
@@ -155,7 +155,8 @@ class IExchange(ABC):
         :param reduce_only: order can only reduce positon
         :param post_only: order will only execute if it goes into orderbook and doesn't fill immidiatly
         :param take_profit: when executed, a new take profit order will be opened at this price
-        :param stop_loss: when executed, a new stop loss order will be opened at this price
+        :param stop_loss: when executed, a new stop loss order will be opened at this price, it cancels the take profit
+                          when it is executed and vice versa
         :return:
         """
         return None
@@ -0,0 +1,159 @@
+import bisect
+import logging
+from typing import Dict, List, Tuple, Union
+
+from kektrade.exchange.backtest_types import *
+
+logger = logging.getLogger(__name__)
+
+
+class OrderBook():
+    """
+    Open orders of the backtest exchange. Orders are indexed by their id, limit and stop orders are additionally kept
+    in price-sorted ladders, so the orders a candle can fill are found with a range query instead of a full scan.
+    Bids are limit orders with positive contracts, asks limit orders with negative contracts. Stop orders are kept in
+    separate trigger ladders for buys and sells.
+    The ladders hold (price, order_id) tuples, equal prices are ordered by the id. The key of every order is kept,
+    since the exchange changes the price and contracts of an order while it executes it.
+    """
+
+    def __init__(self):
+        self.orders: Dict[int, SimOrder] = {}
+        self.bids: List[Tuple[float, int]] = []
+        self.asks: List[Tuple[float, int]] = []
+        self.buy_stops: List[Tuple[float, int]] = []
+        self.sell_stops: List[Tuple[float, int]] = []
+        self.ladder_keys: Dict[int, Tuple[List[Tuple[float, int]], Tuple[float, int]]] = {}
+        self.market_orders: Dict[int, SimOrder] = {}
+        self.reduce_only_orders: Dict[int, SimOrder] = {}
+        self.canceled_orders: Dict[int, SimOrder] = {}
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def __contains__(self, order: SimOrder) -> bool:
+        return order.order_id in self.orders
+
+    def get(self, order_id: int) -> Union[None, SimOrder]:
+        """
+        Get an open order by its id.
+        :param order_id: order id
+        :return: order or None if there is no open order with this id
+        """
+        return self.orders.get(order_id)
+
+    def get_orders(self) -> List[SimOrder]:
+        """
+        Get all open orders in the order they were added.
+        :return: list of orders
+        """
+        return list(self.orders.values())
+
+    def add(self, order: SimOrder) -> None:
+        """
+        Add a new open order.
+        :param order: order
+        """
+        self.orders[order.order_id] = order
+        if order.order_type == ORDER_TYPE_MARKET:
+            self.market_orders[order.order_id] = order
+        else:
+            self._add_to_ladder(order)
+        if order.reduce_only:
+            self.reduce_only_orders[order.order_id] = order
+
+    def remove(self, order: SimOrder) -> None:
+        """
+        Remove an order after it was executed or canceled.
+        :param order: order
+        """
+        del self.orders[order.order_id]
+        if order.order_type == ORDER_TYPE_MARKET:
+            del self.market_orders[order.order_id]
+        else:
+            self._remove_from_ladder(order)
+        self.reduce_only_orders.pop(order.order_id, None)
+        self.canceled_orders.pop(order.order_id, None)
+
+    def set_price(self, order: SimOrder, price: float) -> None:
+        """
+        Change the price of an order and move it to its new place in the ladder.
+        :param order: order
+        :param price: new price
+        """
+        if order.order_type == ORDER_TYPE_MARKET:
+            order.price = price
+        else:
+            self._remove_from_ladder(order)
+            order.price = price
+            self._add_to_ladder(order)
+
+    def cancel(self, order: SimOrder) -> None:
+        """
+        Mark an order as canceled. It stays in the book until the exchange processes the orders of the next candle.
+        :param order: order
+        """
+        order.status = ORDER_STATUS_CANCELED
+        self.canceled_orders[order.order_id] = order
+
+    def cancel_all(self) -> None:
+        """
+        Mark all orders as canceled.
+        """
+        for order in self.orders.values():
+            order.status = ORDER_STATUS_CANCELED
+        self.canceled_orders = dict(self.orders)
+
+    def get_in_range(self, low: float, high: float) -> List[SimOrder]:
+        """
+        Get the limit orders with a price strictly between low and high.
+        :param low: lower bound
+        :param high: upper bound
+        :return: list of orders
+        """
+        result = []
+        for ladder in (self.bids, self.asks):
+            start = bisect.bisect_right(ladder, (low, float("inf")))
+            end = bisect.bisect_left(ladder, (high, float("-inf")))
+            for _, order_id in ladder[start:end]:
+                result.append(self.orders[order_id])
+        return result
+
+    def get_triggered_stops(self, low: float, high: float) -> List[SimOrder]:
+        """
+        Get the stop orders that are triggered by a candle. Buy stops trigger when the high reaches their price, sell
+        stops when the low reaches it. Stops the price already gapped over are included.
+        :param low: low price
+        :param high: high price
+        :return: list of orders
+        """
+        result = []
+        end = bisect.bisect_right(self.buy_stops, (high, float("inf")))
+        for _, order_id in self.buy_stops[:end]:
+            result.append(self.orders[order_id])
+        start = bisect.bisect_left(self.sell_stops, (low, float("-inf")))
+        for _, order_id in self.sell_stops[start:]:
+            result.append(self.orders[order_id])
+        return result
+
+    def get_market_orders(self) -> List[SimOrder]:
+        return list(self.market_orders.values())
+
+    def get_reduce_only_orders(self) -> List[SimOrder]:
+        return list(self.reduce_only_orders.values())
+
+    def get_canceled_orders(self) -> List[SimOrder]:
+        return list(self.canceled_orders.values())
+
+    def _add_to_ladder(self, order: SimOrder) -> None:
+        if order.order_type == ORDER_TYPE_STOP_MARKET:
+            ladder = self.buy_stops if order.contracts > 0 else self.sell_stops
+        else:
+            ladder = self.bids if order.contracts > 0 else self.asks
+        key = (order.price, order.order_id)
+        bisect.insort(ladder, key)
+        self.ladder_keys[order.order_id] = (ladder, key)
+
+    def _remove_from_ladder(self, order: SimOrder) -> None:
+        ladder, key = self.ladder_keys.pop(order.order_id)
+        del ladder[bisect.bisect_left(ladder, key)]
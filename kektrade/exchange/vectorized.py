@@ -0,0 +1,450 @@
+import logging
+from abc import ABC, abstractmethod
+from typing import List, NamedTuple, Union
+
+import numpy as np
+from pandas import DataFrame
+
+from kektrade.exceptions import ExchangeException
+from kektrade.exchange.backtest import Backtest
+from kektrade.exchange.backtest_inverse import BacktestInverse
+from kektrade.exchange.backtest_linear import BacktestLinear
+from kektrade.exchange.event_index import CandleEventIndex
+
+logger = logging.getLogger(__name__)
+
+# Float or array of floats
+Values = Union[float, np.ndarray]
+
+
+class StrategySignals(NamedTuple):
+    """
+    Market orders of a strategy as arrays with an entry for every candle of the dataframe.
+    entry: 1 to go long, -1 to go short, 0 for nothing. An entry in the direction of the position adds size contracts
+    to it, an entry against the position or together with an exit reverses it to size contracts.
+    exit: True to close the position with a reduce only order.
+    size: absolute amount of contracts of an entry, a single value for all candles or an array.
+    size_percentage: optional, replaces size with the contracts exchange.get_contracts_percentage(size_percentage)
+    returns on the first candle, for strategies that calculate their order size once in tick.
+    """
+    entry: np.ndarray
+    exit: np.ndarray
+    size: Union[float, np.ndarray]
+    size_percentage: Union[None, float] = None
+
+
+class VectorizedResult(NamedTuple):
+    """
+    Metrics and wallet curve of a vectorized backtest. The arrays have an entry for every candle, the candles the
+    backtest exchange doesn't process are nan.
+    """
+    account_balance: float
+    max_drawdown: float
+    trades: int
+    margin_balance: np.ndarray
+    contracts: np.ndarray
+
+
+class VectorizedBacktest(ABC):
+    """
+    Backtest of strategy signals with market orders only. It gives the same results as the event loop with the
+    backtest exchange and a tick function that opens the orders of the signals, but only the candles with a signal
+    are visited one by one. Funding, liquidation and the wallet curve of the candles in between are calculated with
+    numpy, since the position doesn't change there.
+    Like in the backtest exchange an order opened on a candle is executed on the open of the next one, after the
+    funding and liquidation of that candle.
+    """
+
+    def __init__(self, exchange: Backtest, initial_deposit: float):
+        """
+        Copy the parameters of a backtest exchange.
+        :param exchange: backtest exchange with the parameters from the config
+        :param initial_deposit: deposit
+        """
+        if exchange.cross_margin:
+            raise ExchangeException("not implemented")
+
+        self.initial_deposit: float = initial_deposit
+        self.unlimited_funds: bool = exchange.unlimited_funds
+        self.leverage: int = exchange.leverage
+        self.maintenance_margin_rate: float = exchange.maintenance_margin_rate
+        self.taker_fee: float = exchange.taker_fee
+
+        # Leverage of the position, the exchange starts with 1 until the strategy calls set_leverage
+        self.position_leverage: int = 1
+
+    def run(self, dataframe: DataFrame, signals: StrategySignals) -> VectorizedResult:
+        """
+        Simulate the signals on the candles of the dataframe.
+        :param dataframe: dataframe with open, high, low, close and optionally funding_rate
+        :param signals: signals of the strategy
+        :return: metrics and wallet curve
+        """
+        self._set_dataframe(dataframe)
+        length = self.length
+        last = length - 2
+
+        entry = np.sign(np.asarray(signals.entry, dtype=np.float64))
+        exits = np.asarray(signals.exit, dtype=bool)
+        size = np.broadcast_to(np.asarray(signals.size, dtype=np.float64), (length,))
+        if signals.size_percentage is not None and length > 0:
+            # Like get_contracts_percentage of the backtest exchange with the deposit as account balance
+            price_one_contract = float(self._get_order_initial_margin(1, self.close_values[0]))
+            size = np.full(length, self.initial_deposit * (signals.size_percentage / 100) / price_one_contract)
+
+        self.contracts: float = 0
+        self.price: float = 0
+        self.total_rpnl: float = 0
+        self.trades: int = 0
+        self.rpnl_values: np.ndarray = np.zeros(length)
+        self.change_positions: List[int] = [0]
+        self.change_contracts: List[float] = [0]
+        self.change_prices: List[float] = [0]
+
+        # Candle that is processed next and the order that is executed on it
+        self.cursor: int = 1
+        self.pending: Union[None, tuple] = None
+
+        for i in np.flatnonzero((entry != 0) | exits):
+            # Orders of the last two candles aren't executed anymore
+            if i > last - 1:
+                break
+
+            self._advance(i)
+            self._open_order(i, entry[i], exits[i], size[i])
+        self._advance(last)
+
+        return self._get_result()
+
+    def _set_dataframe(self, dataframe: DataFrame) -> None:
+        self.length: int = len(dataframe.index)
+        self.open_values: np.ndarray = dataframe["open"].to_numpy(dtype=np.float64)
+        self.high_values: np.ndarray = dataframe["high"].to_numpy(dtype=np.float64)
+        self.low_values: np.ndarray = dataframe["low"].to_numpy(dtype=np.float64)
+        self.close_values: np.ndarray = dataframe["close"].to_numpy(dtype=np.float64)
+        if "funding_rate" in dataframe.columns:
+            self.funding_rate_values: np.ndarray = np.nan_to_num(
+                dataframe["funding_rate"].to_numpy(dtype=np.float64), nan=0)
+        else:
+            self.funding_rate_values: np.ndarray = np.zeros(self.length)
+        self.event_index: CandleEventIndex = CandleEventIndex(self.low_values, self.high_values)
+
+    def _advance(self, end: int) -> None:
+        """
+        Process the candles up to end, like after_tick of the backtest exchange.
+        :param end: last candle to process
+        """
+        if self.pending is not None:
+            self._process_candles(self.cursor, self.cursor)
+            self._execute_pending()
+            self.cursor += 1
+
+        if self.cursor <= end:
+            self._process_candles(self.cursor, end)
+            self.cursor = end + 1
+
+    def _process_candles(self, start: int, end: int) -> None:
+        """
+        Pay funding and check the liquidation for candles in which the position doesn't change otherwise.
+        :param start: first candle
+        :param end: last candle
+        """
+        if self.contracts == 0:
+            return
+
+        liquidation_price = float(self._get_liquidation_price(self.contracts, self.price))
+        if self.contracts > 0:
+            liquidation = self.event_index.first_low_below(start, liquidation_price)
+        else:
+            liquidation = self.event_index.first_high_above(start, liquidation_price)
+
+        # Funding is paid before the liquidation check of the same candle
+        funding_end = min(end, liquidation) + 1
+        funding = self._get_funding_values(self.contracts, self.close_values[start:funding_end],
+                                           self.funding_rate_values[start:funding_end])
+        self.rpnl_values[start:funding_end] += funding
+        self.total_rpnl += funding.sum()
+
+        if liquidation <= end:
+            cost = -float(self._get_position_margin_values(self.contracts, self.price,
+                                                           self.open_values[liquidation]))
+            self.rpnl_values[liquidation] += cost
+            self.total_rpnl += cost
+            self._set_position(liquidation, 0, 0)
+
+    def _open_order(self, i: int, entry: float, exit_signal: bool, size: float) -> None:
+        """
+        Open the order of the signals of a candle, if it passes the balance check of the backtest exchange.
+        :param i: candle
+        :param entry: entry signal
+        :param exit_signal: exit signal
+        :param size: size of an entry
+        """
+        if entry != 0:
+            if exit_signal or self.contracts * entry < 0:
+                target = entry * size
+            else:
+                target = self.contracts + entry * size
+            contracts = target - self.contracts
+            reduce_only = False
+        elif exit_signal and self.contracts != 0:
+            contracts = -self.contracts
+            reduce_only = True
+        else:
+            return
+
+        if contracts == 0:
+            return
+
+        if not self._check_enough_balance(i, contracts, reduce_only):
+            return
+        self.pending = (contracts, reduce_only)
+
+    def _execute_pending(self) -> None:
+        """
+        Execute the pending order on the open of the current candle.
+        """
+        i = self.cursor
+        contracts, reduce_only = self.pending
+        self.pending = None
+
+        if not self.unlimited_funds and self._get_available_balance(i, contracts) < 0:
+            if not self._check_enough_balance(i, contracts, reduce_only):
+                return
+        if reduce_only and ((contracts > 0 and self.contracts > 0) or self.contracts == 0):
+            return
+
+        if reduce_only and abs(contracts) > abs(self.contracts) and contracts * self.contracts < 0:
+            contracts = -self.contracts
+
+        price = self.open_values[i]
+        self.trades += 1
+
+        # Reversal, reduce to zero first
+        if (self.contracts > 0 and self.contracts + contracts < 0) or \
+                (self.contracts < 0 and self.contracts + contracts > 0):
+            reduction = -self.contracts
+            contracts += self.contracts
+            self._reduce(i, reduction, price)
+
+        if abs(self.contracts + contracts) > abs(self.contracts):
+            self._add_rpnl(i, self._get_fee(contracts, price))
+            if self.contracts == 0:
+                self._set_position(i, contracts, price)
+            else:
+                aep = (self.contracts + contracts) / ((self.contracts / self.price) + (contracts / price))
+                self._set_position(i, self.contracts + contracts, aep)
+        elif abs(self.contracts + contracts) < abs(self.contracts):
+            self._reduce(i, contracts, price)
+
+    def _reduce(self, i: int, contracts: float, price: float) -> None:
+        """
+        Reduce the position, the realized pnl is calculated for the whole position like in the backtest exchange.
+        :param i: candle
+        :param contracts: contracts of the order
+        :param price: execution price
+        """
+        rpnl = self.contracts * ((1 / self.price) - (1 / self.open_values[i]))
+        self._add_rpnl(i, self._get_fee(contracts, price) + rpnl)
+        contracts = self.contracts + contracts
+        self._set_position(i, contracts, self.price if contracts != 0 else 0)
+
+    def _add_rpnl(self, i: int, value: float) -> None:
+        self.rpnl_values[i] += value
+        self.total_rpnl += value
+
+    def _set_position(self, i: int, contracts: float, price: float) -> None:
+        self.contracts = contracts
+        self.price = price
+        self.change_positions.append(i)
+        self.change_contracts.append(contracts)
+        self.change_prices.append(price)
+
+    def _check_enough_balance(self, i: int, contracts: float, reduce_only: bool) -> bool:
+        """
+        Check if an order that isn't reducing the position can be paid with the available balance.
+        :param i: candle
+        :param contracts: contracts of the order
+        :param reduce_only: reduce only order
+        :return: bool
+        """
+        reducing = reduce_only or abs(self.contracts + contracts) < abs(self.contracts)
+        if not reducing and not self.unlimited_funds:
+            order_cost = float(self._get_order_initial_margin(contracts, self.close_values[i]))
+            if order_cost > self._get_available_balance(i):
+                return False
+        return True
+
+    def _get_available_balance(self, i: int, order_contracts: float = 0) -> float:
+        """
+        Available balance on a candle.
+        :param i: candle
+        :param order_contracts: contracts of an open market order
+        :return: available balance
+        """
+        balance = self.initial_deposit + self.total_rpnl
+        if self.contracts != 0:
+            open = self.open_values[i]
+            balance += self._get_upnl_values(self.contracts, self.price, open)
+            balance -= float(self._get_position_margin_values(self.contracts, self.price, open))
+        if order_contracts != 0:
+            balance -= self._get_order_initial_margin(order_contracts, self.close_values[i])
+        return balance
+
+    def _get_result(self) -> VectorizedResult:
+        """
+        Calculate the wallet curve of the processed candles from the position changes and the realized pnl.
+        :return: result
+        """
+        length = self.length
+        last = length - 2
+        candles = np.arange(length)
+        change = np.searchsorted(np.asarray(self.change_positions), candles, side="right") - 1
+        contracts = np.asarray(self.change_contracts)[change]
+        prices = np.asarray(self.change_prices)[change]
+
+        account_balance = self.initial_deposit + self.total_rpnl
+        if self.unlimited_funds:
+            account_balance = self.initial_deposit
+            margin_balance = np.full(length, self.initial_deposit)
+        else:
+            upnl = np.zeros(length)
+            position_open = contracts != 0
+            upnl[position_open] = self._get_upnl_values(contracts[position_open], prices[position_open],
+                                                        self.open_values[position_open])
+            margin_balance = self.initial_deposit + np.cumsum(self.rpnl_values) + upnl
+
+        max_drawdown = 0
+        if last >= 1:
+            equity = margin_balance[1:last + 1]
+            peaks = np.maximum.accumulate(np.maximum(equity, 0))
+            if (peaks > 0).any():
+                drawdowns = np.where(peaks > 0, (peaks - equity) / np.where(peaks > 0, peaks, 1), 0)
+                max_drawdown = float(drawdowns.max())
+
+        processed = (candles >= 1) & (candles <= last)
+        return VectorizedResult(
+            account_balance=float(account_balance),
+            max_drawdown=max_drawdown,
+            trades=self.trades,
+            margin_balance=np.where(processed, margin_balance, np.nan),
+            contracts=np.where(processed, contracts, np.nan)
+        )
+
+    # The formulas work elementwise on floats and arrays, the batch backtest uses them for all parameter combinations
+
+    def _get_upnl_values(self, contracts: Values, price: Values, open_values: Values) -> Values:
+        return contracts * ((1 / price) - (1 / open_values))
+
+    def _get_fee(self, contracts: Values, price: Values) -> Values:
+        return np.abs(contracts / price) * self.taker_fee
+
+    def _get_position_margin_values(self, contracts: Values, price: Values, open_values: Values) -> Values:
+        """
+        Position margin of the backtest exchange, the initial margin plus the fee to close at the bankruptcy price.
+        :param contracts: contracts of the position
+        :param price: entry price of the position
+        :param open_values: open prices
+        :return: position margin
+        """
+        if self.position_leverage == 1:
+            bankruptcy_price = self._get_liquidation_price(contracts, price)
+        else:
+            bankruptcy_price = self._get_bankruptcy_price_values(contracts, open_values)
+        return self._get_position_initial_margin(contracts, price) + \
+            self._get_close_fee_values(contracts, bankruptcy_price)
+
+    @abstractmethod
+    def _get_order_initial_margin(self, contracts: Values, price: Values) -> Values:
+        pass
+
+    @abstractmethod
+    def _get_position_initial_margin(self, contracts: Values, price: Values) -> Values:
+        pass
+
+    @abstractmethod
+    def _get_bankruptcy_price_values(self, contracts: Values, open_values: Values) -> Values:
+        pass
+
+    @abstractmethod
+    def _get_close_fee_values(self, contracts: Values, bankruptcy_price: Values) -> Values:
+        pass
+
+    @abstractmethod
+    def _get_liquidation_price(self, contracts: Values, price: Values) -> Values:
+        pass
+
+    @abstractmethod
+    def _get_funding_values(self, contracts: Values, close_values: Values, rate_values: Values) -> Values:
+        pass
+
+
+class VectorizedLinear(VectorizedBacktest):
+    """
+    Formulas of BacktestLinear.
+    """
+
+    def _get_order_initial_margin(self, contracts: Values, price: Values) -> Values:
+        return np.abs(contracts * price) / self.leverage
+
+    def _get_position_initial_margin(self, contracts: Values, price: Values) -> Values:
+        return np.abs(contracts * price) / self.position_leverage
+
+    def _get_bankruptcy_price_values(self, contracts: Values, open_values: Values) -> Values:
+        imr = 1 / self.leverage
+        return np.where(contracts > 0, open_values * (1 - imr), open_values * (1 + imr))
+
+    def _get_close_fee_values(self, contracts: Values, bankruptcy_price: Values) -> Values:
+        return np.abs(contracts * bankruptcy_price) * self.taker_fee
+
+    def _get_liquidation_price(self, contracts: Values, price: Values) -> Values:
+        imr = 1 / self.leverage
+        return np.where(contracts > 0, price * (1 - imr + self.maintenance_margin_rate),
+                        price * (1 + imr - self.maintenance_margin_rate))
+
+    def _get_funding_values(self, contracts: Values, close_values: Values, rate_values: Values) -> Values:
+        funding_fee = np.abs(contracts) * close_values * rate_values
+        return np.where(contracts * rate_values > 0, -funding_fee, funding_fee)
+
+
+class VectorizedInverse(VectorizedBacktest):
+    """
+    Formulas of BacktestInverse.
+    """
+
+    def _get_order_initial_margin(self, contracts: Values, price: Values) -> Values:
+        return np.abs(contracts) / (self.leverage * price)
+
+    def _get_position_initial_margin(self, contracts: Values, price: Values) -> Values:
+        return np.abs(contracts) / (price * self.position_leverage)
+
+    def _get_bankruptcy_price_values(self, contracts: Values, open_values: Values) -> Values:
+        leverage = self.position_leverage
+        return np.where(contracts > 0, open_values * (leverage / (leverage + 1)),
+                        open_values * (leverage / (leverage - 1)))
+
+    def _get_close_fee_values(self, contracts: Values, bankruptcy_price: Values) -> Values:
+        return np.abs(contracts / bankruptcy_price) * self.taker_fee
+
+    def _get_liquidation_price(self, contracts: Values, price: Values) -> Values:
+        leverage = self.position_leverage
+        return np.where(contracts > 0, (price * leverage) / (leverage + 1 - (self.maintenance_margin_rate * leverage)),
+                        (price * leverage) / (leverage - 1 + (self.maintenance_margin_rate * leverage)))
+
+    def _get_funding_values(self, contracts: Values, close_values: Values, rate_values: Values) -> Values:
+        funding_fee = np.abs(np.abs(contracts) / close_values * rate_values)
+        return np.where(contracts * rate_values > 0, -funding_fee, funding_fee)
+
+
+def load_vectorized_backtest(exchange: Backtest, initial_deposit: float) -> VectorizedBacktest:
+    """
+    Get the vectorized backtest with the formulas and parameters of a backtest exchange.
+    :param exchange: backtest exchange
+    :param initial_deposit: deposit
+    :return: vectorized backtest
+    """
+    if isinstance(exchange, BacktestLinear):
+        return VectorizedLinear(exchange, initial_deposit)
+    elif isinstance(exchange, BacktestInverse):
+        return VectorizedInverse(exchange, initial_deposit)
+    raise ExchangeException(f"no vectorized backtest for {exchange.__class__.__name__}")
@@ -0,0 +1,158 @@
+import logging
+from typing import NamedTuple, Tuple, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class RollingStats(NamedTuple):
+    sum: np.ndarray
+    mean: np.ndarray
+    std: np.ndarray
+
+
+class RollingWindows():
+    """
+    Rolling sums, means and standard deviations of many window lengths at once. The prefix sums of the values and
+    their squares are calculated once, the statistics of every window are then the difference of two prefix sums.
+    For a 1D series the results have a row for every value and a column for every window. A 2D matrix is rolled
+    column by column with a single window.
+    Like pandas rolling, nan values are skipped and the result is nan where the window has less than min_periods
+    values.
+    To keep the prefix sums precise over long histories, the values are centered on their mean and the rounding
+    error of every addition is summed separately and added back.
+    """
+
+    def __init__(self, values: np.ndarray):
+        """
+        :param values: 1D series or 2D matrix with a column per series
+        """
+        values = np.asarray(values, dtype=np.float64)
+        self.length: int = values.shape[0]
+        self.matrix: bool = values.ndim == 2
+
+        known = ~np.isnan(values)
+        self.offset: Union[float, np.ndarray] = 0
+        if known.any():
+            self.offset = np.nanmean(values, axis=0) if self.matrix else float(np.nanmean(values))
+        self.offset = np.nan_to_num(self.offset)
+        self.centered: np.ndarray = np.where(known, values - self.offset, 0)
+
+        # Counts are whole numbers and exact without compensation
+        self.counts: Tuple[np.ndarray, np.ndarray] = _prefix_sum(known.astype(np.float64), compensated=False)
+        self.sums: Tuple[np.ndarray, np.ndarray] = _prefix_sum(self.centered)
+        # Only needed for the standard deviation, see _get_sums_squares
+        self.sums_squares: Union[None, Tuple[np.ndarray, np.ndarray]] = None
+
+    def sum(self, windows: Union[int, np.ndarray], min_periods: Union[None, int] = None) -> np.ndarray:
+        """
+        :param windows: window lengths, a single window for a matrix
+        :param min_periods: least values in a window, default the window length
+        :return: rolling sums
+        """
+        count = self._window_sums(self.counts, windows)
+        total = self._window_sums(self.sums, windows) + (count * self.offset)
+        return np.where(self._valid(count, windows, min_periods), total, np.nan)
+
+    def mean(self, windows: Union[int, np.ndarray], min_periods: Union[None, int] = None) -> np.ndarray:
+        """
+        :param windows: window lengths, a single window for a matrix
+        :param min_periods: least values in a window, default the window length
+        :return: rolling means
+        """
+        count = self._window_sums(self.counts, windows)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = (self._window_sums(self.sums, windows) / count) + self.offset
+        return np.where(self._valid(count, windows, min_periods), mean, np.nan)
+
+    def std(self, windows: Union[int, np.ndarray], ddof: int = 0, min_periods: Union[None, int] = None) -> np.ndarray:
+        """
+        :param windows: window lengths, a single window for a matrix
+        :param ddof: delta degrees of freedom, 0 for the population standard deviation like talib.STDDEV
+        :param min_periods: least values in a window, default the window length
+        :return: rolling standard deviations
+        """
+        return self.stats(windows, ddof=ddof, min_periods=min_periods).std
+
+    def stats(self, windows: Union[int, np.ndarray], ddof: int = 0,
+              min_periods: Union[None, int] = None) -> RollingStats:
+        """
+        Sum, mean and standard deviation from the same window sums.
+        :param windows: window lengths, a single window for a matrix
+        :param ddof: delta degrees of freedom of the standard deviation
+        :param min_periods: least values in a window, default the window length
+        :return: rolling statistics
+        """
+        count = self._window_sums(self.counts, windows)
+        total = self._window_sums(self.sums, windows)
+        total_squares = self._window_sums(self._get_sums_squares(), windows)
+        valid = self._valid(count, windows, min_periods)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / count
+            variance = np.maximum(total_squares - (total * mean), 0) / (count - ddof)
+        return RollingStats(
+            sum=np.where(valid, total + (count * self.offset), np.nan),
+            mean=np.where(valid, mean + self.offset, np.nan),
+            std=np.where(valid & (count > ddof), np.sqrt(variance), np.nan)
+        )
+
+    def _get_sums_squares(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.sums_squares is None:
+            self.sums_squares = _prefix_sum(self.centered * self.centered)
+        return self.sums_squares
+
+    def _window_sums(self, prefix: Tuple[np.ndarray, np.ndarray], windows: Union[int, np.ndarray]) -> np.ndarray:
+        """
+        Sums over the windows that end on every row from compensated prefix sums.
+        :param prefix: prefix sums and their rounding errors from _prefix_sum
+        :param windows: window lengths, a single window for a matrix
+        :return: window sums
+        """
+        sums, errors = prefix
+        rows = np.arange(self.length)
+        if self.matrix:
+            start = np.maximum(rows + 1 - int(windows), 0)
+            return (sums[1:] - sums[start]) + (errors[1:] - errors[start])
+
+        windows = np.asarray(windows, dtype=np.int64).reshape(1, -1)
+        start = np.maximum(rows[:, None] + 1 - windows, 0)
+        end = rows[:, None] + 1
+        return (sums[end] - sums[start]) + (errors[end] - errors[start])
+
+    def _valid(self, count: np.ndarray, windows: Union[int, np.ndarray], min_periods: Union[None, int]) -> np.ndarray:
+        if min_periods is None:
+            min_periods = windows if self.matrix else np.asarray(windows).reshape(1, -1)
+        return count >= np.maximum(min_periods, 1)
+
+
+def rolling_stats(values: np.ndarray, windows: np.ndarray, ddof: int = 0) -> RollingStats:
+    """
+    Rolling sum, mean and standard deviation of a series for many window lengths, see RollingWindows.
+    :param values: series
+    :param windows: window lengths
+    :param ddof: delta degrees of freedom of the standard deviation
+    :return: matrices with a row for every value and a column for every window
+    """
+    return RollingWindows(values).stats(windows, ddof=ddof)
+
+
+def _prefix_sum(values: np.ndarray, compensated: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Prefix sums along the first axis with a leading zero row. The rounding error of every addition is taken exactly
+    with the TwoSum algorithm and summed up separately, the sum of both is the compensated prefix sum.
+    :param values: values
+    :param compensated: calculate the rounding errors, otherwise they are 0
+    :return: prefix sums and prefix sums of the rounding errors
+    """
+    zeros = np.zeros((1,) + values.shape[1:])
+    sums = np.cumsum(values, axis=0)
+    if not compensated:
+        prefix = np.concatenate([zeros, sums])
+        return prefix, np.zeros_like(prefix)
+
+    previous = np.concatenate([zeros, sums[:-1]])
+    added = sums - previous
+    errors = (previous - (sums - added)) + (values - added)
+    return np.concatenate([zeros, sums]), np.concatenate([zeros, np.cumsum(errors, axis=0)])
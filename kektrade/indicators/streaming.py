@@ -0,0 +1,489 @@
+import bisect
+import inspect
+import json
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingIndicator(ABC):
+    """
+    Indicator that is updated with one value per candle in O(1), independent of the length of the history.
+    The history is fed at once with initialize, which calculates all outputs vectorized and keeps the state of the
+    last candle. The outputs are the same as the ones of the talib function with the same name, nan until enough
+    values were seen.
+    The state can be saved with get_state and restored with set_state, e.g. to continue after a restart.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget all values.
+        """
+        self.value: float = np.nan
+        self.count: int = 0
+
+    @abstractmethod
+    def update(self, value: float) -> float:
+        """
+        Add the value of the next candle.
+        :param value: input value, e.g. the close price
+        :return: indicator value of the candle
+        """
+        pass
+
+    def update_many(self, values: np.ndarray) -> np.ndarray:
+        """
+        Add the values of several candles one after another.
+        :param values: input values
+        :return: indicator values of the candles
+        """
+        return np.array([self.update(value) for value in values], dtype=np.float64)
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        """
+        Reset the indicator and add the whole history at once.
+        :param values: input values
+        :return: indicator values of all candles
+        """
+        self.reset()
+        return self.update_many(values)
+
+    def get_parameters(self) -> Dict[str, Any]:
+        """
+        :return: the arguments the indicator was created with
+        """
+        names = inspect.signature(type(self).__init__).parameters
+        return {name: getattr(self, name) for name in names if name != "self"}
+
+    def get_state(self) -> Dict[str, Any]:
+        """
+        :return: state of the indicator with plain python types, it can be written as json
+        """
+        state = {}
+        for key, value in self.__dict__.items():
+            if isinstance(value, (deque, list)):
+                value = [float(x) for x in value]
+            elif isinstance(value, np.floating):
+                value = float(value)
+            state[key] = value
+        return state
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        """
+        Restore a state from get_state of an indicator with the same parameters.
+        :param state: state
+        """
+        for key, value in state.items():
+            if isinstance(getattr(self, key, None), deque):
+                value = deque(value)
+            setattr(self, key, value)
+
+
+class SMA(StreamingIndicator):
+    """
+    Simple moving average with a running sum over the window, like talib.SMA.
+    """
+
+    def __init__(self, timeperiod: int = 30):
+        self.timeperiod: int = timeperiod
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.window: Deque[float] = deque()
+        self.total: float = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        self.window.append(value)
+        self.total += value
+        if len(self.window) > self.timeperiod:
+            self.total -= self.window.popleft()
+        if len(self.window) == self.timeperiod:
+            self.value = self.total / self.timeperiod
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        output = pd.Series(values).rolling(self.timeperiod).mean().to_numpy()
+        _initialize_window(self, values, output)
+        return output
+
+
+class EMA(StreamingIndicator):
+    """
+    Exponential moving average, seeded with the simple moving average of the first values like talib.EMA.
+    """
+
+    def __init__(self, timeperiod: int = 30):
+        self.timeperiod: int = timeperiod
+        self.k: float = 2 / (timeperiod + 1)
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.total: float = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        if self.count < self.timeperiod:
+            self.total += value
+        elif self.count == self.timeperiod:
+            self.total += value
+            self.value = self.total / self.timeperiod
+        else:
+            self.value = ((value - self.value) * self.k) + self.value
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        output = np.full(len(values), np.nan)
+        self.count = len(values)
+        self.total = float(values[:self.timeperiod].sum())
+        if self.count >= self.timeperiod:
+            output[self.timeperiod - 1:] = _seeded_ema(self.total / self.timeperiod, values[self.timeperiod:], self.k)
+            self.value = float(output[-1])
+        return output
+
+
+class RSI(StreamingIndicator):
+    """
+    Relative strength index with Wilder's smoothing. The average gain and loss are seeded with the simple average of
+    the first changes like talib.RSI.
+    """
+
+    def __init__(self, timeperiod: int = 14):
+        self.timeperiod: int = timeperiod
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.last: float = np.nan
+        self.avg_gain: float = 0
+        self.avg_loss: float = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        if self.count == 1:
+            self.last = value
+            return self.value
+
+        change = value - self.last
+        self.last = value
+        gain = change if change > 0 else 0
+        loss = -change if change < 0 else 0
+
+        if self.count <= self.timeperiod + 1:
+            # Sum of the first changes, the average is formed on the last of them
+            self.avg_gain += gain
+            self.avg_loss += loss
+            if self.count < self.timeperiod + 1:
+                return self.value
+            self.avg_gain /= self.timeperiod
+            self.avg_loss /= self.timeperiod
+        else:
+            self.avg_gain = ((self.avg_gain * (self.timeperiod - 1)) + gain) / self.timeperiod
+            self.avg_loss = ((self.avg_loss * (self.timeperiod - 1)) + loss) / self.timeperiod
+
+        total = self.avg_gain + self.avg_loss
+        self.value = 100 * (self.avg_gain / total) if total != 0 else 0
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        output = np.full(len(values), np.nan)
+        self.count = len(values)
+        if self.count == 0:
+            return output
+
+        self.last = float(values[-1])
+        change = np.diff(values)
+        gains = np.where(change > 0, change, 0)
+        losses = np.where(change < 0, -change, 0)
+        if self.count < self.timeperiod + 1:
+            self.avg_gain = float(gains.sum())
+            self.avg_loss = float(losses.sum())
+            return output
+
+        alpha = 1 / self.timeperiod
+        avg_gain = _seeded_ema(gains[:self.timeperiod].mean(), gains[self.timeperiod:], alpha)
+        avg_loss = _seeded_ema(losses[:self.timeperiod].mean(), losses[self.timeperiod:], alpha)
+        total = avg_gain + avg_loss
+        with np.errstate(divide="ignore", invalid="ignore"):
+            output[self.timeperiod:] = np.where(total != 0, 100 * (avg_gain / total), 0)
+
+        self.avg_gain = float(avg_gain[-1])
+        self.avg_loss = float(avg_loss[-1])
+        self.value = float(output[-1])
+        return output
+
+
+class RollingSum(StreamingIndicator):
+    """
+    Sum over the last values, like talib.SUM.
+    """
+
+    def __init__(self, timeperiod: int = 30):
+        self.timeperiod: int = timeperiod
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.window: Deque[float] = deque()
+        self.total: float = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        self.window.append(value)
+        self.total += value
+        if len(self.window) > self.timeperiod:
+            self.total -= self.window.popleft()
+        if len(self.window) == self.timeperiod:
+            self.value = self.total
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        output = pd.Series(values).rolling(self.timeperiod).sum().to_numpy()
+        _initialize_window(self, values, output)
+        return output
+
+
+class RollingStd(StreamingIndicator):
+    """
+    Population standard deviation over the last values from running sums of the values and their squares,
+    like talib.STDDEV.
+    """
+
+    def __init__(self, timeperiod: int = 5, nbdev: float = 1):
+        self.timeperiod: int = timeperiod
+        self.nbdev: float = nbdev
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.window: Deque[float] = deque()
+        self.total: float = 0
+        self.total_squares: float = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        self.window.append(value)
+        self.total += value
+        self.total_squares += value * value
+        if len(self.window) > self.timeperiod:
+            old = self.window.popleft()
+            self.total -= old
+            self.total_squares -= old * old
+        if len(self.window) == self.timeperiod:
+            mean = self.total / self.timeperiod
+            variance = (self.total_squares / self.timeperiod) - (mean * mean)
+            self.value = np.sqrt(variance) * self.nbdev if variance > 0 else 0
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        output = pd.Series(values).rolling(self.timeperiod).std(ddof=0).to_numpy() * self.nbdev
+        _initialize_window(self, values, output)
+        self.total_squares = float(np.square(np.asarray(self.window)).sum())
+        return output
+
+
+class RollingMedian(StreamingIndicator):
+    """
+    Median of the last values, like Series.rolling(timeperiod).median(). The window is also kept sorted, so an update
+    is a binary search and an insert instead of sorting the window.
+    """
+
+    def __init__(self, timeperiod: int = 30):
+        self.timeperiod: int = timeperiod
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.window: Deque[float] = deque()
+        self.sorted: List[float] = []
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        self.window.append(value)
+        bisect.insort(self.sorted, value)
+        if len(self.window) > self.timeperiod:
+            del self.sorted[bisect.bisect_left(self.sorted, self.window.popleft())]
+        if len(self.window) == self.timeperiod:
+            middle = self.timeperiod // 2
+            if self.timeperiod % 2 == 1:
+                self.value = self.sorted[middle]
+            else:
+                self.value = (self.sorted[middle - 1] + self.sorted[middle]) / 2
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        output = pd.Series(values).rolling(self.timeperiod).median().to_numpy()
+        _initialize_window(self, values, output)
+        self.sorted = sorted(self.window)
+        return output
+
+
+class WavePMOscillator(StreamingIndicator):
+    """
+    WavePM oscillator of a single window, the same values as wave_pm in kektrade.indicators.wavepm.
+    The deviation of the window relative to its mean is compared with the average deviation of the last look back
+    periods, 0 on the first window values.
+    """
+
+    def __init__(self, window: int, look_back_periods: int = 100):
+        self.window: int = window
+        self.look_back_periods: int = look_back_periods
+        super().__init__()
+
+    def reset(self) -> None:
+        super().reset()
+        self.values: Deque[float] = deque()
+        self.total: float = 0
+        self.total_squares: float = 0
+        self.powers: Deque[float] = deque()
+        self.power_total: float = 0
+        self.power_count: int = 0
+
+    def update(self, value: float) -> float:
+        self.count += 1
+        self.values.append(value)
+        self.total += value
+        self.total_squares += value * value
+        if len(self.values) > self.window:
+            old = self.values.popleft()
+            self.total -= old
+            self.total_squares -= old * old
+
+        mean = np.nan
+        dev = np.nan
+        power = np.nan
+        if len(self.values) == self.window:
+            mean = self.total / self.window
+            variance = (self.total_squares / self.window) - (mean * mean)
+            dev = 3.2 * np.sqrt(variance) if variance > 0 else 0
+            power = (dev / mean) ** 2
+
+        self.powers.append(power)
+        if not np.isnan(power):
+            self.power_total += power
+            self.power_count += 1
+        if len(self.powers) > self.look_back_periods:
+            old = self.powers.popleft()
+            if not np.isnan(old):
+                self.power_total -= old
+                self.power_count -= 1
+
+        if self.count <= self.window:
+            self.value = 0
+        elif self.power_count < 7:
+            self.value = np.nan
+        else:
+            calc_dev = np.sqrt(self.power_total / self.look_back_periods) * mean
+            with np.errstate(divide="ignore", invalid="ignore"):
+                self.value = float(np.tanh(np.float64(dev) / calc_dev))
+        return self.value
+
+    def initialize(self, values: np.ndarray) -> np.ndarray:
+        from kektrade.indicators.wavepm import wave_pm
+
+        self.reset()
+        values = np.asarray(values, dtype=np.float64)
+        series = pd.Series(values)
+        output = wave_pm(series, window=self.window, look_back_periods=self.look_back_periods).to_numpy(dtype=np.float64)
+
+        self.count = len(values)
+        self.values = deque(values[-self.window:])
+        self.total = float(np.sum(self.values))
+        self.total_squares = float(np.square(np.asarray(self.values)).sum())
+
+        dev = 3.2 * series.rolling(window=self.window).std(ddof=0)
+        powers = np.power(dev / series.rolling(window=self.window).mean(), 2).to_numpy()
+        self.powers = deque(powers[-self.look_back_periods:])
+        known = [power for power in self.powers if not np.isnan(power)]
+        self.power_total = float(np.sum(known))
+        self.power_count = len(known)
+        if self.count > 0:
+            self.value = float(output[-1])
+        return output
+
+
+INDICATORS = {cls.__name__: cls for cls in [SMA, EMA, RSI, RollingSum, RollingStd, RollingMedian, WavePMOscillator]}
+
+
+def save_indicators(path: Path, indicators: Dict[str, StreamingIndicator]) -> None:
+    """
+    Write the parameters and the state of indicators to a json file.
+    :param path: json file
+    :param indicators: indicators by name
+    """
+    data = {
+        name: {
+            "class": type(indicator).__name__,
+            "parameters": indicator.get_parameters(),
+            "state": indicator.get_state()
+        } for name, indicator in indicators.items()
+    }
+    with open(path, "w") as json_file:
+        json.dump(data, json_file)
+
+
+def load_indicators(path: Path) -> Dict[str, StreamingIndicator]:
+    """
+    Create the indicators saved with save_indicators with their state.
+    :param path: json file
+    :return: indicators by name
+    """
+    with open(path, "r") as json_file:
+        data = json.load(json_file)
+
+    indicators = {}
+    for name, item in data.items():
+        indicator = INDICATORS[item["class"]](**item["parameters"])
+        indicator.set_state(item["state"])
+        indicators[name] = indicator
+    return indicators
+
+
+def _seeded_ema(seed: float, values: np.ndarray, alpha: float) -> np.ndarray:
+    """
+    Exponential moving average that starts with a seed value.
+    :param seed: first output
+    :param values: values after the seed
+    :param alpha: weight of a new value
+    :return: seed and the averages of the values
+    """
+    series = pd.Series(np.concatenate([[seed], values]))
+    return series.ewm(alpha=alpha, adjust=False).mean().to_numpy()
+
+
+def _initialize_window(indicator: StreamingIndicator, values: np.ndarray, output: np.ndarray) -> None:
+    """
+    Set the window state of a rolling indicator to the last values of the history.
+    :param indicator: indicator with window and total
+    :param values: history
+    :param output: indicator values of the history
+    """
+    indicator.count = len(values)
+    indicator.window = deque(values[-indicator.timeperiod:]) if len(values) > 0 else deque()
+    indicator.total = float(np.sum(indicator.window))
+    if indicator.count > 0:
+        indicator.value = float(output[-1])
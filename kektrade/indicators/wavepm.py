@@ -1,38 +1,25 @@
 from pandas import Series
 from pandas import DataFrame
 import numpy as np
-import pandas as pd
+
+from kektrade.indicators.rolling import RollingWindows
+
+def _tanh(x):
+    two = np.where(x > 0, -2, 2)
+    what = two * x
+    ex = np.exp(what)
+    j = 1 - ex
+    k = ex - 1
+    l = np.where(x > 0, j, k)
+    output = l / (1 + ex)
+    return output
 
 def rolling_mean(series, window=200, min_periods=None):
     return series.rolling(window=window, min_periods=min_periods).mean()
 
 def wave_pm(series, window, look_back_periods=100):
-    ma = rolling_mean(series, window=window)
-    std = Series(series).rolling(window=window).std(ddof=0)
-
-    def tanh(x):
-        two = np.where(x > 0, -2, 2)
-        what = two * x
-        ex = np.exp(what)
-        j = 1 - ex
-        k = ex - 1
-        l = np.where(x > 0, j, k)
-        output = l / (1 + ex)
-        return output
-
-    def osc(input_dev, mean, look_back):
-        variance = Series(power).rolling(window=look_back, min_periods=7).sum() / look_back
-        calc_dev = np.sqrt(variance) * mean
-        y = (input_dev / calc_dev)
-        oscLine = tanh(y)
-        return oscLine
-
-    dev = 3.2 * std
-    power = np.power(dev /ma, 2)
-    wavePM = osc(dev, ma, look_back_periods)
-    wavePM.iloc[0:window] = 0
-
-    return wavePM
+    wavePM = wave_pm_matrix(series.to_numpy(dtype=np.float64), [window], look_back_periods=look_back_periods)
+    return Series(wavePM[:, 0], index=series.index)
 
 
 def calculate_wavepm_bands(df, lookback=100, wavepm_column="close", periods=None, min_period=14, smoothing_period=0, multiplikator=1):
@@ -71,159 +58,49 @@ def calculate_wavepm_bands(df, lookback=100, wavepm_column="close", periods=None
             if p >= 2000:
                 break
 
-    # Calculate all WavePMs
-    # Save the Position in Column List for faster access
-    column_index_map = {}
-    column_names = []
-    for i in periods:
-        colname = f"{i}"
-        series = wave_pm(df[wavepm_column], window=i, look_back_periods=lookback * multiplikator)
-        df = pd.concat([df, series.rename(colname)], axis=1)
-
-        column_index_map[i] = df.columns.get_loc(colname)
-        column_names.append(colname)
-
-    df_wavepms_loxp = df[column_names].copy()
-    df_wavepms_clcp = df[column_names].copy()
-    df_wavepms_lntp = df[column_names].copy()
+    # Calculate all WavePMs as one matrix with a column for every period
+    wavepms = wave_pm_matrix(df[wavepm_column].to_numpy(dtype=np.float64), periods,
+                             look_back_periods=lookback * multiplikator)
+    column_index_map = {period: i for i, period in enumerate(periods)}
+    period_values = np.asarray(periods)
 
     LIMIT_LOXP = 0.9
     LIMIT_CLCP = 0.3
     LIMIT_LNTP = 0.6
 
-    COOLOFF_PERIOD = 0
-
-    for col in column_names:
-        val = int(col)
-        df_wavepms_loxp[col] = np.where(df_wavepms_loxp[col] > LIMIT_LOXP, val, 0)
-        df_wavepms_clcp[col] = np.where((df_wavepms_clcp[col] < LIMIT_CLCP) & (df_wavepms_clcp[col] > 0), val, 0)
-        df_wavepms_lntp[col] = np.where((df_wavepms_lntp[col] < LIMIT_LNTP) & (df_wavepms_lntp[col] > 0), val, 0)
-
-    df_wavepms_loxp = pd.concat([df_wavepms_loxp, pd.Series([1 for x in range(len(df_wavepms_loxp.index))]).rename("0")], axis=1)
-    df_wavepms_clcp = pd.concat([df_wavepms_clcp, pd.Series([1 for x in range(len(df_wavepms_clcp.index))]).rename("0")], axis=1)
-    df_wavepms_lntp = pd.concat([df_wavepms_lntp, pd.Series([1 for x in range(len(df_wavepms_lntp.index))]).rename("0")], axis=1)
-
-    df["loxp"] = df_wavepms_loxp.idxmax(axis=1).astype(int)
-    df["clcp"] = df_wavepms_clcp.idxmax(axis=1).astype(int)
-    df["tlcp"] = 0
-    df["lntp"] = df_wavepms_lntp.idxmax(axis=1).astype(int)
-
-    #del df_wavepms_loxp
-    #del df_wavepms_clcp
-    #del df_wavepms_lntp
-
-    df["wloxp"] = 0
-    df["wclcp"] = 0
-    df["wtlcp"] = 0
-    df["wlntp"] = 0
-
-    idx_loxp = df.columns.get_loc(f"loxp")
-    idx_clcp = df.columns.get_loc(f"clcp")
-    idx_tlcp = df.columns.get_loc(f"tlcp")
-    idx_lntp = df.columns.get_loc(f"lntp")
-    idx_wloxp = df.columns.get_loc(f"wloxp")
-    idx_wclcp = df.columns.get_loc(f"wclcp")
-    idx_wtlcp = df.columns.get_loc(f"wtlcp")
-    idx_wlntp = df.columns.get_loc(f"wlntp")
+    # Longest period in the limits, 0 if there is none
+    loxp = np.max(np.where(wavepms > LIMIT_LOXP, period_values, 0), axis=1, initial=0)
+    clcp = np.max(np.where((wavepms < LIMIT_CLCP) & (wavepms > 0), period_values, 0), axis=1, initial=0)
+    lntp = np.max(np.where((wavepms < LIMIT_LNTP) & (wavepms > 0), period_values, 0), axis=1, initial=0)
 
     # WLOXP muss seperat gemacht werden da er bei Mid Crossover aufhört!
     src = df["close"]
-    loxp = df["loxp"]
-    clcp = df["clcp"]
-    lntp = df["lntp"]
-
-    loxp_m = Sma(src, loxp)
-
-    last_period_wloxp = 0
-    last_period_wclcp = 0
-    last_period_wlntp = 0
-
-    cooloff_wloxp = 0
-    cooloff_wclcp = 0
-    cooloff_wlntp = 0
-
-
-    l = len(df.index)
-    for i in range(l):
-        # WLOXP
-        # LOXP aus DF nehmen
-        period_wloxp = 0
-        period_loxp = df.iat[i, idx_loxp]
-        # Wenn LOXP höher ist als WLOXP, WLOXP auf LOXP setzen
-        if period_loxp > last_period_wloxp:
-            cooloff_wloxp = COOLOFF_PERIOD
-            last_period_wloxp = period_loxp
-        # Erst zurücksetzen wenn WLOXP < 0.7 ist
-        if last_period_wloxp > 0:
-            tmp_wavepm = df.iat[i, column_index_map[last_period_wloxp]]
-            if tmp_wavepm > 0.7:
-                cooloff_wloxp = COOLOFF_PERIOD
-                period_wloxp = last_period_wloxp
-            elif cooloff_wloxp > 0:
-                period_wloxp = last_period_wloxp
-            else:
-                period_wloxp = 0
-                last_period_wloxp = 0
-            cooloff_wloxp -= 1
-
-            # Crossover beendet LOXP
-            if ((src.iloc[i] > loxp_m.iloc[i]) and (src.iloc[i - 1] < loxp_m.iloc[i - 1])) or \
-                    ((src.iloc[i] < loxp_m.iloc[i]) and (src.iloc[i - 1] > loxp_m.iloc[i - 1])):
-                period_wloxp = 0
-                last_period_wloxp = 0
-                cooloff_wloxp = 0
-
-        df.iat[i, idx_wloxp] = period_wloxp
-
-        # WCLCP
-        # CLCP aus DF nehmen
-        period_wclcp = 0
-        period_clcp = df.iat[i, idx_clcp]
-        # Wenn clcp höher ist als Wclcp, Wclcp auf clcp setzen
-        if period_clcp > last_period_wclcp:
-            cooloff_wclcp = COOLOFF_PERIOD
-            last_period_wclcp = period_clcp
-        # Erst zurücksetzen wenn Wclcp > 0.5 ist
-        if last_period_wclcp > 0:
-            tmp_wavepm = df.iat[i, column_index_map[last_period_wclcp]]
-            if tmp_wavepm < 0.4:
-                cooloff_wclcp = COOLOFF_PERIOD
-                period_wclcp = last_period_wclcp
-            elif cooloff_wclcp > 0:
-                period_wclcp = last_period_wclcp
-            else:
-                period_wclcp = 0
-                last_period_wclcp = 0
-            cooloff_wclcp -= 1
-        df.iat[i, idx_wclcp] = period_wclcp
-
-
-        # WLNTP
-        # LNTP aus DF nehmen
-        period_wlntp = 0
-        period_lntp = df.iat[i, idx_lntp]
-        # Wenn lntp höher ist als WLNTP, WLNTP auf lntp setzen
-        if period_lntp > last_period_wlntp:
-            cooloff_wlntp = COOLOFF_PERIOD
-            last_period_wlntp = period_lntp
-        # Erst zurücksetzen wenn WLNTP > 0.8 ist
-        if last_period_wlntp > 0:
-            tmp_wavepm = df.iat[i, column_index_map[last_period_wlntp]]
-            if tmp_wavepm < 0.7:
-                cooloff_wlntp = COOLOFF_PERIOD
-                period_wlntp = last_period_wlntp
-            elif cooloff_wlntp > 0:
-                period_wlntp = last_period_wlntp
-            else:
-                period_wlntp = 0
-                last_period_wlntp = 0
-            cooloff_wlntp -= 1
-        df.iat[i, idx_wlntp] = period_wlntp
+    loxp_m = Sma(src, Series(loxp, index=df.index))
+
+    close = src.to_numpy()
+    close_m = loxp_m.to_numpy()
+    close_prev = np.roll(close, 1)
+    close_m_prev = np.roll(close_m, 1)
+    crossover = ((close > close_m) & (close_prev < close_m_prev)) | ((close < close_m) & (close_prev > close_m_prev))
+
+    # Erst zurücksetzen wenn WLOXP < 0.7 ist, WCLCP > 0.4 und WLNTP > 0.7
+    wloxp = _hold_periods(loxp, wavepms, column_index_map, lambda x: x > 0.7, crossover)
+    wclcp = _hold_periods(clcp, wavepms, column_index_map, lambda x: x < 0.4)
+    wlntp = _hold_periods(lntp, wavepms, column_index_map, lambda x: x < 0.7)
+
+    bands = {
+        "loxp": loxp,
+        "clcp": clcp,
+        "lntp": lntp,
+        "wloxp": wloxp,
+        "wclcp": wclcp,
+        "wlntp": wlntp
+    }
 
     # End-Bands generieren
     result_bands = ["loxp", "clcp", "lntp", "wloxp", "wclcp", "wlntp"]
     for band in result_bands:
-        vband = df[band]
+        vband = Series(bands[band], index=df.index)
         band_m = Sma(src, vband)
         band_s = Stdev(src, vband)
 
@@ -243,8 +120,107 @@ def calculate_wavepm_bands(df, lookback=100, wavepm_column="close", periods=None
             df_orig[f"bb_lower_{band}"]   = df_orig[f"bb_lower_{band}"].rolling(smoothing_period).mean()
             df_orig[f"bb_lower_{band}32"] = df_orig[f"bb_lower_{band}32"].rolling(smoothing_period).mean()
 
-    # WavePM Columns droppen weil dann alles schneller ist.
-    #df_orig.drop(column_names, axis=1, inplace=True)
     return df_orig
 
 
+def wave_pm_matrix(values, periods, look_back_periods=100, chunk_size=32):
+    """
+    WavePM of several windows at once. The rolling statistics of all windows are taken from the same prefix sums
+    of RollingWindows, so no series is built per window. The windows are processed in chunks to limit the memory of
+    the temporary matrices.
+    :param values: input values
+    :param periods: windows
+    :param look_back_periods: look back periods of the oscillator
+    :param chunk_size: number of windows calculated together
+    :return: matrix with a row for every value and a column for every window
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    result = np.empty((n, len(periods)), dtype=np.float64)
+
+    rolling = RollingWindows(values)
+    rows = np.arange(n)[:, None]
+
+    for chunk_start in range(0, len(periods), chunk_size):
+        windows = np.asarray(periods[chunk_start:chunk_start + chunk_size])
+        stats = rolling.stats(windows)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dev = 3.2 * stats.std
+            power = np.power(dev / stats.mean, 2)
+
+            # Rolling sum of the power over the look back periods with at least 7 values
+            variance = RollingWindows(power).sum(look_back_periods, min_periods=7) / look_back_periods
+            calc_dev = np.sqrt(variance) * stats.mean
+            oscillator = _tanh(dev / calc_dev)
+
+        oscillator[rows < windows[None, :]] = 0
+        result[:, chunk_start:chunk_start + len(windows)] = oscillator
+
+    return result
+
+
+def _next_true(mask):
+    """
+    :param mask: boolean array
+    :return: for every position the first position from there on where mask is True, len(mask) if there is none
+    """
+    n = len(mask)
+    positions = np.where(mask, np.arange(n), n)
+    return np.minimum.accumulate(positions[::-1])[::-1]
+
+
+def _hold_periods(periods, wavepms, column_index_map, keep, reset=None):
+    """
+    Hold the period of a band as long as its WavePM stays in the limit, a longer period of the band replaces it.
+    Instead of stepping through every candle, the next candle where the held period ends is looked up, so the loop
+    only runs once per change of the period.
+    :param periods: period of the band on every candle, 0 for none
+    :param wavepms: matrix from wave_pm_matrix
+    :param column_index_map: column of every period in the matrix
+    :param keep: function that returns for WavePM values if the period is held
+    :param reset: boolean array with candles that end the held period
+    :return: held period on every candle, 0 for none
+    """
+    n = len(periods)
+    result = np.zeros(n, dtype=np.int64)
+    if reset is None:
+        reset = np.zeros(n, dtype=bool)
+
+    next_period = _next_true(periods > 0)
+    next_reset = _next_true(reset)
+    next_end = {}
+
+    i = 0
+    last = 0
+    while i < n:
+        if last == 0:
+            i = next_period[i]
+            if i >= n:
+                break
+            last = periods[i]
+        else:
+            if last not in next_end:
+                wavepm = wavepms[:, column_index_map[last]]
+                next_end[last] = _next_true(~keep(wavepm) | (periods > last))
+            end = min(next_end[last][i], next_reset[i])
+            result[i:end] = last
+            if end >= n:
+                break
+            i = end
+            if periods[i] <= last:
+                last = 0
+                i += 1
+                continue
+            last = periods[i]
+
+        # The period was set on this candle
+        if keep(wavepms[i, column_index_map[last]]) and not reset[i]:
+            result[i] = last
+        else:
+            last = 0
+        i += 1
+
+    return result
+
+
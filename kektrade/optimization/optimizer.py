@@ -1,25 +1,28 @@
 import copy
 from itertools import product
-from multiprocessing import Pool
+from multiprocessing import cpu_count
 from pathlib import Path
 import logging
 import pytz
 from typing import Union
 
 from sqlalchemy.sql import select
+import numpy as np
 import pandas as pd
 import tabulate
 
 from kektrade.event_loop import *
 from kektrade.subaccount import SubaccountItem
 from kektrade.data.dataprovider import DatetimePeriod
-from kektrade.exchange import Backtest
+from kektrade.exchange import Backtest, BatchBacktest, load_vectorized_backtest
 from kektrade.database.types import Subaccount, Pair, get_engine
 from kektrade.database.types import get_session
 from kektrade.plotting import PlotterSubaccount
 from kektrade.subaccount import SubaccountItem
 from kektrade.config.runtime_settings import RunSettings
 from kektrade.plotting import plotter_optimize
+from kektrade.optimization.pool import OptimizerPool, OptimizerJob, OptimizerResult, OptimizerIndicators, \
+    get_indicator_dataframe
 from kektrade.database.types import *
 
 logger = logging.getLogger(__name__)
@@ -50,6 +53,7 @@ class Optimizer():
 
         self.subaccount_template: SubaccountItem = subaccount_template
         self.running: bool = False
+        self.pool: Union[None, OptimizerPool] = None
 
         tmp = datetime.datetime(year=1900, month=1, day=1, tzinfo=pytz.utc)
         self.train_period: DatetimePeriod = DatetimePeriod(start=tmp, end=tmp)
@@ -69,33 +73,37 @@ class Optimizer():
         parameter_combinations = self._get_parameter_product(optimizeable_parameter)
         parameter_combinations = self._get_parameters_with_default_values(parameter_combinations)
 
-        subaccount_configurations = []
-        for parameter in parameter_combinations:
-            subaccount = copy.copy(self.subaccount_template)
-            subaccount.start = train_period.start
-            subaccount.end = train_period.end
-            subaccount.parameter = parameter
-            subaccount.parent_subaccount_id = self.subaccount_template.id
-            subaccount_configurations.append(subaccount)
-
         if self.subaccount_template.config["optimization"]["log_optimization"]:
             logger.info(f"Possible parameter combinations: {parameter_combinations}")
 
-        subaccount_ids = []
-        from kektrade.event_loop import start_eventloop
-        cpu_count = 1
-        if cpu_count == 1:
-            for sa in subaccount_configurations:
-                subaccount_ids.append(start_eventloop(sa))
+        pool = self._get_pool(len(parameter_combinations))
+        indicators = pool.precompute_indicators(train_period, self._get_parameters_indicators())
+        parameter_combinations = self._screen_parameters(parameter_combinations, indicators)
+
+        if self._batch_enabled():
+            results = self._run_batch(parameter_combinations, indicators)
         else:
-            pool = Pool(16)
-            subaccount_ids = pool.map(start_eventloop, subaccount_configurations)
-            pool.join()
+            jobs = []
+            for parameter in parameter_combinations:
+                jobs.append(OptimizerJob(
+                    parameter=parameter,
+                    period=train_period,
+                    parent_subaccount_id=self.subaccount_template.id,
+                    indicators=indicators
+                ))
+
+            try:
+                results = pool.map(jobs)
+            except BaseException:
+                # The pool terminated itself, the next step starts a new one
+                self.pool = None
+                raise
+        pool.release_indicators()
 
-        best_parameter = self._get_best_parameter(subaccount_ids)
+        best_parameter = self._get_best_parameter(results)
 
-        if self.subaccount_template.config["optimization"]["plot_optimization"]:
-            self._plot_optimization(train_period, subaccount_ids)
+        if self.subaccount_template.config["optimization"]["plot_optimization"] and not self._batch_enabled():
+            self._plot_optimization(train_period, [result.subaccount_id for result in results])
 
         if self.subaccount_template.config["optimization"]["log_optimization"]:
             logger.info(f"Best parameter combination: {best_parameter}")
@@ -104,6 +112,126 @@ class Optimizer():
 
         callback(best_parameter)
 
+    def close(self) -> None:
+        """
+        Stop the worker pool. Called once the event loop of the subaccount is finished.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def _get_worker_count(self) -> int:
+        """
+        Get the number of worker processes from the optimization config. 0 means one worker per cpu core.
+        :return: number of workers
+        """
+        workers = self.subaccount_template.config["optimization"].get("workers", 1)
+        if workers == 0:
+            workers = cpu_count()
+        return workers
+
+    def _get_history_period(self) -> DatetimePeriod:
+        """
+        Get the period of candles the workers keep in memory. It covers the whole run of the subaccount plus the
+        train period and startup candles in front of the first walk-forward step.
+        :return: datetime period
+        """
+        period = self.subaccount_template.get_required_datetimerange()
+        startup = datetime.timedelta(minutes=self.subaccount_template.strategy.startup_candle_count *
+                                             self.subaccount_template.dataprovider.main_pair.timeframe)
+        days_train = datetime.timedelta(days=self.subaccount_template.config["optimization"]["days_train"])
+        return DatetimePeriod(start=period.start - days_train - startup, end=period.end)
+
+    def _get_pool(self, job_count: int) -> OptimizerPool:
+        """
+        Create the worker pool on the first walk-forward step and reuse it for all following steps.
+        The workers get a copy of the template without loaded modules, since those can't be pickled.
+        :param job_count: number of parameter combinations, there are never more workers than combinations
+        :return: worker pool
+        """
+        if self.pool is None:
+            self.pool = OptimizerPool(
+                template=copy.copy(self.subaccount_template),
+                history_period=self._get_history_period(),
+                workers=min(self._get_worker_count(), job_count),
+                shared_memory=self.subaccount_template.config["optimization"].get("shared_memory", True)
+            )
+        return self.pool
+
+    def _batch_enabled(self) -> bool:
+        """
+        Check if the parameter combinations are run in one batch backtest. The batch backtest has no history, so the
+        optimization can't be plotted.
+        :return: bool
+        """
+        config = self.subaccount_template.config["optimization"]
+        return config.get("batch", False) and not config["plot_optimization"] and \
+            self.subaccount_template.strategy.use_tick_batch
+
+    def _run_batch(self, parameters: List[Dict[str, Any]], indicators: OptimizerIndicators) -> List[OptimizerResult]:
+        """
+        Run all parameter combinations in one pass over the candles of the train period with the tick_batch function
+        of the strategy. The combinations have no subaccount in the database, their subaccount id is 0.
+        :param parameters: parameter combinations
+        :param indicators: indicators of the train period
+        :return: results in the order of the parameter combinations
+        """
+        template = self.pool.template
+        df = get_indicator_dataframe(indicators)
+        exchange = BatchBacktest(template.exchange, template.subaccount_config["exchange_parameters"]["initial_deposit"],
+                                 len(parameters))
+        exchange.set_dataframe(df)
+
+        metadata = {}
+        variables = {}
+        template.strategy.populate_variables(variables)
+        for index in range(len(df.index)):
+            template.strategy.tick_batch(dataframe=df, index=index, metadata=metadata, parameters=parameters,
+                                         variables=variables, exchange=exchange)
+            exchange.after_tick(index)
+
+        account_balance = exchange.get_account_balance()
+        results = []
+        for i, parameter in enumerate(parameters):
+            results.append(OptimizerResult(
+                subaccount_id=0,
+                parameter=parameter,
+                account_balance=float(account_balance[i]),
+                max_drawdown=float(exchange.max_drawdown[i]),
+                trades=int(exchange.trade_count[i])
+            ))
+        return results
+
+    def _screen_parameters(self, parameters: List[Dict[str, Any]],
+                           indicators: OptimizerIndicators) -> List[Dict[str, Any]]:
+        """
+        Keep the screening_top_k parameter combinations with the highest account balance in a vectorized backtest of
+        the strategy signals. Only these are run with the backtest exchange. All combinations are kept if the
+        screening is disabled or the strategy has no signals.
+        :param parameters: parameter combinations
+        :param indicators: indicators of the train period
+        :return: best parameter combinations in their original order
+        """
+        top_k = self.subaccount_template.config["optimization"].get("screening_top_k", 0)
+        if top_k == 0 or len(parameters) <= top_k:
+            return parameters
+
+        template = self.pool.template
+        df = get_indicator_dataframe(indicators)
+        backtest = load_vectorized_backtest(template.exchange,
+                                            template.subaccount_config["exchange_parameters"]["initial_deposit"])
+
+        balances = []
+        for parameter in parameters:
+            signals = template.strategy.populate_signals(dataframe=df, metadata={}, parameter=parameter)
+            if signals is None:
+                return parameters
+            balances.append(backtest.run(df, signals).account_balance)
+
+        best = np.argsort(-np.asarray(balances), kind="stable")[:top_k]
+        if self.subaccount_template.config["optimization"]["log_optimization"]:
+            logger.info(f"Screened {len(parameters)} parameter combinations, keeping {top_k}")
+        return [parameters[i] for i in sorted(best)]
 
     def _get_optimizeable_parameter(self) -> Dict[Any, List[Any]]:
         optimizeable_parameter = self.subaccount_template.strategy.populate_parameters()
@@ -111,6 +239,17 @@ class Optimizer():
             del optimizeable_parameter[key]
         return optimizeable_parameter
 
+    def _get_parameters_indicators(self) -> Dict[str, List[Any]]:
+        """
+        Get the search space for the indicators of all parameter combinations. Fixed parameters from the config
+        only have their single value.
+        :return: dictionary with lists of values
+        """
+        parameters = self.subaccount_template.strategy.populate_parameters()
+        for key, value in self.subaccount_template.subaccount_config["parameters"].items():
+            parameters[key] = [value]
+        return parameters
+
     def _get_parameter_product(self, parameter: Dict[str, List[Any]]) -> List[Dict[str, List[Any]]]:
         generator = (dict(zip(parameter.keys(), values)) for values in product(*parameter.values()))
         return list(generator)
@@ -136,35 +275,21 @@ class Optimizer():
             subaccount_ids
         )
 
-    def _get_best_parameter(self, subaccount_ids: List[int]) -> Union[None, Dict[str, Any]]:
+    def _get_best_parameter(self, results: List[OptimizerResult]) -> Union[None, Dict[str, Any]]:
         """
-        Get the data of the specified subaccounts from the db, calculate metric and return the best one.
-        :param subaccount_ids: list of the subaccount database ids
+        Calculate the metric of every parameter combination from the results of the workers and return the best one.
+        On equal metrics the first combination wins.
+        :param results: results in the order of the parameter combinations
         :return: Dictionary with best parameters or None if all fail
         """
-        session = get_session(self.subaccount_template.run_settings.db_path)
-        conn = session.bind
+        if len(results) == 0:
+            return None
 
-        query = select(Subaccount).filter(Subaccount.id.in_(subaccount_ids))
-        data_subaccounts = pd.read_sql(query, con=conn)
+        data_results = pd.DataFrame(results, columns=OptimizerResult._fields)
+        data_results["metric"] = data_results["account_balance"]
 
-        query = select(Wallet).filter(Wallet.subaccount_id.in_(subaccount_ids))
-        data_wallet = pd.read_sql(query, con=conn)
-
-        parameter_metric = {}
-        data_subaccounts["metric"] = 0.0
-        for i in range(len(data_subaccounts.index)):
-            subaccount_id = data_subaccounts.at[i, "id"]
-            df_tmp = data_wallet[data_wallet["subaccount_id"] == subaccount_id]
-            parameter_metric[subaccount_id] = df_tmp["account_balance"].iloc[-1]
-            data_subaccounts.at[i, "metric"] = parameter_metric[subaccount_id]
-
-        best_id = max(parameter_metric, key=parameter_metric.get)
-        best_param = data_subaccounts[data_subaccounts["id"] == best_id].reset_index().at[0, "parameter"]
+        best_index = int(data_results["metric"].values.argmax())
         if self.subaccount_template.config["optimization"]["log_optimization"]:
-            logger.info("\n" + tabulate.tabulate(data_subaccounts, headers='keys', tablefmt='psql'))
-
-        import ast
-        return ast.literal_eval(best_param)
-
+            logger.info("\n" + tabulate.tabulate(data_results, headers='keys', tablefmt='psql'))
 
+        return dict(results[best_index].parameter)
@@ -0,0 +1,266 @@
+import copy
+import logging
+from multiprocessing import Pool
+from typing import NamedTuple, Dict, List, Any, Union
+
+from pandas import DataFrame
+
+from kektrade.data.dataprovider import DatetimePeriod
+from kektrade.data.sharedstore import SharedCandleStore, SharedFrame, SharedFrameHandle
+from kektrade.subaccount import SubaccountItem
+
+logger = logging.getLogger(__name__)
+
+
+class OptimizerIndicators(NamedTuple):
+    """
+    Main pair dataframe with the indicators of all parameter combinations of a walk-forward step.
+    Either a handle to the dataframe in shared memory or the dataframe itself.
+    """
+    handle: Union[None, SharedFrameHandle]
+    dataframe: Union[None, DataFrame]
+
+
+class OptimizerJob(NamedTuple):
+    """
+    Data container for a single parameter combination. Only this is sent to the workers for every job.
+    """
+    parameter: Dict[str, Any]
+    period: DatetimePeriod
+    parent_subaccount_id: int
+    indicators: Union[None, OptimizerIndicators]
+
+
+class OptimizerResult(NamedTuple):
+    """
+    Metrics of a finished parameter combination. Returned by the workers instead of reading the history from the
+    database.
+    """
+    subaccount_id: int
+    parameter: Dict[str, Any]
+    account_balance: float
+    max_drawdown: float
+    trades: int
+
+
+# State of the worker process. Set once by init_worker and reused for every job.
+_worker_template: Union[None, SubaccountItem] = None
+_worker_error: Union[None, Exception] = None
+
+
+def init_worker(template: SubaccountItem, history_period: DatetimePeriod,
+                handles: Union[None, Dict[str, SharedFrameHandle]] = None) -> None:
+    """
+    Load the strategy, exchange and dataprovider of the template and read the candle history into memory.
+    If the parent published the history into shared memory, attach to it instead of reading it.
+    Exceptions are stored and raised on the first job, because a failing pool initializer would be restarted
+    endlessly.
+    :param template: subaccount without loaded modules
+    :param history_period: period that covers the train periods of all walk-forward steps
+    :param handles: shared memory handles of the history
+    """
+    global _worker_template, _worker_error
+    try:
+        template.load_modules()
+        if handles is None:
+            with template.file_lock:
+                template.dataprovider.load_history_to_memory(history_period)
+        else:
+            template.dataprovider.attach_history(handles, history_period)
+        _worker_template = template
+    except Exception as e:
+        _worker_error = e
+
+
+def run_job(job: OptimizerJob) -> OptimizerResult:
+    """
+    Run the event loop for a single parameter combination with the resident modules of the worker.
+    Only the exchange is created new, since it holds the state of the simulation.
+    :param job: parameter combination and train period
+    :return: metrics of the run
+    """
+    from kektrade.event_loop import EventLoop
+
+    if _worker_error is not None:
+        raise _worker_error
+
+    subaccount = copy.copy(_worker_template)
+    subaccount.strategy = _worker_template.strategy
+    subaccount.dataprovider = _worker_template.dataprovider
+    subaccount.load_exchange()
+
+    subaccount.start = job.period.start
+    subaccount.end = job.period.end
+    subaccount.parameter = job.parameter
+    subaccount.parent_subaccount_id = job.parent_subaccount_id
+    if job.indicators is not None:
+        subaccount.indicator_dataframe = get_indicator_dataframe(job.indicators)
+
+    loop = EventLoop(subaccount)
+    subaccount_id = loop.start()
+
+    exchange = subaccount.exchange
+    return OptimizerResult(
+        subaccount_id=subaccount_id,
+        parameter=job.parameter,
+        account_balance=exchange.wallet.account_balance,
+        max_drawdown=exchange.max_drawdown,
+        trades=exchange.trade_count
+    )
+
+
+def get_indicator_dataframe(indicators: OptimizerIndicators) -> DataFrame:
+    """
+    Get a private copy of the precomputed indicators, since the event loop and the strategy may write to it.
+    :param indicators: indicators of the walk-forward step
+    :return: dataframe
+    """
+    if indicators.handle is None:
+        return indicators.dataframe.copy()
+
+    frame = SharedFrame(indicators.handle)
+    try:
+        return frame.get_slice(0, frame.length).copy()
+    finally:
+        frame.close()
+
+
+class OptimizerPool():
+    """
+    Long-lived pool of optimizer workers that is reused for every walk-forward step.
+    With a single worker the jobs run in this process.
+    """
+
+    def __init__(self, template: SubaccountItem, history_period: DatetimePeriod, workers: int,
+                 shared_memory: bool = False):
+        """
+        Start the workers and load the modules and history in each of them.
+        This process keeps a loaded template as well to precompute the indicators of every walk-forward step.
+        With shared memory the history is loaded once in this process and the workers attach to it read-only.
+        :param template: subaccount without loaded modules
+        :param history_period: period that covers the train periods of all walk-forward steps
+        :param workers: number of processes
+        :param shared_memory: publish the history and indicators into shared memory
+        """
+        self.workers: int = workers
+        self.pool: Union[None, Pool] = None
+        # Set by terminate, the pool can't run jobs anymore
+        self.terminated: bool = False
+        self.shared_memory: bool = shared_memory and workers > 1
+        self.store: Union[None, SharedCandleStore] = None
+        self.indicator_store: Union[None, SharedCandleStore] = None
+
+        if workers > 1:
+            self.template: SubaccountItem = self._load_template(template, history_period)
+            handles = None
+            if self.shared_memory:
+                handles = self._publish_history(history_period)
+            self.pool = Pool(workers, initializer=init_worker, initargs=(template, history_period, handles))
+        else:
+            init_worker(template, history_period)
+            if _worker_error is not None:
+                raise _worker_error
+            self.template: SubaccountItem = template
+
+    def _load_template(self, template: SubaccountItem, history_period: DatetimePeriod) -> SubaccountItem:
+        """
+        Load the modules and history for a template in this process.
+        :param template: subaccount without loaded modules
+        :param history_period: period of the history
+        :return: loaded copy of the template
+        """
+        loaded = copy.copy(template)
+        loaded.load_modules()
+        with loaded.file_lock:
+            loaded.dataprovider.load_history_to_memory(history_period)
+        return loaded
+
+    def _publish_history(self, history_period: DatetimePeriod) -> Dict[str, SharedFrameHandle]:
+        """
+        Copy the history of the template into shared memory. The template attaches to it as well, so the history
+        exists only once.
+        :param history_period: period of the history
+        :return: handles for the workers
+        """
+        self.store = SharedCandleStore()
+        handles = self.template.dataprovider.publish_history(self.store)
+        self.template.dataprovider.attach_history(handles, history_period)
+        return handles
+
+    def precompute_indicators(self, period: DatetimePeriod, parameters: Dict[str, List[Any]]) -> OptimizerIndicators:
+        """
+        Calculate the indicators for the train period once with the whole search space, instead of once for every
+        parameter combination. The dataframe covers the same candles the event loop of a job loads.
+        Has to be released with release_indicators after the jobs are finished.
+        :param period: train period
+        :param parameters: search space with all values of the optimizeable and fixed parameters
+        :return: indicators for the jobs
+        """
+        subaccount = self.template
+        subaccount.start = period.start
+        subaccount.end = period.end
+        subaccount.dataprovider.load_datasets_to_memory(subaccount.get_required_datetimerange())
+
+        df = subaccount.dataprovider.get_pair_dataframe(subaccount.dataprovider.main_pair)
+        df = subaccount.strategy.populate_indicators(dataframe=df, metadata={}, parameters=parameters)
+
+        if self.shared_memory and SharedCandleStore.is_publishable(df):
+            self.indicator_store = SharedCandleStore()
+            return OptimizerIndicators(handle=self.indicator_store.publish(df), dataframe=None)
+        return OptimizerIndicators(handle=None, dataframe=df)
+
+    def release_indicators(self) -> None:
+        """
+        Release the shared memory of the indicators of the last walk-forward step.
+        """
+        if self.indicator_store is not None:
+            self.indicator_store.close()
+            self.indicator_store = None
+
+    def map(self, jobs: List[OptimizerJob]) -> List[OptimizerResult]:
+        """
+        Run the jobs and return the results in the order of the jobs.
+        If a job raises an exception the pool is terminated and the exception is raised again.
+        :param jobs: list of jobs
+        :return: results of the jobs
+        """
+        if self.terminated:
+            raise Exception("optimizer pool is terminated")
+        if self.pool is None:
+            return [run_job(job) for job in jobs]
+
+        try:
+            return self.pool.map(run_job, jobs, chunksize=1)
+        except BaseException:
+            self.terminate()
+            raise
+
+    def close(self) -> None:
+        """
+        Wait for the workers to finish and stop them.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self._free_store()
+
+    def terminate(self) -> None:
+        """
+        Stop the workers immediately. The pool can't be used anymore.
+        """
+        self.terminated = True
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self._free_store()
+
+    def _free_store(self) -> None:
+        """
+        Release the shared memory after the workers are stopped.
+        """
+        self.release_indicators()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
@@ -1,5 +1,9 @@
 import plotly.graph_objects as go
 import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from kektrade.database.types import OrderStatus
 
 class Plotter():
     @staticmethod
@@ -28,3 +32,64 @@ class Plotter():
             line={'color': color},
         )
         fig.add_trace(profit, x, 1)
+
+    @staticmethod
+    def expand_positions(data_position: DataFrame, data_wallet: DataFrame) -> DataFrame:
+        """
+        Expand the position rows onto the datetimes of the wallet, so a history that is recorded in delta mode
+        plots as a step function. Rows recorded for every candle stay the same.
+        :param data_position: position rows
+        :param data_wallet: wallet rows, recorded for every candle
+        :return: position rows for every wallet datetime
+        """
+        if len(data_position.index) == 0 or len(data_wallet.index) == 0:
+            return data_position
+
+        timeline = Plotter._get_timeline(data_wallet)
+        data_position = data_position.sort_values("datetime", kind="stable").drop_duplicates("datetime", keep="last")
+        data_position = pd.merge_asof(timeline, data_position, on="datetime", direction="backward")
+        return data_position.dropna(subset=["id"]).reset_index(drop=True)
+
+    @staticmethod
+    def expand_orders(data_order: DataFrame, data_wallet: DataFrame) -> DataFrame:
+        """
+        Expand the open order rows onto the datetimes of the wallet. Every order is expanded from its first row until
+        the row where it left the book. The rows with the final state of the orders (insert_state) are kept as they are.
+        Rows recorded for every candle stay the same.
+        :param data_order: order rows
+        :param data_wallet: wallet rows, recorded for every candle
+        :return: order rows
+        """
+        if len(data_order.index) == 0 or len(data_wallet.index) == 0:
+            return data_order
+
+        timeline = Plotter._get_timeline(data_wallet)
+        inserts = data_order[data_order["insert_state"] == 1]
+        snapshots = data_order[data_order["insert_state"] != 1].sort_values("datetime", kind="stable")
+
+        frames = [inserts]
+        for order_id, events in snapshots.groupby("order_id", sort=False):
+            is_open = events["status"] == OrderStatus.OPEN
+            open_events = events[is_open]
+            if len(open_events.index) == 0:
+                continue
+
+            start = open_events["datetime"].iloc[0]
+            end = events[~is_open]["datetime"].min() if (~is_open).any() else None
+
+            span = timeline[timeline["datetime"] >= start]
+            if end is not None:
+                span = span[span["datetime"] < end]
+            frames.append(pd.merge_asof(span, open_events, on="datetime", direction="backward"))
+
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def _get_timeline(data_wallet: DataFrame) -> DataFrame:
+        """
+        Get the sorted unique datetimes of the wallet rows.
+        :param data_wallet: wallet rows
+        :return: dataframe with datetime column
+        """
+        timeline = data_wallet["datetime"].drop_duplicates().sort_values()
+        return DataFrame({"datetime": timeline.values})
@@ -59,6 +59,9 @@ class PlotterSubaccount(Plotter):
         )
         data_ticker = pd.read_sql(query, con=conn)
 
+        data_position = Plotter.expand_positions(data_position, data_wallet)
+        data_order = Plotter.expand_orders(data_order, data_wallet)
+
         fig = self._generate_fig(plot_name)
         self._plot_candlestick(fig, data_ticker)
         self._plot_indicators(fig, data_ticker, indicators)
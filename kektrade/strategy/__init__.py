@@ -1,2 +1,3 @@
 from kektrade.strategy.interface import IStrategy
-from kektrade.strategy.resolver import StrategyResolver
\ No newline at end of file
+from kektrade.strategy.resolver import StrategyResolver
+from kektrade.data.barview import BarView
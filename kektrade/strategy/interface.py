@@ -1,10 +1,12 @@
 import logging
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Union
 
+import numpy as np
 from pandas import DataFrame
 
-from kektrade.exchange import IExchange
+from kektrade.exchange import IExchange, StrategySignals, BatchBacktest
+from kektrade.data.barview import BarView
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +14,10 @@ logger = logging.getLogger(__name__)
 class IStrategy(ABC):
     # Count of candles the strategy requires before producing valid signals
     startup_candle_count: int = 0
+    # Call tick with a BarView of the dataframe instead of the dataframe itself
+    use_bar_view: bool = False
+    # The strategy implements tick_batch for the batch optimization
+    use_tick_batch: bool = False
 
     def populate_parameters(self) -> Dict[str, List[Any]]:
         """
@@ -40,8 +46,27 @@ class IStrategy(ABC):
         """
         pass
 
+    def update_indicators(self, dataframe: DataFrame,
+                          start: int,
+                          metadata: Dict[str, Any],
+                          parameters: Dict[str, Any]) -> Union[None, DataFrame]:
+        """
+        Optional. Calculate the indicators only for the candles from start on, used in live mode instead of
+        populate_indicators on every new candle. The candles before start keep the indicators of the last call.
+        The indicators from kektrade.indicators.streaming are updated with one candle in O(1).
+        start is 0 on the first call and whenever the indicators have to be calculated from scratch, the state of the
+        streaming indicators has to be reset then.
+        The default None calls populate_indicators with the whole dataframe.
+        :param dataframe: Dataframe with data from the exchange, without indicators from start on
+        :param start: position of the first candle without indicators
+        :param metadata: Additional information, like the currently traded pair
+        :param parameters: Search space for a indicator.
+        :return: the Dataframe with indicators for all candles or None
+        """
+        return None
+
     @abstractmethod
-    def tick(self, dataframe: DataFrame,
+    def tick(self, dataframe: Union[DataFrame, BarView],
              index: int,
              metadata: Dict[str, Any],
              parameter: Dict[str, Any],
@@ -50,7 +75,7 @@ class IStrategy(ABC):
         """
     	Perform the order management and trading logic.
     	This function is called as soon as a new candle is appended to the dataframe or in a loop in case of backtest.
-    	:param dataframe: Dataframe with indicators
+    	:param dataframe: Dataframe with indicators, or a read-only BarView of it if use_bar_view is set
     	:param index: Current position in dataframe. Exists for backtest compatibility. In Live it is len(dataframe) -1.
     	:param metadata: Additional information, like the currently traded pair
     	:param parameter: Single parameter configuration from all possible combinations
@@ -60,6 +85,57 @@ class IStrategy(ABC):
         pass
 
 
+    def tick_batch(self, dataframe: DataFrame,
+                   index: int,
+                   metadata: Dict[str, Any],
+                   parameters: List[Dict[str, Any]],
+                   variables: Dict[str, Any],
+                   exchange: BatchBacktest) -> None:
+        """
+        Optional. Perform the trading logic of tick for many parameter combinations at once. The exchange keeps the
+        positions and wallets of all combinations in arrays, in the order of the parameters, and opens a market order
+        for each of them. If the strategy implements this, sets use_tick_batch and optimization.batch is set, the
+        optimizer runs all combinations in a single pass over the candles instead of one backtest each.
+        The default does nothing.
+        :param dataframe: Dataframe with indicators
+        :param index: Current position in dataframe
+        :param metadata: Additional information, like the currently traded pair
+        :param parameters: All parameter combinations of the optimization
+        :param variables: Dictionary to store information about the current state. Stays persistent between calls.
+        :param exchange: Batch backtest exchange
+        """
+        pass
+
+    def populate_candidate_bars(self, dataframe: DataFrame,
+                                metadata: Dict[str, Any],
+                                parameter: Dict[str, Any]) -> Union[None, np.ndarray]:
+        """
+        Optional. Return a boolean array with an entry for every candle of the dataframe that is True where tick could
+        open, change or cancel orders. In backtests tick is then only called on these candles and on candles where
+        the exchange could execute orders, liquidate the position or pay funding. The candles in between are skipped.
+        The default None calls tick on every candle.
+        :param dataframe: Dataframe with indicators
+        :param metadata: Additional information, like the currently traded pair
+        :param parameter: Single parameter configuration from all possible combinations
+        :return: boolean array or None
+        """
+        return None
+
+    def populate_signals(self, dataframe: DataFrame,
+                         metadata: Dict[str, Any],
+                         parameter: Dict[str, Any]) -> Union[None, StrategySignals]:
+        """
+        Optional. Return the market orders tick would open as entry, exit and size arrays. The optimizer uses them to
+        screen the parameter combinations with a vectorized backtest before the full backtest, see screening_top_k.
+        Only strategies that open market orders and don't change the leverage can be described by signals.
+        The default None disables the screening.
+        :param dataframe: Dataframe with indicators
+        :param metadata: Additional information, like the currently traded pair
+        :param parameter: Single parameter configuration from all possible combinations
+        :return: signals or None
+        """
+        return None
+
     def get_indicators(self) -> List[Dict[str, Any]]:
         """
         Return a list of indicators for plotting.
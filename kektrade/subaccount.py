@@ -1,10 +1,11 @@
 import logging
 import os
 from multiprocessing import Lock
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Union
 import datetime
 import copy
 import pytz
+from pandas import DataFrame
 
 from kektrade import utils
 from kektrade.config import RunSettings
@@ -35,6 +36,7 @@ class SubaccountItem():
         self.exchange: IExchange = None
         self.dataprovider: DataProvider = None
         self.parameter: Dict[str, Any] = {}
+        self.indicator_dataframe: Union[None, DataFrame] = None
 
         self.id: int = 0
         self.parent_subaccount_id: int = 0
@@ -54,12 +56,24 @@ class SubaccountItem():
         """
         Create all the strategy and excahnge objects because they can't be pickled.
         """
+        self.load_strategy()
+        self.load_exchange()
+        self.load_dataprovider()
+
+    def load_strategy(self) -> None:
+        """
+        Search the strategy folder for the strategy class and create a instance.
+        """
         (module_path, strategy) = StrategyResolver.load_strategy(
             search_path=self.config["strategy_data_dir"],
             class_name=self.subaccount_config["strategy"]
         )
         self.strategy = strategy
 
+    def load_exchange(self) -> None:
+        """
+        Create a new exchange object and set the parameters from the config.
+        """
         exchange = ExchangeResolver.load_exchange(exchange_name=self.subaccount_config["exchange"]["endpoint"])
         exchange_parameters = self.config.get("exchange_default_parameters", {})
         for key, value in self.subaccount_config["exchange"].items():
@@ -68,9 +82,15 @@ class SubaccountItem():
         exchange.set_config(config=self.config, run_settings=self.run_settings)
         self.exchange = exchange
 
+    def load_dataprovider(self) -> None:
+        """
+        Create the dataprovider and register the pairs from the subaccount config.
+        The exchange has to be loaded first, in live mode the dataprovider updates modifiers incrementally.
+        """
         dataprovider = DataProvider(
             search_path=self.config["data_data_dir"],
             file_lock=self.file_lock,
+            live=not self.is_backtest()
         )
         dataprovider.set_pairs(self.subaccount_config)
         self.dataprovider = dataprovider
@@ -2,9 +2,11 @@ from kektrade.exchange import *
 from kektrade.database.types import *
 from kektrade.strategy import *
 from kektrade.misc import  *
+from kektrade.indicators.streaming import RSI, SMA
 
 from pandas import DataFrame
 import logging
+import numpy as np
 import talib
 import tqdm
 from typing import Dict, Any
@@ -14,6 +16,8 @@ logger = logging.getLogger(__name__)
 # This class is a sample. Feel free to customize it.
 class RsiPowerzones(IStrategy):
     startup_candle_count = 200
+    use_bar_view = True
+    use_tick_batch = True
 
     def populate_parameters(self) -> Dict[str, List[Any]]:
         return {
@@ -37,7 +41,20 @@ class RsiPowerzones(IStrategy):
             dataframe[col_sma] = talib.SMA(dataframe.close, timeperiod=sma)
         return dataframe
 
-    def tick(self, dataframe: DataFrame, index: int, metadata: Dict[str, Any], parameter: Dict[str, Any], variables: Dict[str, Any], exchange: IExchange) -> None:
+    def update_indicators(self, dataframe: DataFrame, start: int, metadata: Dict[str, Any], parameters: Dict[str, Any]) -> DataFrame:
+        if start == 0:
+            self.streaming_indicators = {f"rsi{rsi}": RSI(timeperiod=rsi) for rsi in parameters["rsi"]}
+            self.streaming_indicators.update({f"sma{sma}": SMA(timeperiod=sma) for sma in parameters["sma"]})
+
+        close = dataframe["close"].to_numpy(dtype=np.float64)[start:]
+        for col, indicator in self.streaming_indicators.items():
+            if start == 0:
+                dataframe[col] = indicator.initialize(close)
+            else:
+                dataframe.loc[start:, col] = indicator.update_many(close)
+        return dataframe
+
+    def tick(self, dataframe: BarView, index: int, metadata: Dict[str, Any], parameter: Dict[str, Any], variables: Dict[str, Any], exchange: IExchange) -> None:
         df = dataframe
         i = index
 
@@ -62,24 +79,82 @@ class RsiPowerzones(IStrategy):
         if parameter is None:
             close()
         elif i > 1:
+            sma_values = df[col_sma]
+            rsi_value = df[col_rsi][i]
             if side == "long":
-                if df.at[i, col_sma] > df.at[i - 1, col_sma]:
-                    if df.at[i, col_rsi] < 25:
+                if sma_values[i] > sma_values[i - 1]:
+                    if rsi_value < 25:
                         exchange.open_order("", OrderType.MARKET, contracts=c)
-                    elif df.at[i, col_rsi] > 55:
+                    elif rsi_value > 55:
                         close()
                 else:
                     close()
             else:
-                if df.at[i, col_sma] < df.at[i - 1, col_sma]:
-                    if df.at[i, col_rsi] > 75:
+                if sma_values[i] < sma_values[i - 1]:
+                    if rsi_value > 75:
                         exchange.open_order("", OrderType.MARKET, contracts=-c)
-                    elif df.at[i, col_rsi] < 45:
+                    elif rsi_value < 45:
                         close()
                 else:
                     close()
 
 
+    def tick_batch(self, dataframe: DataFrame, index: int, metadata: Dict[str, Any], parameters: List[Dict[str, Any]], variables: Dict[str, Any], exchange: BatchBacktest) -> None:
+        i = index
+
+        if "batch_rsi" not in variables:
+            variables["batch_rsi"] = np.column_stack([dataframe[f"rsi{parameter['rsi']}"].to_numpy() for parameter in parameters])
+            variables["batch_sma"] = np.column_stack([dataframe[f"sma{parameter['sma']}"].to_numpy() for parameter in parameters])
+            variables["batch_long"] = np.array([parameter["side"] == "long" for parameter in parameters])
+            variables["contracts"] = np.zeros(len(parameters))
+
+        contracts = variables["contracts"]
+        contracts = np.where(contracts == 0, exchange.get_contracts_percentage(0.01), contracts)
+        variables["contracts"] = contracts
+
+        if i > 1:
+            rsi = variables["batch_rsi"][i]
+            sma = variables["batch_sma"][i]
+            sma_prev = variables["batch_sma"][i - 1]
+            long = variables["batch_long"]
+
+            rising = sma > sma_prev
+            falling = sma < sma_prev
+
+            entry_long = long & rising & (rsi < 25)
+            entry_short = ~long & falling & (rsi > 75)
+            close = (long & (~rising | (rsi > 55))) | (~long & (~falling | (rsi < 45)))
+
+            position = exchange.get_position_contracts()
+            close &= position != 0
+            order_contracts = np.where(entry_long, contracts, np.where(entry_short, -contracts, np.where(close, -position, 0)))
+            exchange.open_orders(order_contracts, reduce_only=close)
+
+    def populate_signals(self, dataframe: DataFrame, metadata: Dict[str, Any], parameter: Dict[str, Any]) -> StrategySignals:
+        rsi = dataframe[f"rsi{parameter['rsi']}"].to_numpy(dtype=np.float64)
+        sma = dataframe[f"sma{parameter['sma']}"].to_numpy(dtype=np.float64)
+        sma_prev = np.roll(sma, 1)
+
+        if parameter["side"] == "long":
+            trend = sma > sma_prev
+            entry = trend & (rsi < 25)
+            close = ~trend | (rsi > 55)
+            side = 1
+        else:
+            trend = sma < sma_prev
+            entry = trend & (rsi > 75)
+            close = ~trend | (rsi < 45)
+            side = -1
+
+        # tick starts trading on the third candle
+        active = np.arange(len(sma)) > 1
+        return StrategySignals(
+            entry=np.where(active & entry, side, 0),
+            exit=active & ~entry & close,
+            size=0,
+            size_percentage=0.01
+        )
+
     def get_indicators(self):
         res = []
         parameters = self.populate_parameters()
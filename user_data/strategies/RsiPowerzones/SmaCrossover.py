@@ -5,6 +5,7 @@ from kektrade.misc import  *
 
 from pandas import DataFrame
 import logging
+import numpy as np
 import talib
 import tqdm
 from typing import Dict, Any
@@ -36,6 +37,15 @@ class SmaCrossover(IStrategy):
             c = -m - exchange.get_position().contracts
             exchange.open_order("", OrderType.MARKET, contracts=c)
 
+    def populate_signals(self, dataframe: DataFrame, metadata: Dict[str, Any], parameter: Dict[str, Any]) -> StrategySignals:
+        above = dataframe["sma_small"] > dataframe["sma_big"]
+        below = dataframe["sma_small"] < dataframe["sma_big"]
+        cross_up = above & below.shift(1, fill_value=False)
+        cross_down = below & above.shift(1, fill_value=False)
+
+        entry = np.where(cross_up, 1, np.where(cross_down, -1, 0))
+        return StrategySignals(entry=entry, exit=np.zeros(len(entry), dtype=bool), size=1)
+
     def get_indicators(self):
         return [
             {
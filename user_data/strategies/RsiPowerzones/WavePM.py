@@ -16,6 +16,7 @@ logger = logging.getLogger(__name__)
 
 # This class is a sample. Feel free to customize it.
 class WavePM(IStrategy):
+    use_bar_view = True
 
     def populate_variables(self, variables: Dict[str, Any]) -> None:
         variables["contracts"]  = 0
@@ -41,7 +42,7 @@ class WavePM(IStrategy):
 
         return dataframe
 
-    def tick(self, dataframe: DataFrame, index: int, metadata: Dict[str, Any], parameter: Dict[str, Any], variables: Dict[str, Any], exchange: IExchange) -> None:
+    def tick(self, dataframe: BarView, index: int, metadata: Dict[str, Any], parameter: Dict[str, Any], variables: Dict[str, Any], exchange: IExchange) -> None:
         df = dataframe
         i = index
 
@@ -50,20 +51,22 @@ class WavePM(IStrategy):
         m = exchange.get_contracts_percentage(50)
 
         if i > 10:
+            close = df.close[i]
+            mid = df.bb_mid_wloxp[i]
             if (parameter["side"] == "long"):
-                if df.at[i, "close"] > df.at[i, "bb_mid_wloxp"] and exchange.get_position().contracts == 0:
+                if close > mid and exchange.get_position().contracts == 0:
                     exchange.open_order("", OrderType.MARKET, contracts=m)
-                if np.isnan(df.at[i, "bb_mid_wloxp"]):
+                if np.isnan(mid):
                     exchange.close_position()
-                if df.at[i, "close"] < df.at[i, "bb_mid_wloxp"]:
+                if close < mid:
                     exchange.close_position()
 
             elif (parameter["side"] == "short"):
-                if df.at[i, "close"] < df.at[i, "bb_mid_wloxp"] and exchange.get_position().contracts == 0:
+                if close < mid and exchange.get_position().contracts == 0:
                     exchange.open_order("", OrderType.MARKET, contracts=-m)
-                if np.isnan(df.at[i, "bb_mid_wloxp"]):
+                if np.isnan(mid):
                     exchange.close_position()
-                if df.at[i, "close"] > df.at[i, "bb_mid_wloxp"]:
+                if close > mid:
                     exchange.close_position()
 
     def get_indicators(self):